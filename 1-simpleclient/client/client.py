@@ -9,10 +9,36 @@ GCD) which responds with a pickled list of potential group members.
 Sends a message to each group member, prints their response,
 then exits.
 """
-import pickle
 import socket
+from concurrent.futures import ThreadPoolExecutor, wait
 from socket import error as socket_error
 import sys
+import time
+
+import codec
+import framing
+from pool import ConnectionPool
+
+MAX_WORKERS = 256  # max members contacted at once by the fan-out
+
+
+class MemberResult(object):
+    """
+    Outcome of contacting one member: the reply (None on failure), the error that
+    stopped us (None on success) and how long the attempt took in seconds.
+    """
+
+    def __init__(self, member, reply=None, error=None, latency=None):
+        self.member = member
+        self.reply = reply
+        self.error = error
+        self.latency = latency
+
+    def __repr__(self):
+        outcome = repr(self.reply) if self.error is None else 'error: {}'.format(self.error)
+        latency = '?' if self.latency is None else '{:.1f}ms'.format(self.latency * 1000)
+        return '{}:{} {} ({})'.format(self.member['host'], self.member['port'], outcome,
+                                      latency)
 
 
 class Client(object):
@@ -22,17 +48,21 @@ class Client(object):
 
     BUF_SZ = 1024  # msg buffer size in bs
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, keepalive=True, codec_name=codec.STRUCT):
         """
         Instantiates a client object to connect with GCD and neighbor nodes.
 
         :param host: host name
         :param port: port number of host
+        :param keepalive: keep connections open between rounds and reuse them
+        :param codec_name: how to marshal requests, codec.STRUCT or codec.PICKLE
         """
 
         self.host, self.port = host, port
         self.members = []
         self.timeout = 1.5  # seconds
+        self.pool = ConnectionPool(self.timeout) if keepalive else None
+        self.codec = codec_name
 
     def join_group(self):
         """
@@ -42,79 +72,181 @@ class Client(object):
         console.
         """
 
-        # establish connection w/ gcd
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as gcd:
-            gcd_address = (self.host, self.port)
-            print('JOIN {}'.format(gcd_address))
-            gcd.settimeout(self.timeout)
-            try:
-                gcd.connect(gcd_address)
-            except socket_error as err:
-                print('failed to connect to gcd: {}'.format(err))
-                return
-
+        # establish connection w/ gcd (or reuse the one from the last round)
+        gcd_address = (self.host, self.port)
+        print('JOIN {}'.format(gcd_address))
+        try:
             # get members list from gcd
-            self.members = self.send_message(gcd, 'JOIN')
+            self.members = self.request(gcd_address, 'JOIN')
+        except (socket_error, framing.FramingError, codec.CodecError) as err:
+            print('failed to join gcd: {}'.format(err))
 
-    def connect_to_members(self):
+    def connect_to_members(self, fan_out=True, deadline=None, max_workers=MAX_WORKERS):
         """
         Attempts to connect and send msg to all members in members list. Logs responses
         and failures to connect.
+
+        By default all members are contacted in parallel from a bounded thread pool,
+        so a round with many dead members takes about one timeout rather than one
+        timeout per member. Members not heard from by the deadline are recorded as
+        failures.
+
+        :param fan_out: if False, contact members one at a time
+        :param deadline: seconds allowed for the whole round (default self.timeout)
+        :param max_workers: max number of members contacted at once
+        :return: list of MemberResult, one per member in members order
         """
 
-        for member in self.members:
-            print('HELLO to {}'.format(member))
-
-            # establish connection with member socket
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as node:
-                node.settimeout(self.timeout)
-                node_address = (member['host'], member['port'])
-                try:
-                    node.connect(node_address)
-                except socket_error as err:
-                    print('failed to connect to member: {}'.format(err))
+        if not self.members:
+            return []
+        if deadline is None:
+            deadline = self.timeout
+        end = time.monotonic() + deadline
+
+        if not fan_out:
+            results = [self.hello(member, end) for member in self.members]
+        else:
+            workers = max(1, min(max_workers, len(self.members)))
+            executor = ThreadPoolExecutor(max_workers=workers)
+            futures = [executor.submit(self.hello, member, end) for member in self.members]
+            wait(futures, timeout=max(0.0, end - time.monotonic()))
+            executor.shutdown(wait=False, cancel_futures=True)
+            results = []
+            for member, future in zip(self.members, futures):
+                if future.done() and not future.cancelled():
+                    results.append(future.result())
                 else:
-                    print(self.send_message(node, 'HELLO'))
+                    results.append(MemberResult(member, error='deadline exceeded',
+                                                latency=deadline))
+
+        for result in results:
+            print(result)
+        return results
+
+    def hello(self, member, end):
+        """
+        Connects to one member and sends it HELLO, giving up at the end of the round.
+
+        :param member: {'host': host, 'port': port} from the GCD
+        :param end: time.monotonic() value when the round's deadline passes
+        :return: MemberResult for this member
+        """
+        print('HELLO to {}'.format(member))
+        start = time.monotonic()
+        remaining = min(self.timeout, end - start)
+        if remaining <= 0:
+            return MemberResult(member, error='deadline exceeded', latency=0.0)
+
+        # connect (or reuse a connection) and send HELLO
+        node_address = (member['host'], member['port'])
+        try:
+            reply = self.request(node_address, 'HELLO', remaining)
+        except (socket_error, framing.FramingError, codec.CodecError) as err:
+            return MemberResult(member, error=err, latency=time.monotonic() - start)
+        return MemberResult(member, reply=reply, latency=time.monotonic() - start)
+
+    def request(self, address, data, timeout=None):
+        """
+        Sends data to address as one frame and returns the unmarshalled reply. With
+        keepalive on, a pooled connection is used and kept for next time; if that
+        connection turns out to have been closed by the peer while idle, the request
+        is retried on another one (a fresh connection once the pool runs out).
+
+        :param address: (host, port) to send to
+        :param data: data to send via message
+        :param timeout: socket timeout in seconds (default self.timeout)
+        :return: unmarshalled reply
+        :raises OSError: if connecting, sending or receiving fails
+        """
+        timeout = self.timeout if timeout is None else timeout
+        while True:
+            if self.pool is None:
+                sock, reused = socket.create_connection(address, timeout), False
+            else:
+                sock, reused = self.pool.acquire(address, timeout)
+            try:
+                framing.send_frame(sock, codec.encode(data, self.codec))
+                reply, _codec_name = codec.decode(framing.recv_frame(sock))
+            except ConnectionError:
+                ConnectionPool.discard(sock)
+                if reused:
+                    continue  # stale keepalive connection, try a new one
+                raise
+            except BaseException:
+                ConnectionPool.discard(sock)
+                raise
+            if self.pool is None:
+                sock.close()
+            else:
+                self.pool.release(address, sock)
+            return reply
+
+    def poll_group(self, rounds, interval):
+        """
+        Repeats the JOIN and HELLO rounds, reusing connections between them.
+
+        :param rounds: number of rounds
+        :param interval: seconds to wait between rounds
+        :return: MemberResults from the last round
+        """
+        results = []
+        for i in range(rounds):
+            if i:
+                time.sleep(interval)
+            self.join_group()
+            results = self.connect_to_members()
+            if self.pool is not None:
+                self.pool.expire()
+        return results
+
+    def close(self):
+        """ Closes any connections kept open for reuse """
+        if self.pool is not None:
+            self.pool.close()
 
     @staticmethod
     def send_message(sock, data, buffer_size=BUF_SZ):
         """
-        Marshalls data and sends to given socket. Blocks waiting for response,
-        unmarshalls and returns response. If send fails, logs and returns
+        Marshalls data and sends it as one frame to given socket. Blocks waiting for
+        the whole response frame, unmarshalls and returns response. If send fails,
+        logs and returns
 
         :param sock: socket to send message and recv message on
         :param data: data to send via message
-        :param buffer_size: num bytes in recv buffer
+        :param buffer_size: unused, responses are read to their full framed length
         :return: message
         """
 
-        # send pickled data on sock
+        # send marshalled data on sock
         try:
-            sock.sendall(pickle.dumps(data))
+            framing.send_msg(sock, data)
         except socket_error as err:
             print('failed to send msg to socket: {}'.format(err))
             return
 
-        # recv response, unpickle, and return
-        return pickle.loads(sock.recv(buffer_size))
+        # recv response, unmarshall, and return
+        try:
+            return framing.recv_msg(sock)
+        except (socket_error, framing.FramingError, codec.CodecError) as err:
+            print('failed to recv msg from socket: {}'.format(err))
 
 
 if __name__ == '__main__':
     print('\nRPC Client Program\n')
 
     # handle invalid command line args
-    if len(sys.argv) != 3:
-        print("Usage: python client.py HOST PORT")
+    if not 3 <= len(sys.argv) <= 5:
+        print("Usage: python client.py HOST PORT [ROUNDS [INTERVAL]]")
         exit(1)
 
     # store parameters needed to init Client object, then init
     HOST, GCD_PORT = sys.argv[1], int(sys.argv[2])
+    ROUNDS = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    INTERVAL = float(sys.argv[4]) if len(sys.argv) > 4 else 5.0
     client = Client(HOST, GCD_PORT)
 
-    # attempt to join the group
-    client.join_group()
-
-    # attempt to reach the members in the group
-    client.connect_to_members()
+    # attempt to join the group and reach its members, ROUNDS times
+    client.poll_group(ROUNDS, INTERVAL)
+    client.close()
 
     sys.exit(0)
\ No newline at end of file
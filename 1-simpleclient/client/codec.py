@@ -0,0 +1,146 @@
+"""
+Message Codecs
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Marshalling for the payload of each frame. Two codecs are available:
+
+- pickle: marshals anything, but is slow for small tuples, bloated on the wire and
+  unsafe to accept from untrusted peers.
+- struct: compact binary encoding of the message shape this lab sends, which is
+  text (JOIN, HELLO and the replies to them). Anything else (such as the GCD's list
+  of members) falls back to pickle.
+
+Every struct payload starts with MAGIC, which no pickle (protocol 2 and up starts
+with 0x80) does, so payloads identify their own codec. decode() sniffs it and tells
+the caller which codec the peer used; servers answer in the same codec the request
+arrived in, which is how the codec is negotiated per connection.
+
+References
+https://docs.python.org/3/library/struct.html
+https://docs.python.org/3/library/pickle.html (see the warning at the top)
+"""
+
+import pickle
+import struct
+
+PICKLE, STRUCT = 'pickle', 'struct'
+MAGIC = 0xB5  # first byte of every struct-codec payload
+
+# struct-codec message kind (second byte of the payload), numbered the same in each
+# lab's copy of this module
+K_TEXT = 1
+
+PREFIX = struct.Struct('!BB')  # magic, kind
+
+
+class CodecError(ValueError):
+    """
+    Raised when a message can't be encoded by, or decoded as, the requested codec.
+    """
+
+
+class PickleCodec(object):
+    """ Marshals anything with pickle """
+    name = PICKLE
+
+    @staticmethod
+    def encode(data):
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(payload):
+        try:
+            return pickle.loads(payload)
+        except Exception as err:
+            raise CodecError('not a pickled message: {}'.format(err))
+
+
+class StructCodec(object):
+    """
+    Binary codec for text messages.
+
+    >>> c = StructCodec()
+    >>> c.decode(c.encode('JOIN'))
+    'JOIN'
+    >>> len(c.encode('JOIN')), len(PickleCodec.encode('JOIN'))
+    (6, 19)
+    """
+    name = STRUCT
+
+    @staticmethod
+    def encode(data):
+        """
+        :param data: message to marshal
+        :return: payload bytes
+        :raises CodecError: if data isn't text
+        """
+        if type(data) is not str:
+            raise CodecError('unsupported message shape: {!r}'.format(data))
+        try:
+            return PREFIX.pack(MAGIC, K_TEXT) + data.encode('utf-8')
+        except UnicodeEncodeError as err:
+            raise CodecError('cannot struct-encode {!r}: {}'.format(data, err))
+
+    @staticmethod
+    def decode(payload):
+        """
+        :param payload: bytes starting with MAGIC
+        :return: the message
+        :raises CodecError: if the payload is truncated or malformed
+        """
+        try:
+            magic, kind = PREFIX.unpack_from(payload)
+            if magic != MAGIC:
+                raise CodecError('not a struct-codec payload')
+            if kind != K_TEXT:
+                raise CodecError('unknown struct-codec kind {}'.format(kind))
+            return str(memoryview(payload)[PREFIX.size:], 'utf-8')
+        except (struct.error, UnicodeDecodeError) as err:
+            raise CodecError('malformed struct-codec payload: {}'.format(err))
+
+
+CODECS = {PICKLE: PickleCodec(), STRUCT: StructCodec()}
+
+
+def encode(data, codec=STRUCT):
+    """
+    Marshal data with the given codec, falling back to pickle for shapes the struct
+    codec doesn't know.
+
+    :param data: message to marshal
+    :param codec: PICKLE or STRUCT
+    :return: payload bytes
+    """
+    if codec == STRUCT:
+        try:
+            return CODECS[STRUCT].encode(data)
+        except CodecError:
+            pass
+    return CODECS[PICKLE].encode(data)
+
+
+def sniff(payload):
+    """
+    The codec a payload is in, going by its first byte only. Lets a server answer a
+    message it couldn't decode in a codec the sender can read.
+
+    >>> sniff(encode('JOIN', STRUCT)), sniff(encode('JOIN', PICKLE))
+    ('struct', 'pickle')
+    """
+    return STRUCT if payload[:1] == bytes((MAGIC,)) else PICKLE
+
+
+def decode(payload, accept_pickle=True):
+    """
+    Unmarshal a payload in whichever codec it was encoded with.
+
+    :param payload: bytes of one frame
+    :param accept_pickle: if False, refuse pickled payloads (e.g. from untrusted peers)
+    :return: (message, codec name)
+    :raises CodecError: if the payload can't be decoded (or is a refused pickle)
+    """
+    if payload[:1] == bytes((MAGIC,)):
+        return CODECS[STRUCT].decode(payload), STRUCT
+    if not accept_pickle:
+        raise CodecError('pickled messages are not accepted')
+    return CODECS[PICKLE].decode(payload), PICKLE
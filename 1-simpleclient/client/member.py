@@ -0,0 +1,63 @@
+"""
+CPSC 5520, Seattle University
+This is free and unencumbered software released into the public domain.
+:Authors: Narissa Tsuboi
+:Version: 1
+
+:brief: A group member that answers HELLO messages. Connections are kept open, so a
+client polling the group can send any number of HELLOs over one connection.
+"""
+import socketserver
+import sys
+
+import codec
+import framing
+
+
+class HelloHandler(socketserver.BaseRequestHandler):
+    """
+    Answers every framed HELLO on a connection until the client closes it.
+    """
+
+    def handle(self):
+        """
+        Handles the incoming messages - expects only 'HELLO' messages. Replies go
+        back in the codec the request came in.
+        """
+        while True:
+            try:
+                raw = framing.recv_frame(self.request)
+            except (ConnectionError, framing.FramingError):
+                return  # client is done with this connection
+            try:
+                message, codec_name = codec.decode(raw)
+            except codec.CodecError as err:
+                codec_name = codec.sniff(raw)
+                response = 'Could not decode message: {}'.format(err)
+            else:
+                if message != 'HELLO':
+                    response = 'Unexpected message: {}'.format(message)
+                else:
+                    response = 'Happy to meet you, {}'.format(self.client_address)
+            try:
+                framing.send_msg(self.request, response, codec_name)
+            except OSError:
+                return
+
+
+class MemberServer(socketserver.ThreadingTCPServer):
+    """
+    Member listener, one thread per kept-alive client connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python member.py PORT")
+        exit(1)
+    port = int(sys.argv[1])
+    with MemberServer(('', port), HelloHandler) as server:
+        print('member is listening on {}...'.format(server.server_address))
+        server.serve_forever()
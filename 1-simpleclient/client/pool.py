@@ -0,0 +1,150 @@
+"""
+CPSC 5520, Seattle University
+This is free and unencumbered software released into the public domain.
+:Authors: Narissa Tsuboi
+:Version: 1
+
+:brief: Keep-alive connection pool for the simple client. Connections are kept open
+between messages, keyed by (host, port), so repeated JOIN/HELLO rounds reuse an
+existing TCP connection instead of paying for a new handshake each time. Idle
+connections expire and every connection is health checked before it is reused.
+"""
+import socket
+import threading
+import time
+
+IDLE_TIMEOUT = 30.0  # seconds an unused connection is kept open
+MAX_PER_ADDRESS = 4  # idle connections kept per (host, port)
+
+
+def is_alive(sock):
+    """
+    Health check for an idle connection. With no request outstanding, the socket
+    should have nothing to read; if it is readable the peer has closed it (or sent
+    something we didn't ask for), so either way it can't be reused. Checked with a
+    non-blocking peek rather than select(), which can't take fds past FD_SETSIZE.
+
+    :param sock: idle connected socket
+    :return: True if it looks safe to send on
+    """
+    try:
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        finally:
+            sock.setblocking(True)
+    except BlockingIOError:
+        return True  # nothing to read
+    except OSError:  # closed, reset or invalid file descriptor
+        return False
+    return False  # peer closed it, or sent something unasked for
+
+
+class ConnectionPool(object):
+    """
+    Pool of open TCP connections keyed by (host, port). Safe to share between the
+    threads of a fan-out.
+    """
+
+    def __init__(self, timeout, idle_timeout=IDLE_TIMEOUT, max_per_address=MAX_PER_ADDRESS):
+        """
+        :param timeout: socket timeout for new connections, in seconds
+        :param idle_timeout: seconds an idle connection may sit in the pool
+        :param max_per_address: idle connections kept for each address
+        """
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_per_address = max_per_address
+        self.idle = {}  # {(host, port): [(socket, time released), ...], ...}
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def acquire(self, address, timeout=None):
+        """
+        Get a connection to address, reusing a healthy idle one if there is one.
+
+        :param address: (host, port) to connect to
+        :param timeout: socket timeout to use (default self.timeout)
+        :return: (socket, reused) where reused is True if it came from the pool
+        :raises OSError: if a new connection can't be made
+        """
+        timeout = self.timeout if timeout is None else timeout
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                idle = self.idle.get(address)
+                if not idle:
+                    self.misses += 1
+                    break
+                sock, released = idle.pop()
+            if now - released <= self.idle_timeout and is_alive(sock):
+                with self.lock:
+                    self.hits += 1
+                sock.settimeout(timeout)
+                return sock, True
+            sock.close()
+
+        sock = socket.create_connection(address, timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return sock, False
+
+    def release(self, address, sock):
+        """
+        Return a connection after a complete request/response, for reuse.
+
+        :param address: (host, port) it is connected to
+        :param sock: the connection
+        """
+        with self.lock:
+            idle = self.idle.setdefault(address, [])
+            if len(idle) < self.max_per_address:
+                idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    @staticmethod
+    def discard(sock):
+        """
+        Drop a connection that failed or was left mid-conversation.
+
+        :param sock: the connection
+        """
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def expire(self):
+        """
+        Close idle connections that have been unused longer than idle_timeout.
+
+        :return: number of connections closed
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        with self.lock:
+            for address in list(self.idle):
+                keep = []
+                for sock, released in self.idle[address]:
+                    (keep if released > cutoff else expired).append((sock, released))
+                if keep:
+                    self.idle[address] = keep
+                else:
+                    del self.idle[address]
+        for sock, _released in expired:
+            sock.close()
+        return len(expired)
+
+    def close(self):
+        """ Close every idle connection """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for sock, _released in connections:
+                sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,5 +1,201 @@
+import os
+import pickle
+import socket
+import threading
+import time
 import unittest
 
+import codec
+import framing
 from client import Client
+from member import HelloHandler, MemberServer
+from pool import is_alive
+
 
 class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client_sock, self.server_sock = socket.socketpair()
+
+    def tearDown(self):
+        self.client_sock.close()
+        self.server_sock.close()
+
+    def serve(self, response):
+        """ Answers one framed request on the server end with response """
+        def answer():
+            request = framing.recv_msg(self.server_sock)
+            framing.send_msg(self.server_sock, response)
+            self.requests.append(request)
+        self.requests = []
+        thread = threading.Thread(target=answer)
+        thread.start()
+        return thread
+
+    def test_send_message_round_trip(self):
+        thread = self.serve('hi')
+        self.assertEqual(Client.send_message(self.client_sock, 'HELLO'), 'hi')
+        thread.join()
+        self.assertEqual(self.requests, ['HELLO'])
+
+    def test_send_message_large_response(self):
+        members = [{'host': 'localhost', 'port': port} for port in range(10_000)]
+        thread = self.serve(members)
+        self.assertEqual(Client.send_message(self.client_sock, 'JOIN'), members)
+        thread.join()
+
+    def test_send_message_peer_closed(self):
+        self.server_sock.close()
+        self.assertIsNone(Client.send_message(self.client_sock, 'HELLO'))
+
+
+class TestConnectToMembers(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('localhost', 0)
+        self.client.timeout = 0.5
+        self.server = socket.create_server(('localhost', 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.answer_hellos, daemon=True).start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def answer_hellos(self):
+        """ Member that replies to every HELLO with its port """
+        while True:
+            try:
+                conn, _addr = self.server.accept()
+            except OSError:
+                return
+            with conn:
+                framing.recv_msg(conn)
+                framing.send_msg(conn, self.port)
+
+    def silent_member(self):
+        """ Member that accepts connections but never answers """
+        silent = socket.create_server(('localhost', 0))
+        self.addCleanup(silent.close)
+        return {'host': 'localhost', 'port': silent.getsockname()[1]}
+
+    def test_fan_out_one_timeout(self):
+        live = {'host': 'localhost', 'port': self.port}
+        self.client.members = [self.silent_member() for _ in range(20)] + [live]
+        start = time.monotonic()
+        results = self.client.connect_to_members()
+        self.assertLess(time.monotonic() - start, 2 * self.client.timeout)
+        self.assertEqual(len(results), 21)
+        self.assertEqual(results[-1].reply, self.port)
+        self.assertIsNone(results[-1].error)
+        self.assertTrue(all(r.error is not None for r in results[:-1]))
+
+    def test_serial_matches_fan_out(self):
+        self.client.members = [{'host': 'localhost', 'port': self.port}] * 3
+        serial = self.client.connect_to_members(fan_out=False)
+        parallel = self.client.connect_to_members()
+        self.assertEqual([r.reply for r in serial], [r.reply for r in parallel])
+
+
+class TestKeepalive(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = 0
+        test = self
+
+        class CountingHandler(HelloHandler):
+            def setup(self):
+                test.connections += 1
+
+        self.server = MemberServer(('localhost', 0), CountingHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.member = {'host': 'localhost', 'port': self.server.server_address[1]}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rounds_reuse_connection(self):
+        client = Client('localhost', 0)
+        client.members = [self.member]
+        for _ in range(3):
+            results = client.connect_to_members()
+            self.assertTrue(results[0].reply.startswith('Happy to meet you'))
+        client.close()
+        self.assertEqual(self.connections, 1)
+        self.assertEqual(client.pool.hits, 2)
+
+    def test_no_keepalive(self):
+        client = Client('localhost', 0, keepalive=False)
+        client.members = [self.member]
+        for _ in range(3):
+            client.connect_to_members()
+        self.assertEqual(self.connections, 3)
+
+    def test_stale_connection_is_replaced(self):
+        client = Client('localhost', 0)
+        client.members = [self.member]
+        client.connect_to_members()
+        for sock, _released in client.pool.idle[('localhost', self.member['port'])]:
+            sock.shutdown(socket.SHUT_RDWR)  # as if the member dropped it
+        results = client.connect_to_members()
+        self.assertIsNone(results[0].error)
+        self.assertEqual(self.connections, 2)
+        client.close()
+
+    def test_high_fd_is_alive(self):
+        # fds past FD_SETSIZE (1024) are normal in large groups
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        try:
+            high = os.dup2(ours.fileno(), 1500)
+        except OSError:
+            self.skipTest('fd limit too low')
+        finally:
+            ours.close()
+        ours = socket.socket(fileno=high)
+        self.addCleanup(ours.close)
+        self.assertTrue(is_alive(ours))
+        theirs.close()
+        self.assertFalse(is_alive(ours))
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_member_answers_in_request_codec(self):
+        server = MemberServer(('localhost', 0), HelloHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with socket.create_connection(server.server_address) as sock:
+            for codec_name in (codec.STRUCT, codec.PICKLE):
+                framing.send_msg(sock, 'HELLO', codec_name)
+                reply, reply_codec = codec.decode(framing.recv_frame(sock))
+                self.assertEqual(reply_codec, codec_name)
+                self.assertTrue(reply.startswith('Happy to meet you'))
+
+    def test_refuse_pickle(self):
+        with self.assertRaises(codec.CodecError):
+            codec.decode(pickle.dumps('HELLO'), accept_pickle=False)
+        self.assertEqual(codec.decode(codec.encode('HELLO'), accept_pickle=False),
+                         ('HELLO', codec.STRUCT))
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_reader_partial_and_pipelined(self):
+        wire = b''.join(framing.frame(pickle.dumps(i)) for i in range(3))
+        reader = framing.FrameReader()
+        frames = []
+        for i in range(len(wire)):  # worst case, one byte per recv
+            frames += reader.feed(wire[i:i + 1])
+        self.assertEqual([pickle.loads(f) for f in frames], [0, 1, 2])
+        self.assertEqual(len(reader), 0)
+
+    def test_reader_rejects_oversize(self):
+        reader = framing.FrameReader(max_frame_size=4)
+        with self.assertRaises(framing.FramingError):
+            reader.feed(framing.frame(b'12345'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,12 @@ This is free and unencumbered software released into the public domain.
 :Authors: Kevin Lundeen
 :Version: f20
 """
-import pickle
 import socketserver
 import sys
 
+import codec
+import framing
+
 BUF_SZ = 1024 # tcp receive buffer size
 
 
@@ -24,32 +26,58 @@ class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
 
   def handle(self):
     """
-    Handles the incoming messages - expects only 'JOIN' messages
+    Handles the incoming messages - expects only 'JOIN' messages, one per frame.
+    On a threaded server a client may pipeline several on one connection; a
+    single-threaded one answers one per connection, so an idle keepalive client
+    can't hold up everyone else.
     """
-    raw = self.request.recv(BUF_SZ) # self.request is the TCP socket connected to the client
     print(self.client_address)
-    try:  # deserialize datastream
-      print('gcdserver >>> unpickling client message...')
-      message = pickle.loads(raw)
-    except (pickle.PickleError, KeyError, EOFError): # msg wasnt picked
-      print('gcdserver >>> cli msg was not pickled...')
-      response = bytes('Expected a pickled message, got ' + str(raw)[:100] + '\n', 'utf-8')
-    else:  # msg was picked but not 'JOIN'
-      if message != 'JOIN':  # response is serialized error response
-        print('gcdserver >>> cli msg was not JOIN')
-        response = pickle.dumps('Unexpected message: ' + str(message))
-      else:  # success, sends serialized message back
-        print('gcdserver >>> In successful join response')
-        response = pickle.dumps(self.JOIN_RESPONSE)
-    print('gcdserver >>> sending reponse back to cli')
-    self.request.sendall(response)
+    pipelined = isinstance(self.server, socketserver.ThreadingMixIn)
+    while True:
+      try:
+        raw = framing.recv_frame(self.request) # self.request is the TCP socket connected to the client
+      except (ConnectionError, framing.FramingError):
+        break
+      try:  # deserialize datastream, answer in the same codec
+        print('gcdserver >>> unmarshalling client message...')
+        message, codec_name = codec.decode(raw)
+      except codec.CodecError as err: # msg wasnt marshalled
+        print('gcdserver >>> cli msg could not be decoded...')
+        response = codec.encode('Could not decode message: {}'.format(err), codec.sniff(raw))
+      else:  # msg was picked but not 'JOIN'
+        if message != 'JOIN':  # response is serialized error response
+          print('gcdserver >>> cli msg was not JOIN')
+          response = codec.encode('Unexpected message: ' + str(message), codec_name)
+        else:  # success, sends serialized message back
+          print('gcdserver >>> In successful join response')
+          response = codec.encode(self.JOIN_RESPONSE, codec_name)
+      print('gcdserver >>> sending reponse back to cli')
+      framing.send_frame(self.request, response)
+      if not pipelined:
+        break
+
+
+class ThreadedGroupCoordinator(socketserver.ThreadingTCPServer):
+  """
+  GCD server that handles each connection in its own thread, so one slow client
+  doesn't hold up everyone else's JOIN. JOIN_RESPONSE is read-only, so no locking.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
 
 
 if __name__ == '__main__':
-  if len(sys.argv) != 2:
-    print("Usage: python gcd.py GCDPORT")
+  args = sys.argv[1:]
+  threaded = '--single-threaded' not in args
+  for flag in ('--single-threaded', '--threaded'): # --threaded is the default now
+    if flag in args:
+      args.remove(flag)
+  if len(args) != 1:
+    print("Usage: python gcd.py GCDPORT [--single-threaded]")
     exit(1)
-  port = int(sys.argv[1])
-  with socketserver.TCPServer(('', port), GroupCoordinatorDaemon) as server:
+  port = int(args[0])
+  server_class = ThreadedGroupCoordinator if threaded else socketserver.TCPServer
+  with server_class(('', port), GroupCoordinatorDaemon) as server:
     print('gcdserv is listening...')
     server.serve_forever()
\ No newline at end of file
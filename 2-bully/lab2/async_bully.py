@@ -0,0 +1,383 @@
+"""
+Bully Consensus Algorithm (asyncio engine)
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: The same Bully node as bully.py, driven by asyncio instead of a hand-rolled
+selectors loop. Every peer connection is read by its own task, and every ELECTION
+sent is a task that waits for that peer's OK with its own deadline, so timeouts fire
+exactly when they are due instead of being found by scanning the state table every
+CHECK_INTERVAL. Messages and framing are the same as bully.py's, so nodes of either
+kind can take part in the same election: msgs are built by Bully.outgoing, so they
+carry the election epoch and, when gossiping (the default), the membership digest,
+and MEMBERS gossip is answered the same way.
+
+What the asyncio engine leaves out: coalescing (ELECTIONs still go to every higher
+peer at once and each OK is sent straight away, not batched), re-announcing itself
+to a node that starts an election while it leads (it runs a new election instead),
+and UDP heartbeats, which it neither sends nor watches, so a selector node running
+them should not have an asyncio node as its leader.
+
+Usage:
+    python async_bully.py GCDHOST GCDPORT SUID [YYYY-MM-DD]
+
+References
+https://docs.python.org/3/library/asyncio-stream.html
+https://docs.python.org/3/library/asyncio-task.html#asyncio.wait_for
+https://en.wikipedia.org/wiki/Bully_algorithm
+"""
+
+import asyncio
+import logging
+import sys
+from datetime import datetime
+
+import codec
+import framing
+from bully import ASSUME_FAILURE_TIMEOUT, Bully, State, log
+
+
+async def read_frame(reader):
+    """
+    Read one framed payload from a stream.
+
+    :param reader: asyncio.StreamReader
+    :return: payload bytes
+    :raises asyncio.IncompleteReadError: if the peer closed the connection
+    :raises framing.FramingError: if the header announces an oversized frame
+    """
+    size, = framing.HEADER.unpack(await reader.readexactly(framing.HEADER_SZ))
+    if size > framing.MAX_FRAME_SZ:
+        raise framing.FramingError('frame of {} bytes exceeds {}'.format(
+            size, framing.MAX_FRAME_SZ))
+    return await reader.readexactly(size)
+
+
+class AsyncBully(Bully):
+    """
+    Bully node run by an asyncio event loop. Identity, membership and the GCD JOIN
+    are inherited from Bully; only the election engine is different.
+    """
+
+    def __init__(self, gcd_address, next_birthday, su_id, timeout=ASSUME_FAILURE_TIMEOUT):
+        """
+        :param gcd_address: IP address (sysarg[0]), port (sysarg[1])
+        :param next_birthday: users next birthday in iso-str format 'YEAR-MO-DY'
+        :param su_id: user's six digit seattle u id
+        :param timeout: seconds to wait for an OK or a COORDINATOR before giving up
+        """
+        super().__init__(gcd_address, next_birthday, su_id)
+        self.selector.close()  # the event loop does the waiting
+        self.timeout = timeout
+        self.writers = {}  # {pid: StreamWriter, ...} (persistent connection per peer)
+        self.pending_ok = {}  # {pid: Future, ...} (set when that peer answers OK)
+        self.election = None  # Task running my current election, if any
+        self.victor = None  # Event set when a COORDINATOR arrives
+        self.tasks = set()  # strong references to running tasks
+        self.gossiped = {}  # {pid: (my digest, their digest, when), ...} tables sent
+        self.server = None
+
+    def spawn(self, coroutine):
+        """ Run a coroutine as a task, keeping a reference until it is done """
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def start(self):
+        """ Start accepting peers on the listener socket """
+        self.server = await asyncio.start_server(self.serve_peer, sock=self.listener)
+
+    async def serve(self, reason=None):
+        """
+        Accept peers and take part in elections until cancelled.
+
+        :param reason: if given, start an election straight away (note for log)
+        """
+        await self.start()
+        if reason is not None:
+            self.start_election(reason)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        """ Stop serving and close every connection """
+        if self.server is not None:
+            self.server.close()
+        for task in list(self.tasks):
+            task.cancel()
+        for writer in list(self.writers.values()):
+            writer.close()
+        self.writers.clear()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # connections
+
+    async def serve_peer(self, reader, writer, pid=None):
+        """
+        Read and handle every message arriving on one connection.
+
+        :param reader: StreamReader of the connection
+        :param writer: StreamWriter of the connection (used for replies)
+        :param pid: peer's pid if we connected to them, else learned from HELLO
+        """
+        try:
+            while True:
+                message = self.unmarshal(await read_frame(reader))
+                pid = self.handle(message, writer, pid)
+        except (OSError, EOFError, codec.CodecError, framing.FramingError) as err:
+            log.warning('%s: closing: %r', pid, err)
+        finally:
+            if pid is not None and self.writers.get(pid) is writer:
+                del self.writers[pid]
+            writer.close()
+
+    async def connect(self, pid):
+        """
+        Get the connection to a peer, opening it (and saying HELLO) if need be.
+
+        :param pid: peer's process id
+        :return: StreamWriter, or None if the peer can't be reached right now
+        """
+        writer = self.writers.get(pid)
+        if writer is not None:
+            return writer
+        if not self.backoff.ready(pid):
+            return None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(*self.members[pid]), self.timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            log.warning('FAILURE: couldnt connect to member %s %r', pid, err)
+            self.backoff.failed(pid)
+            return None
+        if pid in self.writers:  # someone else connected while we were waiting
+            writer.close()
+            return self.writers[pid]
+        self.writers[pid] = writer
+        writer.write(framing.frame(codec.encode(self.hello(), self.codec)))
+        self.spawn(self.serve_peer(reader, writer, pid))
+        return writer
+
+    async def send_to(self, pid, message_name, writer=None):
+        """
+        Send an election msg to a peer, shaped as the selector engine would send it.
+
+        :param pid: peer's process id
+        :param message_name: 'ELECTION', 'OK' or 'COORDINATOR'
+        :param writer: connection to send on (default: the peer's connection)
+        :return: True if it was sent
+        """
+        return await self.send_message(pid, self.outgoing(State(message_name)), writer)
+
+    async def send_message(self, pid, message, writer=None):
+        """
+        Send a msg to a peer.
+
+        :param pid: peer's process id
+        :param message: (message_name, data, ...) to marshal
+        :param writer: connection to send on (default: the peer's connection)
+        :return: True if it was sent
+        """
+        message_name = message[0]
+        if writer is None:
+            writer = await self.connect(pid)
+            if writer is None:
+                return False
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: sending %s [%s]', pid, message_name, self.pr_now())
+        self.metrics.incr('sent.' + message_name)
+        try:
+            writer.write(framing.frame(codec.encode(message, self.codec)))
+            await writer.drain()
+        except OSError as err:
+            log.warning('%s: send failed %r', pid, err)
+            if pid is not None:
+                self.backoff.failed(pid)
+            writer.close()
+            return False
+        return True
+
+    def offer_table(self, pid, writer, their_digest):
+        """
+        Gossip: send our table to a peer whose digest differs, unless we already did
+        for this pair of digests recently (as Bully.offer_members).
+
+        :param pid: peer's process id
+        :param writer: connection the peer's msg came in on
+        :param their_digest: digest the peer sent
+        """
+        now = self.clock()
+        last = self.gossiped.get(pid)
+        if last is not None and last[:2] == (self.digest, their_digest) and \
+                now - last[2] < ASSUME_FAILURE_TIMEOUT:
+            return
+        self.gossiped[pid] = (self.digest, their_digest, now)
+        self.spawn(self.send_message(pid, ('MEMBERS', self.members, None, self.digest), writer))
+
+    def return_table(self, pid, writer, their_idea, their_digest):
+        """
+        Gossip: a peer sent its table (already merged into ours). If we still differ,
+        send back just the entries it lacks (as Bully.exchange_members).
+
+        :param pid: peer's process id
+        :param writer: connection the table came in on
+        :param their_idea: the table they sent
+        :param their_digest: digest of their whole table
+        """
+        if their_digest == self.digest:
+            return
+        lacking = {member: listener for member, listener in self.members.items()
+                   if their_idea.get(member) != listener}
+        if lacking:
+            self.spawn(self.send_message(pid, ('MEMBERS', lacking, None, self.digest), writer))
+
+    # election
+
+    def handle(self, message, writer, pid):
+        """
+        React to one message from a peer.
+
+        :param message: unmarshalled (message_name, their_idea) tuple
+        :param writer: connection it came in on
+        :param pid: peer's pid, if known
+        :return: peer's pid, which a HELLO may have just told us
+        """
+        message_name, their_idea = message[:2]
+        epoch = message[2] if len(message) > 2 else None
+        digest = message[3] if len(message) > 3 else None
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: received %s [%s]', pid, message_name, self.pr_now())
+        self.metrics.incr('received.' + message_name)
+        if message_name == 'HELLO':
+            for pid, listener in (their_idea or {}).items():
+                self.add_member(pid, listener)
+                self.writers.setdefault(pid, writer)
+                self.backoff.succeeded(pid)
+            return pid
+        if pid is not None:
+            self.backoff.succeeded(pid)
+        self.update_members(their_idea)
+        if message_name == 'MEMBERS':
+            self.return_table(pid, writer, their_idea, digest)
+            return pid
+        if digest is not None and digest != self.digest:
+            self.offer_table(pid, writer, digest)
+
+        # a stale ELECTION was started before the leader we know about won
+        stale = epoch is not None and epoch <= self.leader_epoch and self.bully is not None
+        if epoch is not None:
+            self.epoch = max(self.epoch, epoch)
+
+        if message_name == 'ELECTION':
+            self.spawn(self.send_to(pid, 'OK', writer))
+            if not self.is_election_in_progress() and not stale:
+                self.start_election('Got a VOTE card', join=True)
+        elif message_name == 'COORDINATOR':
+            if epoch is not None and epoch < self.leader_epoch:
+                return pid  # announcement of an older election
+            self.set_leader(pid)
+            if epoch is not None:
+                self.leader_epoch = epoch
+            if self.victor is not None:
+                self.victor.set()
+            if self.is_election_in_progress():
+                self.election.cancel()
+        elif message_name == 'OK':
+            future = self.pending_ok.get(pid)
+            if future is not None and not future.done():
+                future.set_result(True)
+        return pid
+
+    def is_election_in_progress(self):
+        """ True while my election task is running """
+        return self.election is not None and not self.election.done()
+
+    def start_election(self, reason, join=False):
+        """
+        Start an election in the background, unless one is already running.
+
+        :param reason: note for log
+        :param join: True if a peer's ELECTION started it (see Bully.start_election)
+        """
+        if not self.is_election_in_progress():
+            log.info('Starting an election %s', reason)
+            self.metrics.incr('elections.started')
+            self.election_started = self.clock()
+            if not join:
+                self.epoch += 1
+            self.election = self.spawn(self.elect())
+
+    async def ask(self, pid):
+        """
+        One peer conversation: send ELECTION and wait, up to self.timeout, for OK.
+
+        :param pid: higher peer's process id
+        :return: True if the peer answered OK in time
+        """
+        future = self.pending_ok[pid] = asyncio.get_running_loop().create_future()
+        try:
+            if not await self.send_to(pid, 'ELECTION'):
+                return False
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if self.pending_ok.get(pid) is future:
+                del self.pending_ok[pid]
+
+    async def elect(self):
+        """
+        Ask every higher peer at once. The first OK means someone bigger will take
+        over, so wait for their COORDINATOR (starting over if it never comes); if no
+        one answers in time, I am the bully.
+        """
+        self.set_leader(None)
+        self.victor = asyncio.Event()
+        conversations = [self.spawn(self.ask(pid)) for pid in self.members if pid > self.pid]
+        got_ok = False
+        try:
+            for conversation in asyncio.as_completed(conversations):
+                if await conversation:
+                    got_ok = True
+                    break
+        finally:
+            for conversation in conversations:
+                conversation.cancel()
+
+        if not got_ok:
+            self.declare_victory('no bigger member answered')
+            return
+        try:
+            await asyncio.wait_for(self.victor.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.election = None
+            self.start_election('timed out waiting for coordinator from peers')
+
+    def declare_victory(self, reason):
+        """ Tell every other member I am the bully """
+        log.info('Victory by %s %s', self.pid, reason)
+        self.metrics.incr('elections.won')
+        self.set_leader(self.pid)
+        self.leader_epoch = self.epoch
+        for member in self.members:
+            if member != self.pid:
+                self.spawn(self.send_to(member, 'COORDINATOR'))
+
+
+if __name__ == '__main__':
+    if not 4 <= len(sys.argv) <= 5:
+        print("Usage: python async_bully.py GCDHOST GCDPORT SUID [YYYY-MM-DD]")
+        exit(1)
+
+    now = datetime.now()
+    next_birthday = datetime(2020, 1, 1)
+    if len(sys.argv) == 5:
+        args = sys.argv[4].split('-')
+        next_birthday = datetime(now.year, int(args[1]), int(args[2]))
+        if next_birthday < now:
+            next_birthday = datetime(next_birthday.year + 1, next_birthday.month,
+                                     next_birthday.day)
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    node = AsyncBully(sys.argv[1:3], next_birthday.date().isoformat(), int(sys.argv[3]))
+    node.join_group()
+    asyncio.run(node.serve('at startup'))
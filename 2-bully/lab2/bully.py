@@ -12,20 +12,69 @@ https://docs.python.org/3/library/selectors.html
 https://en.wikipedia.org/wiki/Bully_algorithm
 """
 
+import argparse
+import hashlib
+import logging
 import selectors  # used to wait for I/O readiness notification on multiple file objects
 import socket
 from enum import Enum
 from socket import error as socket_error
-import pickle
 import sys
+import time
 import datetime
 from datetime import datetime
 
+import codec
+import framing
+from channel import Backoff, Peer, PeerChannel
+from heartbeat import Heartbeats, HEARTBEAT_BUDGET, HEARTBEAT_INTERVAL, PHI_THRESHOLD
+from metrics import Metrics
+from timers import Deadlines
+
 BUF_SZ = 1024  # max msg size in bytes
-CHECK_INTERVAL = 1.5  # ms to wait before checking for events in list serv
+CHECK_INTERVAL = 1.5  # longest s to wait in select when no deadline is sooner
 PEER_DIGITS = 10  # used to shorten the port numbers is cpr_sock
 ASSUME_FAILURE_TIMEOUT = 5  # ms to wait before assuming host has failed
 QUEUE_SIZE = 100
+ELECTION_FANOUT = 3  # higher peers asked at a time when coalescing elections
+HEARTBEAT = 'heartbeat'  # deadlines key for the heartbeat send/check tick
+METRICS = 'metrics'  # deadlines key for writing the metrics file
+METRICS_INTERVAL = 1.0  # seconds between metrics file writes
+
+# per-event tracing (select events, state changes, each msg) is logged at DEBUG and
+# only formatted when enabled; elections and leaders at INFO; failures at WARNING
+log = logging.getLogger('bully')
+
+
+def entry_digest(pid, listener):
+    """
+    64-bit hash of one member entry. Membership digests are the XOR of these, so
+    they don't depend on dict order and can be updated one entry at a time. The hash
+    is the same in every process (unlike hash(), which is salted per process).
+    """
+    key = repr((tuple(pid), tuple(listener))).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+def upcoming_birthday(birthday, now=None):
+    """
+    The next birthday after now, whatever year birthday gives (a pid's days to it
+    must not be negative).
+
+    >>> upcoming_birthday('1999-06-28', datetime(2023, 7, 1))
+    '2024-06-28'
+
+    :param birthday: 'YYYY-MM-DD'
+    :param now: datetime to count from (default the current time)
+    :return: the next birthday, 'YYYY-MM-DD'
+    """
+    now = datetime.now() if now is None else now
+    parts = birthday.split('-')
+    next_birthday = datetime(now.year, int(parts[1]), int(parts[2]))
+    if next_birthday < now:
+        next_birthday = datetime(next_birthday.year + 1, next_birthday.month,
+                                 next_birthday.day)
+    return next_birthday.date().isoformat()
 
 
 class State(Enum):
@@ -79,55 +128,189 @@ class Bully(object):
         # unique node process id
         self.pid = (int(days_to_birthday), int(su_id))
 
+        # election group this node belongs to (None when it is the process's only
+        # one; see groups.py for running many over one selector and listener)
+        self.group = None
+
         # dictionary of all members known to this node
-        self.members = {}  # {pid: (host, port), ...}
+        self.members = {}  # {pid: (host, port), ...} (also sets self.digest)
+
+        # membership gossip: msgs carry self.digest instead of self.members, and
+        # tables are only exchanged (MEMBERS msgs) with peers whose digest differs
+        self.gossip = True
+
+        # GCD's membership version token for self.members (None means never joined)
+        self.members_version = None
 
-        # dictionary of the states of all members known to this node
-        self.states = {}  # { socket:pid, ...}
+        # how we marshal outgoing msgs (peers' msgs are decoded in whatever they used)
+        self.codec = codec.STRUCT
+        self.accept_pickle = True  # False refuses pickled msgs from peers
+
+        # conversation records: my own, and one per channel (state lives on them)
+        self.me = Peer(self.pid)
+        self.states = set()  # {Peer, ...} the records not currently QUIESCENT
+        self.deadlines = Deadlines()  # when each waiting state times out
+
+        # persistent connections to peers, reused for every election
+        self.channels = {}  # {pid: PeerChannel, ...} (one per peer we can send to)
+        self.peers = {}  # {file descriptor: PeerChannel, ...} (every open channel)
+        self.backoff = Backoff()  # when we may next try to reconnect to a failed peer
 
         # identity of the current leader
         self.bully = None  # None means election is pending, otherwise pid of bully
 
+        # msgs carry an election epoch so stale ELECTIONs can be ignored; coalescing
+        # also batches OKs (which then go out without a member table) and only asks
+        # the highest ELECTION_FANOUT peers at a time (then the next ones, and so on)
+        self.coalesce = False
+        self.epoch = 0  # highest election epoch seen
+        self.leader_epoch = -1  # epoch of the election that chose self.bully
+        self.candidates = []  # higher peers not asked yet this election, highest last
+        self.ok_batch = {}  # {Peer: None, ...} peers owed an OK (ordered set)
+
+        # leader heartbeats over UDP (None until start_heartbeats is called)
+        self.heartbeats = None
+
+        # source of time for state timestamps and deadlines (a simulation can swap it)
+        self.clock = time.monotonic
+
+        # counters, histograms and gauges (see metrics.py)
+        self.metrics = Metrics()
+        self.metrics_path = None
+        self.metrics_interval = METRICS_INTERVAL
+        self.election_started = None  # clock() when my current election started
+        self.metrics.gauge('states', lambda: len(self.states))
+        self.metrics.gauge('open_sockets', lambda: len(self.peers))
+        self.metrics.gauge('outbox_bytes', lambda: sum(
+            len(channel.outbox) for channel in list(self.peers.values())))
+        self.metrics.gauge('members', lambda: len(self.members))
+        self.metrics.gauge('leader', lambda: self.bully)
+
+        self.open_transport()
+
+    @property
+    def members(self):
+        return self._members
+
+    @members.setter
+    def members(self, members):
+        """ Replace the whole member table and recompute its digest """
+        self._members = members
+        self.digest = 0
+        for pid, listener in members.items():
+            self.digest ^= entry_digest(pid, listener)
+
+    def add_member(self, pid, listener):
+        """
+        Add or update one member, keeping the digest up to date.
+
+        :return: True if the table changed
+        """
+        old = self._members.get(pid)
+        if old == listener:
+            return False
+        if old is not None:
+            self.digest ^= entry_digest(pid, old)
+        self._members[pid] = listener
+        self.digest ^= entry_digest(pid, listener)
+        return True
+
+    def remove_member(self, pid):
+        """ Drop one member, if present, keeping the digest up to date """
+        old = self._members.pop(pid, None)
+        if old is not None:
+            self.digest ^= entry_digest(pid, old)
+
+    def open_transport(self):
+        """
+        Set up the selector and the server side listener socket.
+        """
         # tcp socket selector
         self.selector = selectors.DefaultSelector()
 
         # server side listener socket
         self.listener, self.listener_address = self.start_a_server()
+        self.selector.register(self.listener, selectors.EVENT_READ)
 
-    def run(self):
+    def start_heartbeats(self, interval=HEARTBEAT_INTERVAL, threshold=PHI_THRESHOLD,
+                         budget=HEARTBEAT_BUDGET):
         """
-        Runs event loop and performs action on sockets queued up in selector.
+        Send heartbeats while leader, and watch the leader's heartbeats otherwise,
+        starting an election as soon as the leader looks dead.
+
+        :param interval: seconds between heartbeat ticks
+        :param threshold: phi at which the leader is presumed dead
+        :param budget: most heartbeats sent per tick (see heartbeat.py)
         """
+        self.heartbeats = self.open_heartbeats(interval, threshold, budget)
+        self.deadlines.schedule(HEARTBEAT, 0, self.clock())
 
-        # register MY listening socket
-        self.selector.register(self.listener, selectors.EVENT_READ)
+    def open_heartbeats(self, interval, threshold, budget):
+        """ Heartbeats on a UDP socket of my own, watched by my selector """
+        heartbeats = Heartbeats(self.listener_address, interval, threshold, budget)
+        self.selector.register(heartbeats.sock, selectors.EVENT_READ)
+        return heartbeats
 
-        # selector loop
+    def start_metrics_file(self, path, interval=METRICS_INTERVAL):
+        """
+        Write a metrics snapshot to path every interval seconds.
+
+        :param path: file to (atomically) replace with each snapshot
+        :param interval: seconds between writes
+        """
+        self.metrics_path = path
+        self.metrics_interval = interval
+        self.deadlines.schedule(METRICS, 0, self.clock())
+
+    def run(self):
+        """
+        Runs event loop and performs action on sockets queued up in selector.
+        """
         while True:
-            events = self.selector.select(CHECK_INTERVAL)
+            self.run_once(self.deadlines.timeout(CHECK_INTERVAL, self.clock()))
 
-            print(events)
+    def run_once(self, timeout):
+        """
+        One pass of the event loop: wait up to timeout seconds for socket events,
+        handle them, then check for timeouts.
 
-            for key, mask in events:
-                if key.fileobj == self.listener:  # accept peer
-                    self.accept_peer()
-                elif mask and selectors.EVENT_READ:  # recv msg
-                    self.receive_message(key.fileobj)
-                else:  # mask and selectors.EVENT_WRITE
-                    self.send_message(key.fileobj)  # send msg
-            self.check_timeouts()
+        :param timeout: max seconds to wait in select
+        """
+        events = self.selector.select(timeout)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s', events)
+
+        for key, mask in events:
+            if key.fileobj == self.listener:  # accept peer
+                self.accept_peer()
+                continue
+            if self.heartbeats is not None and key.fileobj == self.heartbeats.sock:
+                self.heartbeats_received()
+                continue
+            channel = self.peers.get(key.fd)
+            if channel is None:
+                continue
+            if mask & selectors.EVENT_WRITE:  # finish connect, send queued msgs
+                self.write_ready(channel)
+            if mask & selectors.EVENT_READ and self.peers.get(key.fd) is channel:
+                self.receive_message(channel)  # recv msg
+        self.flush_oks()
+        self.check_timeouts()
 
     def accept_peer(self):
         """
-        Accept new TCP/IP connections from a peer (TCP handshake)
+        Accept new TCP/IP connections from a peer (TCP handshake). The connection is
+        kept as a channel for as long as the peer keeps it open.
         """
-        print('in accept_peer')
         try:
             peer, _addr = self.listener.accept()
-            print('{}: accepted [{}]'.format(self.pr_sock(peer), self.pr_now()))
-            self.set_state(State.WAITING_FOR_ANY_MESSAGE, peer)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('%s: accepted [%s]', self.pr_sock(peer), self.pr_now())
+            peer.setblocking(False)
+            self.add_channel(PeerChannel(peer))
         except socket_error as serr:
-            print('accept failed {}'.format(serr))
+            log.warning('accept failed %s', serr)
 
     def join_group(self):
         """
@@ -137,35 +320,66 @@ class Bully(object):
 
         # opens connection to gcd, sends JOIN msg, recvs msg, and closes connection
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as gcd:
-            # GCD accepts tuple of pid and listener socket address only
-            data = (self.pid, self.listener_address)
-            print('JOIN {}, {}'.format(self.gcd_address, data))  # log
+            # GCD accepts pid, listener socket address and the last version we saw
+            data = (self.pid, self.listener_address, self.members_version)
+            log.info('JOIN %s, %s', self.gcd_address, data)
 
             # attempt to connect to the gcd
             gcd.connect(self.gcd_address)
 
-            # get members dict by using send method
-            self.members = self.send(gcd, 'JOIN', data, wait_for_reply=True)
+            # get members (or changes to them) by using send method
+            self.apply_membership(self.send(gcd, 'JOIN', data, wait_for_reply=True))
 
-            # expect a dictionary from the GCD, if not raise error
-            if type(self.members) != dict:
-                raise TypeError('wrong data type from GCD: {}'.format(self.members))
+    def apply_membership(self, response):
+        """
+        Bring self.members up to date from the GCD's JOIN response.
+
+        :param response: {pid: listener, ...} from an older GCD, or
+                         ('FULL', version, {pid: listener, ...}) or
+                         ('DELTA', version, {pid: listener, ...}, [removed pid, ...])
+        :raises TypeError: if the GCD sent back something else (e.g. an error string)
+        """
+        if type(response) == dict:
+            self.members = response
+        elif type(response) == tuple and len(response) == 3 and response[0] == 'FULL':
+            _name, self.members_version, members = response
+            self.members = dict(members)
+        elif type(response) == tuple and len(response) == 4 and response[0] == 'DELTA':
+            _name, self.members_version, added, removed = response
+            for pid in removed:
+                self.remove_member(pid)
+            self.update_members(added)
+        else:
+            raise TypeError('wrong data type from GCD: {}'.format(response))
 
-    def start_election(self, reason):
+    def start_election(self, reason, join=False):
         """
         Send ELECTION message to all peers that outrank this node.
 
         :param reason: note for log
+        :param join: True if a peer's ELECTION started it, so it is part of that
+                     election and keeps its epoch rather than starting a new one
         """
-        print('Starting an election {}'.format(reason))
-
-        self.set_state(State.SEND_ELECTION)  # set MY state, election now in progress
+        log.info('Starting an election %s', reason)
+        self.metrics.incr('elections.started')
+        self.election_started = self.clock()
+
+        self.set_leader(None)  # election now in progress
+        self.set_state(State.WAITING_FOR_OK)  # set MY state, wait for OKs
+        if not join:
+            self.epoch += 1
+
+        if self.coalesce:
+            self.candidates = sorted(member for member in self.members
+                                     if member > self.pid and not self.is_suspected(member))
+            self.ask_candidates()
+            return
 
         am_leader = True  # flag for biggest bully not found
 
         # logic to only send election msgs to peers with pids greater than mine
         for member in self.members:
-            if member > self.pid:
+            if member > self.pid and not self.is_suspected(member):
                 peer = self.get_connection(member)
                 if peer is None:
                     continue
@@ -174,37 +388,85 @@ class Bully(object):
         if am_leader:
             self.declare_victory('no other members bigger than me')
 
+    def ask_candidates(self):
+        """
+        Coalescing: send ELECTION to the highest ELECTION_FANOUT candidates not yet
+        asked. If there are none left to ask, I am the bully.
+        """
+        asked = 0
+        while self.candidates and asked < ELECTION_FANOUT:
+            peer = self.get_connection(self.candidates.pop())
+            if peer is None:
+                continue
+            self.set_state(State.SEND_ELECTION, peer)
+            asked += 1
+        if asked == 0:
+            self.declare_victory('no other members bigger than me')
+        else:
+            self.set_state(State.WAITING_FOR_OK)  # restart my deadline
+
+    def outgoing(self, state):
+        """
+        The msg to send for an outgoing state.
+
+        :param state: SEND_ELECTION, SEND_OK or SEND_VICTORY
+        :return: (message_name, members, epoch), or gossiping
+                 (message_name, None, epoch, digest)
+        """
+        if self.gossip:
+            return state.value, None, self.epoch, self.digest
+        if self.coalesce and state == State.SEND_OK:
+            return state.value, None, self.epoch  # the ELECTION had our members
+        return state.value, self.members, self.epoch
+
     def send_message(self, peer):
         """
-        Send the queued msg to the given peer.
-        :param peer: socket connected to the socket selector in run
+        Queue the msg for the given peer's state on its channel. It goes out when the
+        selector reports the channel writable.
+
+        :param peer: socket of the peer's channel
         """
 
         state = self.get_state(peer)
-        print('{}: sending {} [{}]'.format(self.pr_sock(peer), state.value,
-                                           self.pr_now()))
-        try:
-            # should be ready, but may be a failed connect instead
-            self.send(peer, state.value, self.members)
-
-        except ConnectionError as err:  # TODO better exception handling later
-            print('error sending exiting send_msg')
-            pass
-        except Exception as err:
-            print('error sending exiting send_msg')
-            pass
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: sending %s [%s]', self.pr_sock(peer), state.value, self.pr_now())
+        sent = self.transmit(peer, self.outgoing(state))
 
         # check to see if we want to wait for response immediately
-        if state == State.SEND_ELECTION:
-            self.set_state(State.WAITING_FOR_OK, peer, switch_mode=True)
+        if state == State.SEND_ELECTION and sent:
+            self.set_state(State.WAITING_FOR_OK, peer)
         else:
             self.set_quiescent(peer)
 
+    def transmit(self, peer, message):
+        """
+        Queue a msg on the peer's channel and try to send it right away. A congested
+        channel (its outbox over the high-water mark) gets nothing more until it
+        drains, so the msg is dropped and the peer is treated as not answering.
+
+        :param peer: socket (or PeerChannel) of the peer's channel
+        :param message: (message_name, data) to marshal
+        :return: True if the msg was queued and the channel is (still) open
+        """
+        channel = self.record(peer)
+        if channel is None:
+            return False
+        if channel.congested():
+            self.metrics.incr('dropped.congested.' + message[0])
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('%s: congested, dropping %s (%d bytes queued)',
+                          self.pr_sock(channel), message[0], len(channel.outbox))
+            return False
+        self.metrics.incr('sent.' + message[0])
+        channel.queue(codec.encode(message, self.codec))
+        self.write_ready(channel)
+        return self.peers.get(channel.fd) is channel
+
     def send(cls, peer, message_name, message_data=None, wait_for_reply=False,
              buffer_size=BUF_SZ):
         """
-        Marshalls and sends the msg to the given socket and unmarshalls the returned
-        msg.
+        Marshalls and sends the msg to the given blocking socket and unmarshalls the
+        returned msg.
 
         :param peer: socket to send and recv from
         :param message_name: text message name 'OK', 'ELECTION'
@@ -216,114 +478,411 @@ class Bully(object):
 
         # assemble and send msg to peer
         message = message_name if message_data is None else (message_name, message_data)
-        peer.sendall(pickle.dumps(message))
+        framing.send_msg(peer, message, cls.codec)
 
         # if blocking, wait for a reply
         if wait_for_reply:
             return cls.receive(peer, buffer_size)
 
-    def receive_message(self, peer):
+    def write_ready(self, peer):
+        """
+        Channel is writable: finish its connect and send what is queued.
+
+        :param peer: socket (or PeerChannel) of the channel
         """
-        Recv msg from peer and update state based on ELECTION, COORDINATOR, OK.
+        channel = self.record(peer)
+        if channel is None:
+            return
+        try:
+            channel.flush()
+        except socket_error as serr:
+            self.close_channel(channel, 'send failed {}'.format(serr))
+            return
+        self.update_interest(channel)
 
-        :param peer: socket to recv from
+    def receive_message(self, peer, buffer_size=BUF_SZ):
         """
+        Recv available bytes from peer and handle every complete message in them.
 
-        # recv msg from peer, handle connection error and socket errors
+        :param peer: socket (or PeerChannel) to recv from
+        :param buffer_size: max bytes to recv in one call
+        """
+
+        # recv whatever is available, handle connection error and socket errors
+        channel = self.record(peer)
         try:
-            message_name, their_idea = self.receive(peer)
-            print('{}: received {} [{}]'.format(self.pr_sock(peer), message_name, self.pr_now()))
-        except ConnectionError as err:
-            print('closing: {}'.format(err))
-            self.set_quiescent(peer)
+            packets = channel.read(buffer_size)
+        except (BlockingIOError, InterruptedError):
+            return  # spurious wakeup
+        except (socket_error, framing.FramingError) as err:
+            self.close_channel(channel, err)
             return
-        except socket_error as serr:
-            print('failed {}'.format(serr))
-            if self.is_expired(peer):
-                print('peer timed out')
-                self.set_quiescent(peer)
+        self.handle_packets(channel, packets)
+
+    def handle_packets(self, channel, packets):
+        """
+        Unmarshal and handle the frames read from a channel, in order.
+
+        :param channel: PeerChannel they came in on
+        :param packets: list of frame payloads
+        """
+        # a read may hold a partial frame (wait for more) or several frames
+        for packet in packets:
+            try:
+                message = self.unmarshal(packet)
+            except codec.CodecError as err:
+                self.close_channel(channel, err)
+                return
+            self.handle_message(channel, message)
+            if self.peers.get(channel.fd) is not channel:
+                break  # channel was closed while handling the message
+
+    def handle_message(self, peer, message):
+        """
+        Update state based on a received HELLO, ELECTION, COORDINATOR or OK message.
+
+        :param peer: socket the message came in on
+        :param message: unmarshalled (message_name, their_idea) tuple
+        """
+        message_name, their_idea = message[:2]
+        epoch = message[2] if len(message) > 2 else None
+        digest = message[3] if len(message) > 3 else None
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: received %s [%s]', self.pr_sock(peer), message_name, self.pr_now())
+        self.metrics.incr('received.' + message_name)
+
+        # first msg on a channel says who is on the other end
+        if message_name == 'HELLO':
+            self.identify(peer, their_idea)
             return
+        pid = self.peer_pid(peer)
+        if pid is not None:
+            self.backoff.succeeded(pid)
 
         # update members with their idea of state
         self.update_members(their_idea)
+        if message_name == 'MEMBERS':
+            self.exchange_members(peer, their_idea, digest)
+            return
+        if digest is not None and digest != self.digest:
+            self.offer_members(peer, digest)
+
+        # a stale ELECTION was started before the leader we know about won
+        stale = epoch is not None and epoch <= self.leader_epoch and self.bully is not None
+        if epoch is not None:
+            self.epoch = max(self.epoch, epoch)
 
         # make state transition based on rec'd msg
         if message_name == 'ELECTION':
-            self.set_state(State.SEND_OK, peer)
-            if not self.is_election_in_progress():
-                self.start_election('Got a VOTE card')
+            if self.coalesce:
+                self.ok_batch[self.record(peer)] = None  # answered by flush_oks
+            else:
+                self.set_state(State.SEND_OK, peer)
+            if self.bully == self.pid and not self.is_election_in_progress():
+                self.announce(peer)  # anyone above me got this ELECTION too
+            elif not self.is_election_in_progress() and not stale:
+                self.start_election('Got a VOTE card', join=True)
         elif message_name == 'COORDINATOR':
-            self.set_leader('someone else is the leader')
+            if epoch is not None and epoch < self.leader_epoch:
+                self.set_quiescent(peer)  # announcement of an older election
+                return
+            if pid is not None and pid < self.pid:
+                # it won because it never heard from me (my OK may have been lost)
+                self.set_quiescent(peer)
+                if not self.is_election_in_progress():
+                    self.start_election('COORDINATOR from lower {}'.format(pid))
+                return
+            self.set_leader(pid)
+            if epoch is not None:
+                self.leader_epoch = epoch
+            self.candidates = []
             self.set_quiescent(peer)
             self.set_quiescent()
         elif message_name == 'OK':
+            state, when = self.get_state(peer, detail=True)
+            if state == State.WAITING_FOR_OK:
+                self.metrics.observe('peer_rtt_seconds', self.clock() - when)
             if self.get_state() == State.WAITING_FOR_OK:
                 self.set_state(State.WAITING_FOR_VICTOR)  #recd an OK ignore others
             self.set_quiescent(peer)
 
-    @staticmethod
-    def receive(peer, buffer_size=BUF_SZ):
+    def offer_members(self, peer, their_digest):
         """
-        Recvs and unmarshalls incoming msg from the peer.
+        Gossip: send our table to a peer whose digest differs, unless we already did
+        for this pair of digests recently (its reply may still be on the way).
 
-        :param peer: socket to recv msg from
-        :param buffer_size: buffer size of the listening socket
-        :return: unmarshalled msg
+        :param peer: socket of the peer's channel
+        :param their_digest: digest the peer sent
         """
+        record = self.record(peer)
+        if record is None:
+            return
+        now = self.clock()
+        last = record.gossiped
+        if last is not None and last[:2] == (self.digest, their_digest) and \
+                now - last[2] < ASSUME_FAILURE_TIMEOUT:
+            return
+        record.gossiped = (self.digest, their_digest, now)
+        self.transmit(peer, ('MEMBERS', self.members, None, self.digest))
 
-        # store buffer
-        packet = peer.recv(buffer_size)
+    def exchange_members(self, peer, their_idea, their_digest):
+        """
+        Gossip: a peer whose digest differed from ours sent its table (already merged
+        into ours). If we still differ, send back just the entries it lacks.
 
-        # handle None response when socket is closed
-        if not packet:
-            raise ValueError('socket closed')
+        :param peer: socket of the peer's channel
+        :param their_idea: the table they sent
+        :param their_digest: digest of their whole table
+        """
+        if their_digest == self.digest:
+            return
+        lacking = {pid: listener for pid, listener in self.members.items()
+                   if their_idea.get(pid) != listener}
+        if lacking:
+            self.transmit(peer, ('MEMBERS', lacking, None, self.digest))
 
-        # unmarshall data and return
-        data = pickle.loads(packet)
+    def flush_oks(self):
+        """
+        Send the OKs owed for the ELECTIONs handled since the last flush, one per
+        peer however many ELECTIONs it sent.
+        """
+        batch, self.ok_batch = self.ok_batch, {}
+        for peer in batch:
+            self.set_state(State.SEND_OK, peer)
+
+    def identify(self, peer, their_idea):
+        """
+        Record who is on the other end of a channel from their HELLO, so we can reuse
+        the channel when we have something to send them.
+
+        :param peer: socket of the channel the HELLO came in on
+        :param their_idea: {their pid: their listener address}
+        """
+        if not their_idea:
+            return
+        channel = self.record(peer)
+        for pid, listener in their_idea.items():
+            channel.pid = pid
+            self.add_member(pid, listener)
+            self.channels.setdefault(pid, channel)
+            self.backoff.succeeded(pid)
+
+    def hello(self):
+        """ First msg on a channel I open: who I am (and which group it is for) """
+        if self.group is None:
+            return 'HELLO', {self.pid: self.listener_address}
+        return 'HELLO', {self.pid: self.listener_address}, self.group
+
+    def peer_pid(self, peer):
+        """ pid of the peer on the other end of a channel (None until its HELLO) """
+        record = self.record(peer)
+        return None if record is None else record.pid
+
+    def record(self, peer):
+        """
+        The conversation record for a peer.
+
+        :param peer: socket of a channel, a Peer record, or None (or self) for me
+        :return: Peer (a PeerChannel for peers), or None if the channel is gone
+        """
+        if peer is None or peer is self:
+            return self.me
+        if isinstance(peer, Peer):
+            return peer
+        return self.peers.get(peer.fileno())
+
+    def receive(self, peer, buffer_size=BUF_SZ):
+        """
+        Blocks for one whole framed msg from the peer and unmarshalls it.
+
+        :param peer: blocking socket to recv msg from
+        :param buffer_size: unused, frames are read to their full length
+        :return: unmarshalled msg
+        """
+        return self.unmarshal(framing.recv_frame(peer))
+
+    def unmarshal(self, packet):
+        """
+        Unmarshalls one frame's payload into a (message_name, data) tuple.
+
+        :param packet: payload of a single frame
+        :return: unmarshalled msg
+        :raises codec.CodecError: if the payload can't be decoded
+        """
+        data, _codec_name = codec.decode(packet, self.accept_pickle)
         if type(data) == str:
             data = (data, None)  # format msg into tuple
         return data
 
     def check_timeouts(self):
         """
-        Check if peers (including me) have timed out.
+        Act on the peers (including me) whose deadlines have passed. Only the
+        expired ones are looked at.
         """
 
-        if self.is_expired():
-            if self.get_state() == State.WAITING_FOR_OK:
+        for peer in self.deadlines.expired(self.clock()):
+            if peer == HEARTBEAT:
+                self.heartbeat_tick()
+            elif peer == METRICS:
+                self.metrics.write(self.metrics_path)
+                self.deadlines.schedule(METRICS, self.metrics_interval)
+            elif peer is not self.me:
+                self.set_quiescent(peer)  # they never answered, forget them
+            elif self.get_state() == State.WAITING_FOR_OK and self.candidates:
+                self.ask_candidates()  # nobody that high answered, try the next ones
+            elif self.get_state() == State.WAITING_FOR_OK:
                 self.declare_victory('timed out from waiting from ok from peers')
             else:
+                if self.heartbeats is not None:
+                    # nobody won, maybe because I wrongly left out a leader I suspected
+                    self.heartbeats.detectors.clear()
                 self.start_election('timed out waiting for coordinate from peers')
 
+    def heartbeat_tick(self):
+        """
+        Every heartbeat interval: if I lead, send this tick's batch of followers a
+        heartbeat; otherwise check that the leader's heartbeats are still coming.
+        """
+        now = self.clock()
+        if self.bully == self.pid:
+            followers = [(member, address) for member, address in self.members.items()
+                         if member != self.pid]
+            batch = self.heartbeats.batch(followers)
+            for _member, address in batch:
+                self.heartbeats.send(self.pid, max(0, self.leader_epoch), address)
+            self.metrics.incr('heartbeats.sent', len(batch))
+        elif (self.bully is not None and not self.is_election_in_progress() and
+              self.heartbeats.suspect(self.bully, now)):
+            self.metrics.incr('leader_suspected')
+            self.start_election('leader {} stopped sending heartbeats'.format(self.bully))
+        self.deadlines.schedule(HEARTBEAT, self.heartbeats.interval, now)
+
+    def heartbeats_received(self, beats=None):
+        """
+        Heartbeats arrived. Ones from my leader renew its lease. One from a higher
+        leader I never heard a COORDINATOR from makes it my leader; one from a lower
+        leader means it doesn't know about me yet, so I bully it. Heartbeats from an
+        epoch older than my leader's (sent before it won, or delayed on the way) say
+        nothing about who leads now and are ignored.
+
+        :param beats: [(leader pid, epoch), ...] already read for me (by a GroupHost),
+                      or None to read them from my heartbeat socket
+        """
+        now = self.clock()
+        if beats is None:
+            beats = self.heartbeats.receive()
+        for pid, epoch in beats:
+            self.heartbeats.received += 1
+            self.metrics.incr('heartbeats.received')
+            if pid == self.bully:
+                self.heartbeats.beat(pid, now)
+            elif self.is_election_in_progress() or pid == self.pid:
+                continue
+            elif epoch < self.leader_epoch:
+                continue
+            elif pid > self.pid and (self.bully is None or pid > self.bully):
+                self.set_leader(pid)
+                self.leader_epoch = epoch
+            elif pid < self.pid:
+                self.start_election('heard heartbeats from lower leader {}'.format(pid))
+
+    def is_suspected(self, member):
+        """ True if heartbeats say member is dead (so don't wait on it in an election) """
+        return self.heartbeats is not None and self.heartbeats.suspect(member, self.clock())
+
     def get_connection(self, member):
         """
-        Get a socket for a member. Connection will be non-blocking,
-        must use selector to pick it up when its writable.
+        Get the socket of the channel to a member, connecting one if there isn't
+        one yet. A new connection is non-blocking; the selector picks it up when it
+        is writable. Members that recently failed are skipped until their reconnect
+        backoff runs out.
 
-        :param member_pid: process id of peer
-        :return: socket
+        :param member: process id of peer
+        :return: socket, or None if the member can't be reached right now
         """
 
-        # look up member's address
-        listener = self.members[member]
-        peer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        peer.setblocking(False)
+        channel = self.channels.get(member)
+        if channel is not None:
+            return channel.sock
+        if not self.backoff.ready(member):
+            return None
 
+        # look up member's address and start connecting
         try:
-            peer.connect(listener)
-        except BlockingIOError:  # handle connection still in progress
-            pass
+            channel = self.open_channel(member)
         except socket_error as serr:
-            print('FAILURE: couldnt connect to member {}'.format(serr))
+            log.warning('FAILURE: couldnt connect to member %s', serr)
+            self.backoff.failed(member)
             return None
+        channel.queue(codec.encode(self.hello(), self.codec))
+        self.add_channel(channel)
+        self.metrics.incr('channels.connected')
+        return channel.sock
+
+    def open_channel(self, member):
+        """
+        Start connecting a new channel to a member.
+
+        :param member: process id of peer
+        :return: PeerChannel, still connecting
+        :raises OSError: if the connect fails straight away
+        """
+        return PeerChannel.connect(member, self.members[member])
+
+    def add_channel(self, channel):
+        """ Start tracking a channel and watching it in the selector """
+        self.peers[channel.fd] = channel
+        if channel.pid is not None:
+            self.channels[channel.pid] = channel
+        self.selector.register(channel.sock, self.interest(channel))
+
+    def close_channel(self, channel, reason):
+        """
+        Drop a broken or closed channel. Any conversation on it ends, and if we were
+        the ones connecting, the peer goes into reconnect backoff.
+
+        :param channel: PeerChannel to close
+        :param reason: note for log
+        """
+        self.forget_channel(channel, reason)
+        self.selector.unregister(channel.sock)
+        channel.close()
 
-        return peer
+    def forget_channel(self, channel, reason):
+        """
+        Everything close_channel does except the socket itself: end the conversation
+        on the channel and stop tracking it.
+
+        :param channel: PeerChannel being closed
+        :param reason: note for log
+        """
+        log.warning('%s: closing: %s', self.pr_sock(channel), reason)
+        self.metrics.incr('channels.closed')
+        self.set_quiescent(channel)
+        self.ok_batch.pop(channel, None)
+        del self.peers[channel.fd]
+        if channel.pid is not None and self.channels.get(channel.pid) is channel:
+            del self.channels[channel.pid]
+            self.backoff.failed(channel.pid)
+
+    @staticmethod
+    def interest(channel):
+        """ Selector events to watch for on a channel """
+        if channel.wants_write():
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def update_interest(self, channel):
+        """ Watch for writability only while there is something queued """
+        events = self.interest(channel)
+        if self.selector.get_key(channel.sock).events != events:
+            self.selector.modify(channel.sock, events)
 
     def is_election_in_progress(self):
         """
         Checks my state to see if we are awaiting a victor.
         """
-        return self.bully is None
+        return self.get_state() in (State.WAITING_FOR_OK, State.WAITING_FOR_VICTOR)
 
     def is_expired(self, peer=None, threshold=ASSUME_FAILURE_TIMEOUT):
         """
@@ -337,71 +896,73 @@ class Bully(object):
         my_state, when = self.get_state(peer, detail=True)
         if my_state == State.QUIESCENT:
             return False
-        time_since = (datetime.now() - when).total_seconds()
-        return time_since > threshold
+        return self.clock() - when > threshold
 
     def set_leader(self, new_leader):
         """
         Set the current leader. Sets self.bully to that leader.
         """
         self.bully = new_leader
-        print('Leader is {}'.format(self.pr_leader()))
-
-    def get_state(self, peer=None, switch_mode=False):
+        log.info('Leader is %s', self.pr_leader())
+        if new_leader is not None and self.election_started is not None:
+            self.metrics.observe('election_seconds', self.clock() - self.election_started)
+            self.election_started = None
+        if self.heartbeats is not None and new_leader is not None:
+            self.heartbeats.detectors.clear()  # old suspicions only matter mid-election
+            if new_leader != self.pid:
+                self.heartbeats.watch(new_leader, self.clock(), len(self.members) - 1)
+
+    def get_state(self, peer=None, detail=False):
         """
         Look up member's current state in state table.
 
-        :param peer: socket connected to peer process (None means self)
-        :param switch_mode: if True, then state and timestamp are both returned
+        :param peer: socket connected to peer process or its Peer (None means self)
+        :param detail: if True, then state and timestamp are both returned
         :return: either the state or (state, timestamp) depending on the detail (not
         found gives(QUIESCENT, None))
         """
 
-        if not switch_mode:
-            peer = self
-        status = self.states[peer] if peer in self.states else (State.QUIESCENT, None)
-        return status if switch_mode else status[0]
+        record = self.record(peer)
+        if record is None or record.state is None:
+            return (State.QUIESCENT, None) if detail else State.QUIESCENT
+        return (record.state, record.since) if detail else record.state
 
-    def set_state(self, state, peer=None, switch_mode=False):
+    def set_state(self, state, peer=None):
         """
-        Set a member's state in the state table.
+        Set a member's state in the state table. Outgoing states queue their msg on
+        the peer's channel straight away.
 
-        :param peer: socket connected to peer process (None means self)
-        :param switch_mode: if True, then state and timestamp are both returned
+        :param state: new State
+        :param peer: socket connected to peer process or its Peer (None means self)
         """
 
-        print('{}: {}'.format(self.pr_sock(peer), state.name))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s: %s', self.pr_sock(peer), state.name)
 
-        if peer is None:
-            peer = self
+        record = self.record(peer)
+        if record is None:
+            return  # channel already closed
 
-        # who to register as event.write or event.read in the selector
-        if state.is_incoming():
-            mask = selectors.EVENT_READ
-        else:
-            mask = selectors.EVENT_WRITE
-
-        # if QUIESCENT lets remove it from the members list
+        # if QUIESCENT the conversation is over (the channel itself stays open)
         if state == State.QUIESCENT:
-            if peer in self.states:
-                if peer != self:
-                    self.selector.unregister(peer)
-                del self.states[peer]
-            if len(self.states) == 0:
-                print('{} (leader: {})\n'.format(self.pr_now(), self.pr_leader()))
+            self.deadlines.cancel(record)
+            record.state = None
+            self.states.discard(record)
+            if len(self.states) == 0 and log.isEnabledFor(logging.DEBUG):
+                log.debug('%s (leader: %s)\n', self.pr_now(), self.pr_leader())
             return
 
-        # handle new state and adjust selector
-        if peer != self and peer not in self.states:
-            peer.setblocking(False)
-            self.selector.register(peer, mask)
-        elif switch_mode:
-            self.selector.modify(peer, mask)
-        self.states[peer] = (state, datetime.now())
+        now = self.clock()
+        record.state, record.since = state, now
+        self.states.add(record)
 
-        # send msg write away if writeable
-        if mask == selectors.EVENT_WRITE:
-            self.send_message(peer)
+        # send msg right away if outgoing, otherwise wait no longer than the timeout
+        if not state.is_incoming():
+            self.deadlines.cancel(record)
+            if record is not self.me:
+                self.send_message(record)
+        else:
+            self.deadlines.schedule(record, ASSUME_FAILURE_TIMEOUT, now)
 
     def set_quiescent(self, peer=None):
         """ call when you've sent an election out and didn't hear back in time from
@@ -411,12 +972,13 @@ class Bully(object):
     def declare_victory(self, reason):
         """ Send COORDINATOR message to all peers stating I am the bully"""
 
-        print('Victory by {} {}'.format(self.pid, reason))
+        log.info('Victory by %s %s', self.pid, reason)
+        self.metrics.incr('elections.won')
 
         # call set_leader
         self.set_leader(self.pid)
-        # update my state
-        self.set_state(State.SEND_VICTORY)
+        self.leader_epoch = self.epoch
+        self.candidates = []
         # send message to everyone else
         for member in self.members:
             if member != self.pid:  # skip myself
@@ -426,6 +988,19 @@ class Bully(object):
                 self.set_state(State.SEND_VICTORY, peer)
         self.set_quiescent()
 
+    def announce(self, peer):
+        """
+        I lead and a lower node started an election, so it hasn't heard (or doubts)
+        my COORDINATOR. Tell just that node again instead of running a whole new
+        election: any node above me was sent the ELECTION as well and will bully me
+        if it is there. The announcement takes the newest epoch seen, so the ELECTIONs
+        still on their way from it are stale once they arrive.
+
+        :param peer: socket of the channel the ELECTION came in on
+        """
+        self.leader_epoch = self.epoch
+        self.set_state(State.SEND_VICTORY, peer)
+
     def update_members(self, their_idea_of_membership):
         """
         Add members from the peer's memberlist that we didn't already know to our
@@ -436,7 +1011,7 @@ class Bully(object):
 
         if their_idea_of_membership is not None:
             for member in their_idea_of_membership:
-                self.members[member] = their_idea_of_membership[member]
+                self.add_member(member, their_idea_of_membership[member])
 
     @staticmethod
     def start_a_server():
@@ -458,9 +1033,11 @@ class Bully(object):
         return datetime.now().strftime('%H:%M:%S.%f')
 
     def pr_sock(self, sock):
-        """ Printing helper for given socket """
-        if sock is None or sock == self or sock == self.listener:
+        """ Printing helper for given socket (or Peer record) """
+        if sock is None or sock is self or sock is self.me or sock is self.listener:
             return 'self'
+        if isinstance(sock, Peer):
+            sock = sock.sock  # a channel
         return self.cpr_sock(sock)
 
     @staticmethod
@@ -482,23 +1059,35 @@ class Bully(object):
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    print('Bully')
-    # handle invalid command line args count
-    if not 4 <= len(sys.argv) <= 5:
-        print("Usage: python bully.py (IP, port) 'YYYY-MM-DD' suid")
-        exit(1)
+    parser = argparse.ArgumentParser(description='Bully')
+    parser.add_argument('host', help='GCD host')
+    parser.add_argument('port', help='GCD port')
+    parser.add_argument('suid', type=int, help='six digit seattle u id')
+    parser.add_argument('birthday', nargs='?', help='YYYY-MM-DD')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='DEBUG traces every event and state change')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics as JSON on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-file', help='write metrics as JSON to this file')
+    parser.add_argument('--heartbeats', action='store_true',
+                        help='detect leader failure with UDP heartbeats')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s', stream=sys.stdout)
 
     # start program
-    if len(sys.argv) == 5:
-        args = sys.argv[4].split('-')
-        now = datetime.now()
-        next_birthday = datetime(now.year, int(args[1], int(args[2]),))
-        if next_birthday < now:
-            next_birthday = datetime(next_birthday.year + 1, next_birthday.month,
-                                     next_birthday.day)
-        else:
-            next_birthday = datetime(2020, 1, 1)
-    print('Next Birthday:', next_birthday)
-    suid = int(sys.argv[3])
-    print('Student ID:', suid)
-    bully = Bully(sys.argv[1:3], next_birthday, suid)
\ No newline at end of file
+    next_birthday = '2020-01-01'
+    if args.birthday:
+        next_birthday = upcoming_birthday(args.birthday)
+    log.info('Next Birthday: %s', next_birthday)
+    log.info('Student ID: %s', args.suid)
+    bully = Bully((args.host, args.port), next_birthday, args.suid)
+    if args.metrics_port is not None:
+        log.info('Metrics on http://%s:%s/metrics', *bully.metrics.serve(args.metrics_port))
+    if args.metrics_file:
+        bully.start_metrics_file(args.metrics_file)
+    if args.heartbeats:
+        bully.start_heartbeats()
+    bully.join_group()
+    bully.start_election('at startup')
+    bully.run()
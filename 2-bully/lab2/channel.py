@@ -0,0 +1,174 @@
+"""
+Persistent Peer Channels
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: A PeerChannel is one long-lived non-blocking TCP connection to another Bully
+node. It stays registered in the node's selector and carries every ELECTION, OK and
+COORDINATOR exchanged with that peer, in both directions, so an election costs one
+framed message per peer instead of one TCP handshake per peer. Outgoing frames are
+queued and written when the selector says the socket is writable, as much as the
+kernel will take each time, so a slow peer never blocks the event loop. Once a peer
+has OUTBOX_HIGH_WATER bytes queued it is congested and the node stops queueing for
+it (it is treated like a peer that did not answer) until it catches up.
+
+Each channel is also the node's record of its conversation with that peer (a Peer),
+so the per-peer state table is just these objects, keyed by file descriptor. They use
+__slots__, so a record is a few pointers rather than a dict, and changing a peer's
+state assigns attributes instead of allocating a new (state, time) tuple.
+
+References
+https://docs.python.org/3/library/selectors.html
+https://docs.python.org/3/library/socket.html#socket.socket.connect_ex
+"""
+
+import errno
+import socket
+import time
+
+import framing
+
+RECONNECT_BASE = 0.1  # seconds to wait before the first reconnect attempt
+RECONNECT_MAX = 5.0  # cap on the reconnect wait
+OUTBOX_HIGH_WATER = 64 * 1024  # queued bytes at which a peer counts as congested
+
+
+class Peer(object):
+    """
+    Election state of one conversation (with a peer, or with myself).
+    """
+    __slots__ = ('pid', 'state', 'since', 'gossiped')
+
+    def __init__(self, pid=None):
+        """
+        :param pid: peer's process id, if known
+        """
+        self.pid = pid
+        self.state = None  # a bully.State, None when quiescent
+        self.since = 0.0  # clock() when state was set
+        self.gossiped = None  # (my digest, their digest, when) of the last table sent
+
+
+class PeerChannel(Peer):
+    """
+    One connection to a peer. pid is None for an accepted connection until the peer
+    introduces itself.
+    """
+    __slots__ = ('sock', 'fd', 'connecting', 'reader', 'outbox')
+
+    def __init__(self, sock, pid=None, connecting=False):
+        """
+        :param sock: connected (or connecting) non-blocking socket
+        :param pid: peer's process id, if known
+        :param connecting: True while a non-blocking connect is in progress
+        """
+        super().__init__(pid)
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.connecting = connecting
+        self.reader = framing.FrameReader()
+        self.outbox = bytearray()  # framed bytes not yet accepted by the kernel
+
+    @classmethod
+    def connect(cls, pid, address):
+        """
+        Start a non-blocking connect to the peer's listener.
+
+        :param pid: peer's process id
+        :param address: peer's listener (host, port)
+        :return: new PeerChannel, still connecting
+        :raises OSError: if the connect fails straight away
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise ConnectionRefusedError(err, 'connect to {} failed'.format(address))
+        return cls(sock, pid, connecting=True)
+
+    def queue(self, payload):
+        """
+        Queue one message payload to be framed and sent.
+
+        :param payload: marshalled message
+        """
+        self.outbox += framing.frame(payload)
+
+    def wants_write(self):
+        """ True if the selector should report this socket writable """
+        return self.connecting or bool(self.outbox)
+
+    def congested(self, high_water=OUTBOX_HIGH_WATER):
+        """ True if so much is queued that nothing more should be added for now """
+        return len(self.outbox) >= high_water
+
+    def flush(self):
+        """
+        Finish connecting if need be, then write as much of the outbox as the kernel
+        will take without blocking.
+
+        :return: True if the outbox is now empty
+        :raises OSError: if the connect failed or the connection broke
+        """
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise ConnectionRefusedError(err, 'connect failed')
+            self.connecting = False
+        while self.outbox:
+            try:
+                sent = self.sock.send(self.outbox)
+            except (BlockingIOError, InterruptedError):
+                return False
+            del self.outbox[:sent]
+        return True
+
+    def read(self, buffer_size=framing.BUF_SZ):
+        """
+        One recv's worth of complete frames.
+
+        :return: list of payloads (possibly empty)
+        :raises ConnectionError: if the peer closed the connection
+        :raises BlockingIOError: if there was nothing to read after all
+        """
+        return self.reader.read_from(self.sock, buffer_size)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class Backoff(object):
+    """
+    Exponential reconnect backoff per peer: after each failure the next connect
+    attempt is put off twice as long, up to RECONNECT_MAX.
+    """
+
+    def __init__(self, base=RECONNECT_BASE, cap=RECONNECT_MAX):
+        self.base, self.cap = base, cap
+        self.failures = {}  # {pid: (consecutive failures, time.monotonic() of next try)}
+
+    def ready(self, pid, now=None):
+        """ True if we may try connecting to pid now """
+        if pid not in self.failures:
+            return True
+        now = time.monotonic() if now is None else now
+        return now >= self.failures[pid][1]
+
+    def failed(self, pid, now=None):
+        """
+        Record a failure to reach pid.
+
+        :return: seconds until the next attempt is allowed
+        """
+        now = time.monotonic() if now is None else now
+        count = self.failures.get(pid, (0, 0.0))[0] + 1
+        delay = min(self.cap, self.base * 2 ** (count - 1))
+        self.failures[pid] = (count, now + delay)
+        return delay
+
+    def succeeded(self, pid):
+        """ Forget past failures once pid has been heard from """
+        self.failures.pop(pid, None)
@@ -0,0 +1,68 @@
+"""
+Codec Micro-Benchmark
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Compares the pickle and struct codecs in codec.py on the messages this lab
+actually sends, reporting encode and decode ns/op and bytes per message.
+
+Usage:
+    python codec_bench.py [GROUP_SIZE ...]
+
+References
+https://docs.python.org/3/library/timeit.html
+"""
+
+import sys
+import timeit
+
+import codec
+
+DEFAULT_GROUP_SIZES = (5, 100, 1000)
+
+
+def members(n):
+    """ A group of n members all listening on localhost """
+    return {(i % 365 + 1, 1_000_000 + i): ('127.0.0.1', 10_000 + i) for i in range(n)}
+
+
+def sample_messages(group_sizes):
+    """
+    :return: list of (label, message) covering every shape the struct codec handles
+    """
+    samples = [
+        ('OK', ('OK', None)),
+        ('HELLO', 'HELLO'),
+        ('JOIN', ('JOIN', ((100, 1_234_567), ('127.0.0.1', 40_000)))),
+        ('JOIN since', ('JOIN', ((100, 1_234_567), ('127.0.0.1', 40_000), ('0a1b2c3d', 42)))),
+        ('DELTA 1+1', ('DELTA', ('0a1b2c3d', 43), members(1), [(1, 1_000_001)])),
+    ]
+    for n in group_sizes:
+        samples.append(('ELECTION {}'.format(n), ('ELECTION', members(n))))
+        samples.append(('FULL {}'.format(n), ('FULL', ('0a1b2c3d', 42), members(n))))
+    return samples
+
+
+def ns_per_op(func, min_time=0.2):
+    """ Mean ns per call of func, timing enough calls to take about min_time """
+    timer = timeit.Timer(func)
+    number, _elapsed = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e9
+
+
+def main(group_sizes):
+    print('{:<14} {:>7} {:>11} {:>11} {:>7} {:>11} {:>11}'.format(
+        'message', 'pickle', 'enc ns', 'dec ns', 'struct', 'enc ns', 'dec ns'))
+    for label, message in sample_messages(group_sizes):
+        row = [label]
+        for name in (codec.PICKLE, codec.STRUCT):
+            c = codec.CODECS[name]
+            payload = c.encode(message)
+            assert c.decode(payload) == message, label
+            row += [len(payload), ns_per_op(lambda: c.encode(message)),
+                    ns_per_op(lambda: c.decode(payload))]
+        print('{:<14} {:>6}B {:>11,.0f} {:>11,.0f} {:>6}B {:>11,.0f} {:>11,.0f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_GROUP_SIZES)
@@ -0,0 +1,445 @@
+"""
+Bully Election Simulator
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Runs many Bully state machines in one process over a virtual network, with
+no GCD, sockets or real time. Messages are delivered on a virtual clock with
+configurable latency and loss. Links between nodes keep their messages in order the
+way a TCP connection does. Nodes can be crashed, recovered and partitioned. Every
+run with the same seed makes the same choices, so a regression in election cost
+shows up as a changed number rather than noise.
+
+The nodes are the real bully.Bully class. Only its transport (get_connection,
+transmit, peer_pid) and its clock are swapped for the simulated ones, so the
+simulator measures the election logic that ships.
+
+Nodes can also run the leader heartbeats of heartbeat.py, sent as virtual datagrams
+(lost like any other msg, but not kept in order). They are what puts a group back
+together after a lost COORDINATOR: a node that missed it picks up the leader from its
+heartbeats, and one left following a dead leader suspects it and starts an election.
+Heartbeats never stop (and with loss, now and then one node wrongly suspects its
+leader and starts another election), so a run with them ends as soon as no election
+msg is in flight, nobody is waiting on anything and every node follows the leader it
+should. They are counted apart from the election msgs.
+
+Usage:
+    python election_sim.py [--nodes N ...] [--latency MIN MAX] [--loss FRACTION]
+                           [--starter lowest|random] [--crash-leader] [--seed N]
+                           [--coalesce] [--no-heartbeats]
+
+References
+https://en.wikipedia.org/wiki/Discrete-event_simulation
+https://en.wikipedia.org/wiki/Bully_algorithm
+"""
+
+import argparse
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import codec
+from bully import Bully, HEARTBEAT, log
+from channel import Peer
+from heartbeat import HEARTBEAT_INTERVAL, Heartbeats
+from timers import Deadlines
+
+SIM_BIRTHDAY = '2020-01-01'  # any date will do, pids are assigned by the network
+DEFAULT_SIZES = (5, 10, 30, 100, 300, 1000)
+RUN_LIMIT = 600.0  # virtual seconds an election may take before we call it stuck
+
+ElectionResult = collections.namedtuple('ElectionResult', [
+    'nodes', 'messages', 'by_kind', 'bytes', 'dropped', 'time_to_leader',
+    'converged', 'leaders', 'heartbeats', 'wall_seconds'])
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Turn the nodes' logging down to warnings while simulating """
+    level = log.level
+    log.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        log.setLevel(level)
+
+
+class SimLink(Peer):
+    """ One node's end of its virtual connection to a peer; stands in for the channel """
+    __slots__ = ()
+
+
+class SimHeartbeats(Heartbeats):
+    """ A node's heartbeats, sent over the simulated Network instead of a UDP socket """
+
+    def __init__(self, network, interval, threshold, budget):
+        super().__init__(None, interval, threshold, budget, sock=network)
+        self.network = network
+
+    def send(self, pid, epoch, address):
+        self.network.beat(pid, epoch, address)
+        self.sent += 1
+
+
+class SimBully(Bully):
+    """ A Bully node whose sockets and clock belong to a simulated Network """
+
+    def __init__(self, network, pid, address):
+        """
+        :param network: Network the node lives on
+        :param pid: (days_to_bd, su_id) to use as the node's identity
+        :param address: fake listener (host, port) to advertise
+        """
+        self.network = network
+        self.sim_address = address
+        super().__init__(('127.0.0.1', 0), SIM_BIRTHDAY, pid[1])
+        self.pid = pid
+        self.clock = network.now
+        self.links = {}  # {pid: SimLink, ...}
+        self.leader_time = None  # virtual time self.bully last changed
+
+    def open_transport(self):
+        """ No selector or listener; the network delivers messages directly """
+        self.selector = None
+        self.listener, self.listener_address = None, self.sim_address
+
+    def open_heartbeats(self, interval, threshold, budget):
+        """ The network delivers heartbeats straight to heartbeats_received too """
+        return SimHeartbeats(self.network, interval, threshold, budget)
+
+    def link(self, pid):
+        """ The SimLink to the given peer, which holds our conversation state with it """
+        link = self.links.get(pid)
+        if link is None:
+            link = self.links[pid] = SimLink(pid)
+        return link
+
+    def get_connection(self, member):
+        """ Connecting to a crashed node is refused straight away, like real TCP """
+        if not self.network.can_connect(member):
+            return None
+        return self.link(member)
+
+    def transmit(self, peer, message):
+        self.network.send(self.pid, peer.pid, message)
+        return True
+
+    def peer_pid(self, peer):
+        return peer.pid
+
+    def set_leader(self, new_leader):
+        if new_leader != self.bully:
+            self.leader_time = self.clock()
+        super().set_leader(new_leader)
+
+    def pr_sock(self, sock):
+        if sock is None or sock is self or sock is self.me:
+            return 'self'
+        return str(sock.pid)
+
+    def restart(self):
+        """ Forget everything a crashed process would have lost (but not members) """
+        for record in self.states:
+            record.state = None
+        self.states.clear()
+        self.ok_batch.clear()
+        self.deadlines = Deadlines()
+        self.bully = None
+        self.leader_time = self.clock()
+        if self.heartbeats is not None:
+            self.heartbeats.detectors.clear()
+            self.deadlines.schedule(HEARTBEAT, 0, self.clock())
+
+
+class Network(object):
+    """
+    Discrete-event virtual network. Events are kept in a heap on virtual time, and
+    the next deadline of every node is kept in a Deadlines keyed by pid, so each step
+    touches only the one node that has something to do.
+    """
+
+    def __init__(self, latency=(0.001, 0.005), loss=0.0, seed=0, carry_members=False,
+                 coalesce=False, heartbeats=False):
+        """
+        :param latency: (min, max) one-way delay in virtual seconds
+        :param loss: fraction of messages silently dropped
+        :param seed: seed for every random choice made by the simulation
+        :param carry_members: deliver the member table of ELECTION, OK and COORDINATOR
+                              msgs when gossip is off (slow for big groups; the
+                              bytes are counted either way)
+        :param coalesce: run the nodes with election coalescing on
+        :param heartbeats: run the nodes with leader heartbeats on
+        """
+        self.latency = latency
+        self.loss = loss
+        self.carry_members = carry_members
+        self.coalesce = coalesce
+        self.heartbeats = heartbeats
+        self.random = random.Random(seed)
+        self.time = 0.0
+        self.events = []  # [(time, sequence, dst pid, src pid, message or epoch), ...]
+                          # (a bare epoch for a heartbeat)
+        self.sequence = itertools.count()
+        self.timers = Deadlines()  # {pid: node's next deadline}
+        self.last_delivery = {}  # {(src, dst): time}, keeps each link in order
+        self.nodes = {}  # {pid: SimBully, ...}
+        self.by_address = {}  # {listener address: pid, ...}, where heartbeats go
+        self.in_flight = 0  # election msgs sent and not yet delivered (or dropped)
+        self.checked = 0.0  # time settled() last looked at every node
+        self.crashed = set()
+        self.groups = None  # {pid: partition number, ...} while partitioned
+        self.stats = collections.Counter()
+        self.sizes = {}  # {(message_name, group size, fields): bytes on the wire}
+
+    def now(self):
+        return self.time
+
+    def add_nodes(self, n):
+        """
+        Create n nodes that all know each other, as if they had all JOINed the GCD.
+
+        :return: list of nodes in pid order
+        """
+        nodes = []
+        for i in range(len(self.nodes), len(self.nodes) + n):
+            pid = (1, 1_000_000 + i)
+            address = ('10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255), 5000)
+            nodes.append(SimBully(self, pid, address))
+            nodes[-1].coalesce = self.coalesce
+        for node in nodes:
+            self.nodes[node.pid] = node
+            self.by_address[node.listener_address] = node.pid
+            if self.heartbeats:
+                node.start_heartbeats()
+                self.refresh(node)
+        members = {pid: node.listener_address for pid, node in self.nodes.items()}
+        for node in self.nodes.values():
+            node.members = dict(members)
+        return sorted(self.nodes.values(), key=lambda node: node.pid)
+
+    # faults
+
+    def crash(self, pid):
+        """ Stop a node: it sends and receives nothing and its timers stop """
+        self.crashed.add(pid)
+        self.timers.cancel(pid)
+
+    def recover(self, pid):
+        """ Restart a crashed node with its state table wiped """
+        self.crashed.discard(pid)
+        self.nodes[pid].restart()
+        self.refresh(self.nodes[pid])
+
+    def partition(self, *groups):
+        """
+        Split the network; nodes in different groups can't reach each other.
+
+        :param groups: iterables of pids (nodes in none of them form one more group)
+        """
+        self.groups = {pid: i for i, group in enumerate(groups, 1) for pid in group}
+
+    def heal(self):
+        self.groups = None
+
+    def can_connect(self, dst):
+        return dst in self.nodes and dst not in self.crashed
+
+    def reachable(self, src, dst):
+        if dst in self.crashed:
+            return False
+        return self.groups is None or self.groups.get(src, 0) == self.groups.get(dst, 0)
+
+    # delivery
+
+    def size(self, message):
+        """ Bytes the message would take with the struct codec (cached per group size) """
+        name, members = message[:2]
+        key = name, None if members is None else len(members), len(message)
+        size = self.sizes.get(key)
+        if size is None:
+            size = self.sizes[key] = len(codec.encode(message))
+        return size
+
+    def send(self, src, dst, message):
+        """ Put a message on the wire from src to dst """
+        name = message[0]
+        self.stats['messages'] += 1
+        self.stats[name] += 1
+        self.stats['bytes'] += self.size(message)
+        if not self.reachable(src, dst) or self.random.random() < self.loss:
+            self.stats['dropped'] += 1
+            return
+        when = self.time + self.random.uniform(*self.latency)
+        when = max(when, self.last_delivery.get((src, dst), 0.0))
+        self.last_delivery[src, dst] = when
+        carry = message[1] is not None and (self.carry_members or name == 'MEMBERS')
+        data = dict(message[1]) if carry else None
+        self.in_flight += 1
+        heapq.heappush(self.events, (when, next(self.sequence), dst, src,
+                                     (name, data) + message[2:]))
+
+    def beat(self, src, epoch, address):
+        """ Send a heartbeat datagram from src to the node listening on address """
+        self.stats['heartbeats'] += 1
+        dst = self.by_address.get(address)
+        if dst is None or not self.reachable(src, dst) or self.random.random() < self.loss:
+            return
+        when = self.time + self.random.uniform(*self.latency)
+        heapq.heappush(self.events, (when, next(self.sequence), dst, src, epoch))
+
+    def refresh(self, node):
+        """ Re-file the node's next deadline after it may have changed """
+        deadline = node.deadlines.next_deadline()
+        if deadline is None or node.pid in self.crashed:
+            self.timers.cancel(node.pid)
+        else:
+            self.timers.schedule(node.pid, deadline - self.time, self.time)
+
+    def step(self, until):
+        """
+        Process the next event (a delivery or a node's deadline).
+
+        :param until: don't go past this virtual time
+        :return: False if nothing is left to do before until
+        """
+        next_event = self.events[0][0] if self.events else None
+        next_timer = self.timers.next_deadline()
+        if next_timer is not None and (next_event is None or next_timer < next_event):
+            if next_timer > until:
+                return False
+            self.time = next_timer
+            for pid in self.timers.expired(self.time):
+                node = self.nodes[pid]
+                node.check_timeouts()
+                self.refresh(node)
+            return True
+        if next_event is None or next_event > until:
+            return False
+        self.time, _seq, dst, src, message = heapq.heappop(self.events)
+        if isinstance(message, int):  # a heartbeat, carrying the sender's epoch
+            if dst not in self.crashed and self.reachable(src, dst):
+                node = self.nodes[dst]
+                node.heartbeats_received([(src, message)])
+                self.refresh(node)
+            return True
+        self.in_flight -= 1
+        if dst in self.crashed or not self.reachable(src, dst):
+            self.stats['dropped'] += 1
+            return True
+        node = self.nodes[dst]
+        node.handle_message(node.link(src), message)
+        node.flush_oks()
+        self.refresh(node)
+        return True
+
+    def run(self, limit=RUN_LIMIT):
+        """ Run until nothing is in flight and nobody is waiting, or limit seconds pass """
+        until = self.time + limit
+        with quiet():
+            while self.step(until):
+                if self.heartbeats and self.settled():
+                    break
+
+    def settled(self):
+        """
+        With heartbeats: True once no election msg is in flight, no live node is
+        waiting on anything and each follows the leader it should. Every node is only
+        looked at once per heartbeat interval.
+        """
+        if self.in_flight or self.time - self.checked < HEARTBEAT_INTERVAL:
+            return False
+        self.checked = self.time
+        expected = self.expected_leaders()
+        return all(not self.nodes[pid].states and self.nodes[pid].bully == leader
+                   for pid, leader in expected.items())
+
+    # measuring
+
+    def expected_leaders(self):
+        """ {pid: the highest live pid it can reach} for every live node """
+        components = collections.defaultdict(list)
+        for pid in self.nodes:
+            if pid not in self.crashed:
+                components[0 if self.groups is None else self.groups.get(pid, 0)].append(pid)
+        return {pid: max(component) for component in components.values()
+                for pid in component}
+
+    def elect(self, starter, limit=RUN_LIMIT):
+        """
+        Have one node start an election and run the network until it settles.
+
+        :param starter: SimBully to call start_election on
+        :param limit: virtual seconds to allow
+        :return: ElectionResult
+        """
+        before = collections.Counter(self.stats)
+        start, wall = self.time, time.perf_counter()
+        with quiet():
+            starter.start_election('simulated')
+        self.refresh(starter)
+        self.run(limit)
+
+        expected = self.expected_leaders()
+        stats = self.stats - before
+        changed = [self.nodes[pid].leader_time for pid in expected
+                   if self.nodes[pid].leader_time is not None]
+        return ElectionResult(
+            nodes=len(expected),
+            messages=stats['messages'],
+            by_kind={name: stats[name] for name in ('ELECTION', 'OK', 'COORDINATOR')},
+            bytes=stats['bytes'],
+            dropped=stats['dropped'],
+            time_to_leader=max([t - start for t in changed if t >= start], default=0.0),
+            converged=all(self.nodes[pid].bully == leader for pid, leader in expected.items()),
+            leaders=collections.Counter(self.nodes[pid].bully for pid in expected),
+            heartbeats=stats['heartbeats'],
+            wall_seconds=time.perf_counter() - wall)
+
+
+def report(label, result):
+    """ Print one election's results on a line """
+    print('{:>14} {:>6} {:>10,} {:>9.1f} {:>12,} {:>8,} {:>9.1f} {:>9} {:>10,} {:>7.2f}'.format(
+        label, result.nodes, result.messages, result.messages / max(1, result.nodes),
+        result.bytes, result.dropped, result.time_to_leader * 1000, str(result.converged),
+        result.heartbeats, result.wall_seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bully election simulator')
+    parser.add_argument('--nodes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='group sizes to simulate')
+    parser.add_argument('--latency', type=float, nargs=2, default=(0.001, 0.005),
+                        metavar=('MIN', 'MAX'), help='one-way delay in seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of messages lost')
+    parser.add_argument('--starter', choices=('lowest', 'random'), default='lowest',
+                        help='which node notices first and starts the election')
+    parser.add_argument('--crash-leader', action='store_true',
+                        help='after the first election, crash the leader and elect again')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--coalesce', action='store_true',
+                        help='dedupe elections by epoch, batch OKs, ask highest pids first')
+    parser.add_argument('--no-heartbeats', action='store_true',
+                        help="don't run leader heartbeats (a lost COORDINATOR then stays lost)")
+    args = parser.parse_args()
+
+    print('{:>14} {:>6} {:>10} {:>9} {:>12} {:>8} {:>9} {:>9} {:>10} {:>7}'.format(
+        'election', 'nodes', 'messages', 'msg/node', 'bytes', 'dropped', 'ms', 'converged',
+        'heartbeats', 'wall s'))
+    for n in args.nodes:
+        network = Network(tuple(args.latency), args.loss, args.seed,
+                          coalesce=args.coalesce, heartbeats=not args.no_heartbeats)
+        nodes = network.add_nodes(n)
+        pick = (lambda: nodes[0]) if args.starter == 'lowest' else \
+            (lambda: network.random.choice([node for node in nodes
+                                            if node.pid not in network.crashed]))
+        report('startup', network.elect(pick()))
+        if args.crash_leader:
+            network.crash(nodes[-1].pid)
+            report('leader crash', network.elect(pick()))
+
+
+if __name__ == '__main__':
+    main()
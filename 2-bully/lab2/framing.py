@@ -0,0 +1,174 @@
+"""
+Length-Prefixed Message Framing
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Framing layer used by every TCP conversation in the lab. Each message on the
+wire is a 4-byte big-endian payload length followed by the payload itself, so a
+receiver always knows how many bytes make up the next message regardless of how
+the kernel splits or coalesces the stream. Several messages may be written back to
+back on the same connection (pipelining).
+
+References
+https://docs.python.org/3/library/struct.html
+https://docs.python.org/3/library/socket.html#socket.socket.recv_into
+"""
+
+import struct
+
+import codec
+
+BUF_SZ = 4096  # bytes asked of recv per call
+HEADER = struct.Struct('!I')  # 4-byte big-endian payload length
+HEADER_SZ = HEADER.size
+MAX_FRAME_SZ = 64 * 1024 * 1024  # refuse anything bigger than 64 MB
+
+
+class FramingError(ValueError):
+    """
+    Raised when the stream does not contain a valid frame header.
+    """
+
+
+def frame(payload: bytes) -> bytes:
+    """
+    Prefix the payload with its length.
+
+    >>> frame(b'hi')
+    b'\\x00\\x00\\x00\\x02hi'
+
+    :param payload: bytes to put on the wire
+    :return: header + payload
+    """
+    if len(payload) > MAX_FRAME_SZ:
+        raise FramingError('frame of {} bytes exceeds {}'.format(len(payload), MAX_FRAME_SZ))
+    return HEADER.pack(len(payload)) + payload
+
+
+def recv_exactly(sock, n):
+    """
+    Blocks until exactly n bytes have been read from the socket.
+
+    :param sock: blocking socket to read from
+    :param n: number of bytes wanted
+    :return: the n bytes
+    :raises ConnectionError: if the peer closes before n bytes arrive
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        nbytes = sock.recv_into(view[got:], n - got)
+        if nbytes == 0:
+            raise ConnectionError('socket closed after {} of {} bytes'.format(got, n))
+        got += nbytes
+    return bytes(buf)
+
+
+def send_frame(sock, payload):
+    """
+    Send one framed payload on a blocking socket.
+
+    :param sock: socket to send on
+    :param payload: bytes to send
+    """
+    sock.sendall(frame(payload))
+
+
+def recv_frame(sock):
+    """
+    Blocks until one full frame has been read from the socket.
+
+    :param sock: blocking socket to read from
+    :return: the frame's payload
+    :raises ConnectionError: if the peer closes mid-frame (or before any frame)
+    :raises FramingError: if the header announces an oversize frame
+    """
+    size, = HEADER.unpack(recv_exactly(sock, HEADER_SZ))
+    if size > MAX_FRAME_SZ:
+        raise FramingError('frame of {} bytes exceeds {}'.format(size, MAX_FRAME_SZ))
+    return recv_exactly(sock, size)
+
+
+def send_msg(sock, data, codec_name=codec.STRUCT):
+    """
+    Marshall data and send it as one frame.
+
+    :param sock: socket to send on
+    :param data: message (shapes the codec doesn't know are pickled)
+    :param codec_name: codec.STRUCT or codec.PICKLE
+    """
+    send_frame(sock, codec.encode(data, codec_name))
+
+
+def recv_msg(sock, accept_pickle=True):
+    """
+    Block for one frame and unmarshall it with whichever codec it was sent in.
+
+    :param sock: socket to read from
+    :param accept_pickle: if False, refuse pickled payloads
+    :return: unmarshalled message
+    :raises codec.CodecError: if the payload can't be decoded
+    """
+    return codec.decode(recv_frame(sock), accept_pickle)[0]
+
+
+class FrameReader(object):
+    """
+    Streaming frame decoder for non-blocking sockets. Bytes are fed in as they arrive
+    and complete payloads come out; partial frames are held until the rest shows up,
+    and a single read holding several frames yields all of them.
+
+    >>> reader = FrameReader()
+    >>> reader.feed(frame(b'one') + frame(b'two')[:5])
+    [b'one']
+    >>> reader.feed(frame(b'two')[5:] + frame(b'three'))
+    [b'two', b'three']
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SZ):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def __len__(self):
+        """ Number of bytes buffered but not yet returned as a frame """
+        return len(self.buffer)
+
+    def feed(self, data):
+        """
+        Add newly received bytes and return every payload they complete.
+
+        :param data: bytes just read from the stream
+        :return: list of complete payloads, oldest first (possibly empty)
+        :raises FramingError: if a header announces an oversize frame
+        """
+        self.buffer += data
+        frames = []
+        start = 0
+        end = len(self.buffer)
+        while end - start >= HEADER_SZ:
+            size, = HEADER.unpack_from(self.buffer, start)
+            if size > self.max_frame_size:
+                raise FramingError('frame of {} bytes exceeds {}'.format(
+                    size, self.max_frame_size))
+            if end - start - HEADER_SZ < size:
+                break  # rest of this frame hasn't arrived yet
+            start += HEADER_SZ
+            frames.append(bytes(self.buffer[start:start + size]))
+            start += size
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def read_from(self, sock, buffer_size=BUF_SZ):
+        """
+        Do one recv on the socket and return any payloads it completes.
+
+        :param sock: socket reported readable by the selector
+        :param buffer_size: max bytes to recv in this call
+        :return: list of complete payloads (possibly empty)
+        :raises ConnectionError: if the peer has closed the connection
+        """
+        data = sock.recv(buffer_size)
+        if not data:
+            raise ConnectionError('socket closed')
+        return self.feed(data)
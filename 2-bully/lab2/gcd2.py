@@ -4,12 +4,23 @@ This is free and unencumbered software released into the public domain.
 :Authors: Kevin Lundeen
 :Version: f19-02
 """
+import collections
+import os
 import pickle
 import socket
 import socketserver
 import sys
+import threading
+import time
+
+import codec
+import framing
 
 BUF_SZ = 1024  # tcp receive buffer size
+SNAPSHOT_INTERVAL = 1.0  # min seconds between membership snapshots written to disk
+LOG_SIZE = 10_000  # membership changes kept for answering delta JOINs
+RESOLVE_TTL = 60.0  # seconds a listener host lookup is reused for
+RESOLVE_CACHE_SIZE = 1024  # most host lookups kept at once
 
 
 class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
@@ -17,7 +28,9 @@ class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
     A Group Coordinator Daemon (GCD) which will respond with a list of potential group members to a text message JOIN
     with list of group members to contact.
 
-    We respond with a dictionary of group members.
+    We respond with a dictionary of group members. A JOIN that also carries the
+    membership version the client last saw is answered with just the changes since
+    that version, or the whole group if the changes are no longer in the log.
     """
 
     # global group data structures
@@ -28,24 +41,64 @@ class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
     # we want to restrict all listeners to be on the same host as the GCD
     localhost_ip = socket.gethostbyname('localhost')
 
+    # versioned log of membership changes, (version, pid, listener or None if removed)
+    # versions are only comparable within the same epoch (i.e. GCD run), so after a
+    # restart every client gets one FULL response before going back to deltas
+    epoch = os.urandom(4).hex()
+    version = 0
+    membership_log = collections.deque(maxlen=LOG_SIZE)
+
+    # False refuses pickled JOINs, which can run arbitrary code when unpickled
+    accept_pickle = True
+
+    # guards the group data structures when handlers run in their own threads
+    lock = threading.RLock()
+
+    # where to persist the group data structures (None means don't)
+    snapshot_path = None
+    snapshot_time = 0.0  # time.monotonic() of the last snapshot written
+    snapshot_dirty = False  # membership changed since the last snapshot
+    snapshot_timer = None  # pending write of changes made too soon after the last one
+
+    # listener host lookups, {host: (ip, time.monotonic() it expires), ...}
+    resolved = {}
+
     def handle(self):
         """
-        Handles the incoming messages - expects only 'JOIN' messages
+        Handles the incoming messages - expects only 'JOIN' messages.
+        Each message is one frame; on a threaded server a client may pipeline several
+        on one connection. A single-threaded server answers one per connection, so a
+        client keeping its connection open can't hold up everyone else's JOIN.
+        Responses are sent in the same codec the request came in.
         """
         #print(self.request.getsockname())
-        raw = self.request.recv(BUF_SZ)  # self.request is the TCP socket connected to the client
-        try:
-            message = pickle.loads(raw)
-        except Exception:
-            response = bytes('Expected a pickled message, got ' + str(raw)[:100] + '\n', 'utf-8')
-        else:
+        pipelined = isinstance(self.server, socketserver.ThreadingMixIn)
+        while True:
+            try:
+                raw = framing.recv_frame(self.request)  # self.request is the TCP socket connected to the client
+            except (ConnectionError, framing.FramingError):
+                break  # client is done (or sent garbage instead of a header)
+            try:
+                message, codec_name = codec.decode(raw, self.accept_pickle)
+            except codec.CodecError as err:
+                response = codec.encode('Could not decode message: {}'.format(err),
+                                        codec.sniff(raw))
+            else:
+                try:
+                    response_data = self.handle_join(message)
+                except ValueError as err:
+                    response_data = str(err)
+                response = codec.encode(response_data, codec_name)
             try:
-                response_data = self.handle_join(message)
-            except ValueError as err:
-                response_data = str(err)
-            response = pickle.dumps(response_data)
-        self.request.sendall(response)
-        self.request.shutdown(socket.SHUT_RDWR)
+                framing.send_frame(self.request, response)
+            except OSError:
+                break
+            if not pipelined:
+                break
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # client already gone
         self.request.close()
 
     @staticmethod
@@ -56,8 +109,11 @@ class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
         - of the right form
         - listener is on localhost (or equivalent)
 
-        :param message: ('JOIN', ((days_to_bd, su_id), (host, port)))
-        :return: GroupCoordinatorDaemon.listeners_by_pid
+        :param message: ('JOIN', ((days_to_bd, su_id), (host, port))) or
+                        ('JOIN', ((days_to_bd, su_id), (host, port), since)) where since
+                        is the version token from a previous response (or None)
+        :return: copy of GroupCoordinatorDaemon.listeners_by_pid, or if since was given
+                 ('DELTA', version, added, removed) or ('FULL', version, members)
         :raises ValueError: if the message cannot be validated
         """
         try:
@@ -71,7 +127,12 @@ class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
 
         # pull apart message_data
         try:
-            process_id, listener = message_data
+            if len(message_data) == 3:
+                process_id, listener, since = message_data
+                delta = True
+            else:
+                process_id, listener = message_data
+                since, delta = None, False
             listen_host, listen_port = listener
             days_to_birthday, student_id = process_id
         except (ValueError, TypeError):
@@ -82,7 +143,7 @@ class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
 
         # make sure that listen_host is localhost or equivalent
         try:
-            listen_ip = socket.gethostbyname(listen_host)
+            listen_ip = GroupCoordinatorDaemon.resolve(listen_host)
         except Exception as err:
             raise ValueError(str(err))
         if not (type(listen_port) is int and 0 < listen_port < 65_536):
@@ -91,34 +152,225 @@ class GroupCoordinatorDaemon(socketserver.BaseRequestHandler):
             raise ValueError('Only local group members currently allowed')
         listener = (listen_ip, listen_port)
 
-        # aliases for global dictionaries
-        students = GroupCoordinatorDaemon.pids_by_student
-        group = GroupCoordinatorDaemon.listeners_by_pid
-        listeners = GroupCoordinatorDaemon.pids_by_listener
+        with GroupCoordinatorDaemon.lock:
+            # aliases for global dictionaries
+            students = GroupCoordinatorDaemon.pids_by_student
+            group = GroupCoordinatorDaemon.listeners_by_pid
+            listeners = GroupCoordinatorDaemon.pids_by_listener
+
+            log = GroupCoordinatorDaemon.log_change
+
+            # remove any old memberships for the same student
+            if student_id in students and students[student_id] != process_id:
+                old_pid = students[student_id]
+                if group.pop(old_pid, None) is not None:
+                    log(old_pid, None)
+            students[student_id] = process_id
 
-        # remove any old memberships for the same student
-        if student_id in students and students[student_id] != process_id:
-            old_pid = students[student_id]
-            del group[old_pid]
-        students[student_id] = process_id
+            # add this entry into group membership
+            if group.get(process_id) != listener:
+                group[process_id] = listener
+                log(process_id, listener)
 
-        # add this entry into group membership
-        group[process_id] = listener
+            # also remove any old memberships which claimed this same listener (host, port) pair
+            if listener in listeners and listeners[listener] != process_id:
+                old_pid = listeners[listener]
+                if old_pid in group:
+                    del group[old_pid]
+                    log(old_pid, None)
+            listeners[listener] = process_id
 
-        # also remove any old memberships which claimed this same listener (host, port) pair
-        if listener in listeners and listeners[listener] != process_id:
-            old_pid = listeners[listener]
-            if old_pid in group:
-                del group[old_pid]
-        listeners[listener] = process_id
+            GroupCoordinatorDaemon.save_snapshot()
+
+            if delta:
+                return GroupCoordinatorDaemon.changes_since(since)
+
+            # copy, so other handler threads can keep changing the group while we pickle
+            return dict(group)
+
+    @classmethod
+    def log_change(cls, pid, listener):
+        """
+        Record a membership change in the versioned log. Call with the lock held.
+
+        :param pid: process id added, moved or removed
+        :param listener: its new (host, port), None if it was removed
+        """
+        cls.version += 1
+        cls.membership_log.append((cls.version, pid, listener))
+        cls.snapshot_dirty = True
+
+    @classmethod
+    def changes_since(cls, since):
+        """
+        Membership changes after the given version, or the whole group if the client's
+        version is from another epoch or older than anything left in the log.
+        Call with the lock held.
+
+        :param since: (epoch, version) token from an earlier response, or None
+        :return: ('DELTA', (epoch, version), added, removed) where added is
+                 {pid: listener, ...} and removed is [pid, ...], or
+                 ('FULL', (epoch, version), {pid: listener, ...})
+        """
+        token = (cls.epoch, cls.version)
+        try:
+            their_epoch, their_version = since
+        except (ValueError, TypeError):
+            their_epoch, their_version = None, None
+        log = cls.membership_log
+        oldest = log[0][0] if log else cls.version + 1
+        if (their_epoch != cls.epoch or type(their_version) is not int
+                or their_version > cls.version or their_version < oldest - 1):
+            return 'FULL', token, dict(cls.listeners_by_pid)
 
-        return group
+        # walk back from the newest change, the latest change to each pid wins
+        latest = {}
+        for version, pid, listener in reversed(log):
+            if version <= their_version:
+                break
+            latest.setdefault(pid, listener)
+        added = {pid: listener for pid, listener in latest.items() if listener is not None}
+        removed = [pid for pid, listener in latest.items() if listener is None]
+        return 'DELTA', token, added, removed
+
+    @classmethod
+    def resolve(cls, host):
+        """
+        socket.gethostbyname, cached for RESOLVE_TTL seconds so repeat JOINs don't
+        block on the resolver but a host whose address changes is picked up again.
+        Failed lookups raise and are not cached.
+
+        :param host: listener host name from a JOIN
+        :return: dotted IPv4 address
+        """
+        now = time.monotonic()
+        cached = cls.resolved.get(host)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        ip = socket.gethostbyname(host)
+        with cls.lock:
+            resolved = cls.resolved
+            if len(resolved) >= RESOLVE_CACHE_SIZE:
+                for stale in [h for h, (_ip, expires) in resolved.items() if expires <= now]:
+                    del resolved[stale]
+                if len(resolved) >= RESOLVE_CACHE_SIZE:
+                    del resolved[next(iter(resolved))]  # oldest lookup
+            resolved[host] = (ip, now + RESOLVE_TTL)
+        return ip
+
+    @classmethod
+    def save_snapshot(cls, force=False):
+        """
+        Write the group data structures to snapshot_path if they changed, at most once
+        every SNAPSHOT_INTERVAL seconds unless forced. Changes made sooner than that are
+        written by a timer once the interval is up, so none wait on the next JOIN. The
+        file is replaced atomically so a crash mid-write leaves the previous snapshot
+        intact.
+
+        :param force: write now even if the interval hasn't passed
+        """
+        with cls.lock:
+            if cls.snapshot_path is None or not cls.snapshot_dirty:
+                return
+            now = time.monotonic()
+            wait = cls.snapshot_time + SNAPSHOT_INTERVAL - now
+            if not force and wait > 0:
+                if cls.snapshot_timer is None:
+                    cls.snapshot_timer = threading.Timer(wait, cls.flush_snapshot)
+                    cls.snapshot_timer.daemon = True
+                    cls.snapshot_timer.start()
+                return
+            cls.cancel_snapshot_timer()
+            state = (cls.listeners_by_pid, cls.pids_by_listener, cls.pids_by_student)
+            temp_path = cls.snapshot_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                pickle.dump(state, f)
+            os.replace(temp_path, cls.snapshot_path)
+            cls.snapshot_time, cls.snapshot_dirty = now, False
+
+    @classmethod
+    def flush_snapshot(cls):
+        """ Runs on the snapshot timer: write out the changes it was started for """
+        with cls.lock:
+            if cls.snapshot_timer is not threading.current_thread():
+                return  # cancelled, and maybe replaced, while waiting for the lock
+            cls.snapshot_timer = None
+            cls.save_snapshot(force=True)
+
+    @classmethod
+    def cancel_snapshot_timer(cls):
+        """ Drop the pending snapshot write, if any """
+        with cls.lock:
+            if cls.snapshot_timer is not None:
+                cls.snapshot_timer.cancel()
+                cls.snapshot_timer = None
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """
+        Use path for snapshots from now on, restoring the group from it if it exists.
+
+        :param path: snapshot file name
+        :return: number of members restored
+        """
+        with cls.lock:
+            cls.snapshot_path = path
+            if not os.path.exists(path):
+                return 0
+            with open(path, 'rb') as f:
+                group, listeners, students = pickle.load(f)
+            cls.listeners_by_pid.clear()
+            cls.listeners_by_pid.update(group)
+            cls.pids_by_listener.clear()
+            cls.pids_by_listener.update(listeners)
+            cls.pids_by_student.clear()
+            cls.pids_by_student.update(students)
+            return len(group)
+
+
+class ThreadedGroupCoordinator(socketserver.ThreadingTCPServer):
+    """
+    GCD server that handles each connection in its own thread, so a slow or stalled
+    client doesn't hold up everyone else's JOIN.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+def serve(port, threaded=True, snapshot=None, accept_pickle=True):
+    """
+    Run a GCD on the given port until interrupted.
+
+    :param port: port to listen on
+    :param threaded: handle each connection in its own thread (False serves one
+                     connection, and so one JOIN, at a time)
+    :param snapshot: file to persist group membership in (None means don't)
+    :param accept_pickle: False to only accept struct-codec JOINs
+    """
+    GroupCoordinatorDaemon.accept_pickle = accept_pickle
+    if snapshot is not None:
+        restored = GroupCoordinatorDaemon.load_snapshot(snapshot)
+        print('restored {} members from {}'.format(restored, snapshot))
+    server_class = ThreadedGroupCoordinator if threaded else socketserver.TCPServer
+    try:
+        with server_class(('', port), GroupCoordinatorDaemon) as server:
+            server.serve_forever()
+    finally:
+        GroupCoordinatorDaemon.save_snapshot(force=True)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage: python gcd2.py GCDPORT")
+    args = sys.argv[1:]
+    threaded = '--single-threaded' not in args
+    for flag in ('--single-threaded', '--threaded'):  # --threaded is the default now
+        if flag in args:
+            args.remove(flag)
+    no_pickle = '--no-pickle' in args
+    if no_pickle:
+        args.remove('--no-pickle')
+    if len(args) not in (1, 2):
+        print("Usage: python gcd2.py GCDPORT [SNAPSHOT_FILE] [--single-threaded] [--no-pickle]")
         exit(1)
-    port = int(sys.argv[1])
-    with socketserver.TCPServer(('', port), GroupCoordinatorDaemon) as server:
-        server.serve_forever()
+    port = int(args[0])
+    serve(port, threaded, args[1] if len(args) == 2 else None, not no_pickle)
@@ -0,0 +1,227 @@
+"""
+GCD Load Test
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Self-contained throughput benchmark for the Group Coordinator Daemon in
+gcd2.py. Starts a GCD on localhost, drives it with concurrent
+synthetic clients sending valid and malformed JOIN messages, and reports JOINs per
+second, p50/p99 latency and memory growth so server modes can be compared. Each
+mode runs in a fresh process, since peak RSS only ever goes up: measured in one
+process, every mode after the first would show the growth left over from the ones
+before it instead of its own.
+
+Usage:
+    python gcd_bench.py [--clients N] [--joins N] [--members N] [--malformed FRACTION]
+                        [--mode plain|threaded|both] [--pipeline] [--delta]
+                        [--codec struct|pickle]
+
+References
+https://docs.python.org/3/library/socketserver.html
+https://docs.python.org/3/library/resource.html
+https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+"""
+
+import argparse
+import multiprocessing
+import random
+import resource
+import socket
+import socketserver
+import threading
+import time
+
+import codec
+import framing
+from gcd2 import GroupCoordinatorDaemon, ThreadedGroupCoordinator
+
+MALFORMED = [  # things a buggy client might send instead of a proper JOIN
+    'JOIN',
+    ('JOIN',),
+    ('HELLO', ((100, 1_234_567), ('localhost', 40_000))),
+    ('JOIN', ((100, 1_234_567), ('localhost', 'port'))),
+    ('JOIN', ((0, 1_234_567), ('localhost', 40_000))),
+    ('JOIN', ((100, 12), ('localhost', 40_000))),
+]
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+
+    >>> percentile([1, 2, 3, 4], 0.5), percentile([1, 2, 3, 4], 0.99)
+    (2, 4)
+    """
+    if not ordered:
+        return float('nan')
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def max_rss_kb():
+    """ Peak resident set size of this process so far (KB on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_gcd():
+    """ Empty the GCD's class-level group data structures between runs """
+    with GroupCoordinatorDaemon.lock:
+        GroupCoordinatorDaemon.listeners_by_pid.clear()
+        GroupCoordinatorDaemon.pids_by_listener.clear()
+        GroupCoordinatorDaemon.pids_by_student.clear()
+        GroupCoordinatorDaemon.membership_log.clear()
+        GroupCoordinatorDaemon.snapshot_path = None
+
+
+class LoadClient(threading.Thread):
+    """
+    One synthetic client. Sends its share of JOINs to the GCD and records the
+    latency of each round trip.
+    """
+
+    def __init__(self, address, n, joins, members, malformed, pipeline, delta,
+                 codec_name=codec.STRUCT):
+        """
+        :param address: GCD (host, port)
+        :param n: this client's number, used to pick its pids
+        :param joins: number of JOINs to send
+        :param members: distinct members the whole run cycles through (group size)
+        :param malformed: fraction of messages that are malformed
+        :param pipeline: keep one connection open for all JOINs
+        :param delta: send the version token from the previous reply
+        :param codec_name: codec.STRUCT or codec.PICKLE
+        """
+        super().__init__(daemon=True)
+        self.address = address
+        self.joins = joins
+        self.members = members
+        self.malformed = malformed
+        self.pipeline = pipeline
+        self.delta = delta
+        self.codec_name = codec_name
+        self.random = random.Random(n)
+        self.latencies = []
+        self.errors = 0
+        self.bytes_received = 0
+        self.since = None
+
+    def message(self):
+        """ Next message to send, malformed with the configured probability """
+        if self.random.random() < self.malformed:
+            return self.random.choice(MALFORMED)
+        i = self.random.randrange(self.members)
+        data = ((i % 365 + 1, 1_000_000 + i), ('127.0.0.1', 1024 + i % 64_000))
+        if self.delta:
+            data += (self.since,)
+        return 'JOIN', data
+
+    def exchange(self, gcd, message):
+        """ One JOIN round trip on an open connection """
+        start = time.perf_counter()
+        framing.send_msg(gcd, message, self.codec_name)
+        raw = framing.recv_frame(gcd)
+        self.latencies.append(time.perf_counter() - start)
+        self.bytes_received += len(raw)
+        if self.delta and raw:
+            reply, _codec_name = codec.decode(raw)
+            if type(reply) == tuple and reply and reply[0] in ('FULL', 'DELTA'):
+                self.since = reply[1]
+
+    def run(self):
+        gcd = None
+        try:
+            for _ in range(self.joins):
+                if gcd is None:
+                    gcd = socket.create_connection(self.address)
+                self.exchange(gcd, self.message())
+                if not self.pipeline:
+                    gcd.close()
+                    gcd = None
+        except OSError:
+            self.errors += 1
+        finally:
+            if gcd is not None:
+                gcd.close()
+
+
+def run_mode(mode, args):
+    """
+    Start a GCD in the given mode, drive it with args.clients clients and report.
+
+    :param mode: 'plain' (socketserver.TCPServer) or 'threaded'
+    :param args: parsed command line
+    :return: dict of results
+    """
+    reset_gcd()
+    server_class = ThreadedGroupCoordinator if mode == 'threaded' else socketserver.TCPServer
+    server = server_class(('localhost', 0), GroupCoordinatorDaemon)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    rss_before = max_rss_kb()
+    pipeline = args.pipeline and mode == 'threaded'  # plain mode answers one JOIN per connection
+    clients = [LoadClient(server.server_address, n, args.joins, args.members,
+                          args.malformed, pipeline, args.delta, args.codec)
+               for n in range(args.clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+
+    latencies = sorted(lat for client in clients for lat in client.latencies)
+    return {
+        'mode': mode,
+        'joins': len(latencies),
+        'errors': sum(client.errors for client in clients),
+        'seconds': elapsed,
+        'per_second': len(latencies) / elapsed if elapsed else float('nan'),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'reply_bytes': sum(client.bytes_received for client in clients) / max(1, len(latencies)),
+        'group_size': len(GroupCoordinatorDaemon.listeners_by_pid),
+        'rss_growth_kb': max_rss_kb() - rss_before,
+    }
+
+
+def run_mode_in_child(mode, args):
+    """ run_mode in a newly started process, so its peak RSS starts from a clean baseline """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_mode, (mode, args))
+
+
+def report(result):
+    """ Print one mode's results on a line """
+    print('{mode:>8}: {joins} JOINs in {seconds:.2f}s = {per_second:,.0f}/s  '
+          'p50 {p50_ms:.2f}ms  p99 {p99_ms:.2f}ms  {reply_bytes:,.0f} B/reply  '
+          'group {group_size}  rss +{rss_growth_kb} KB  errors {errors}'.format(**result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GCD load test')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--joins', type=int, default=200, help='JOINs per client')
+    parser.add_argument('--members', type=int, default=1000, help='distinct members (group size)')
+    parser.add_argument('--malformed', type=float, default=0.05,
+                        help='fraction of malformed messages')
+    parser.add_argument('--mode', choices=('plain', 'threaded', 'both'), default='both')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='reuse one connection per client instead of one per JOIN '
+                             '(threaded mode only)')
+    parser.add_argument('--delta', action='store_true',
+                        help='ask for membership deltas instead of the whole group')
+    parser.add_argument('--codec', choices=(codec.STRUCT, codec.PICKLE), default=codec.STRUCT,
+                        help='how clients marshal their JOINs')
+    args = parser.parse_args()
+
+    if args.pipeline and args.mode != 'threaded':
+        print('note: plain mode answers one JOIN per connection, so its clients '
+              'connect for each JOIN even with --pipeline')
+    modes = ('plain', 'threaded') if args.mode == 'both' else (args.mode,)
+    for mode in modes:
+        report(run_mode_in_child(mode, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+"""
+Multi-Group Bully Runtime
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Many Bully election groups (e.g. one per shard) hosted by one process over
+one selector, one listener, one heartbeat socket and one connection per peer
+process. Every group's node has the process's pid and advertises the shared listener
+address, so a peer process reaches all of its groups at one address.
+
+Two hosts talk over a single PeerLink, however many groups they share. Every frame on
+a link starts with the id of the group it is for, and each group has a GroupChannel on
+the link: its own conversation record with that peer, with its msgs queued on the
+link. A group opens its channel with a HELLO as usual; the receiving host hands each
+frame to its group, starting that group's GroupChannel on the link with the first one.
+Once a HELLO has said whose link it is, every group of that host uses it to reach
+that peer. A link that breaks is closed for all the groups on it.
+
+Group LEGACY_GROUP (0) is the exception: its frames carry no group id, and its HELLOs
+and heartbeats are untagged too, exactly as a standalone Bully (bully.py) sends them.
+So standalone nodes and hosted ones can be members of group 0 together. Frames of
+the other groups can't reach a standalone Bully. Group ids stay below 2**31, so a
+tagged frame starts with a byte below 0x80, and every payload starts with one at or
+above it (pickle's PROTO opcode, or codec.MAGIC). The first byte of a frame then
+tells whether it has a group id.
+
+Heartbeats for hosted groups go through the host's one UDP socket, tagged with the
+group id (see heartbeat.py), and the host hands each group its own.
+
+The host keeps each node's next deadline in a Deadlines keyed by node, so the loop
+sleeps until the earliest deadline of any group and only the groups with something
+to do are woken.
+
+A process hosting G groups with P peer processes needs one listener, one selector,
+one heartbeat socket, one thread and P connections, instead of G of the first four
+and G * P connections. Group ids are ints from 0 to MAX_GROUP (they go on the wire).
+
+Usage:
+    python groups.py GCDHOST SUID GCDPORT [GCDPORT ...] --birthday YYYY-MM-DD [--heartbeats]
+
+runs one group per GCD, using the GCD's port number as the group id.
+
+References
+https://docs.python.org/3/library/selectors.html
+https://en.wikipedia.org/wiki/Bully_algorithm
+"""
+
+import argparse
+import logging
+import selectors
+import socket
+import struct
+import sys
+import time
+from socket import error as socket_error
+
+import framing
+from bully import Bully, CHECK_INTERVAL, log, upcoming_birthday
+from channel import Peer, PeerChannel
+from heartbeat import Heartbeats, receive_all
+from timers import Deadlines
+
+GROUP = struct.Struct('!I')  # group id at the front of every frame on a link
+LEGACY_GROUP = 0  # the group whose frames go untagged, as a standalone Bully's do
+MAX_GROUP = 0x7FFFFFFF  # so a group id's first byte is never a payload's first byte
+UNTAGGED = 0x80  # a frame starting with a byte from here up has no group id
+
+
+class PeerLink(PeerChannel):
+    """
+    The connection between this host and one peer process, shared by every group
+    the two have in common. pid is None for an accepted link until a HELLO on it
+    says who is on the other end.
+    """
+    __slots__ = ('channels', 'closed')
+
+    def __init__(self, sock, pid=None, connecting=False):
+        super().__init__(sock, pid, connecting)
+        self.channels = {}  # {group id: GroupChannel, ...} groups talking over this link
+        self.closed = False
+
+
+class GroupChannel(Peer):
+    """
+    One group's conversation with a peer process, carried on the link to it. Has the
+    parts of a PeerChannel a Bully node uses; reading, and watching the socket, are
+    left to the host.
+    """
+    __slots__ = ('link', 'group', 'sock', 'fd')
+
+    def __init__(self, link, group, pid=None):
+        """
+        :param link: PeerLink to the peer
+        :param group: group id
+        :param pid: peer's process id, if known
+        """
+        super().__init__(pid)
+        self.link, self.group = link, group
+        self.sock, self.fd = link.sock, link.fd
+
+    @property
+    def outbox(self):
+        return self.link.outbox
+
+    def queue(self, payload):
+        """ Queue one msg payload on the link, tagged with my group (unless legacy) """
+        if self.group == LEGACY_GROUP:
+            self.link.queue(payload)
+        else:
+            self.link.queue(GROUP.pack(self.group) + payload)
+
+    def wants_write(self):
+        return self.link.wants_write()
+
+    def congested(self):
+        return self.link.congested()
+
+    def flush(self):
+        return self.link.flush()
+
+    def close(self):
+        pass  # the host closes the link
+
+
+class GroupMember(Bully):
+    """ One group's Bully node, using its host's selector, listener and links """
+
+    def __init__(self, host, group, gcd_address, next_birthday, su_id):
+        """
+        :param host: GroupHost running the node
+        :param group: group id
+        :param gcd_address: (host, port) of the group's GCD
+        :param next_birthday: users next birthday in iso-str format 'YEAR-MO-DY'
+        :param su_id: user's six digit seattle u id
+        """
+        self.host = host
+        super().__init__(gcd_address, next_birthday, su_id)
+        self.group = group
+
+    def open_transport(self):
+        """ The host owns the selector and the listener """
+        self.selector = self.host.selector
+        self.listener, self.listener_address = self.host.listener, self.host.listener_address
+
+    def open_heartbeats(self, interval, threshold, budget):
+        """ Heartbeats tagged with my group (unless legacy), on the host's shared socket """
+        group = None if self.group == LEGACY_GROUP else self.group
+        return Heartbeats(None, interval, threshold, budget, group,
+                          self.host.heartbeat_socket())
+
+    def hello(self):
+        """ In the legacy group, the HELLO a standalone Bully sends """
+        if self.group == LEGACY_GROUP:
+            return 'HELLO', {self.pid: self.listener_address}
+        return super().hello()
+
+    def start_heartbeats(self, *args, **kwargs):
+        super().start_heartbeats(*args, **kwargs)
+        self.host.dirty.add(self)  # first heartbeat tick is due
+
+    def open_channel(self, member):
+        """ My channel on the host's link to the member (connecting one if need be) """
+        return self.host.open_channel(self.group, member, self.members[member])
+
+    def add_channel(self, channel):
+        """ Start tracking a GroupChannel; the host watches its link """
+        self.peers[channel.fd] = channel
+        if channel.pid is not None:
+            self.channels[channel.pid] = channel
+        channel.link.channels[self.group] = channel
+        self.host.update_interest(channel.link)
+
+    def update_interest(self, channel):
+        self.host.update_interest(channel.link)
+
+    def close_channel(self, channel, reason):
+        """ A broken link is broken for every group on it """
+        self.host.close_link(channel.link, reason)
+
+    def identify(self, peer, their_idea):
+        super().identify(peer, their_idea)
+        channel = self.record(peer)
+        if channel is not None and channel.pid is not None:
+            self.host.identify(channel.link, channel.pid)
+
+    def set_state(self, state, peer=None):
+        super().set_state(state, peer)
+        self.host.dirty.add(self)  # its deadlines may have changed
+
+
+class GroupHost(object):
+    """
+    Runs the event loop for every group hosted by this process.
+    """
+
+    def __init__(self, next_birthday, su_id):
+        """
+        :param next_birthday: users next birthday in iso-str format 'YEAR-MO-DY'
+        :param su_id: user's six digit seattle u id
+        """
+        self.next_birthday, self.su_id = next_birthday, su_id
+        self.selector = selectors.DefaultSelector()
+        self.listener, self.listener_address = Bully.start_a_server()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.heartbeat_sock = None  # UDP socket shared by the groups' heartbeats
+        self.groups = {}  # {group id: GroupMember, ...}
+        self.links = {}  # {pid: PeerLink, ...} the link to each peer process we know
+        self.by_fd = {}  # {file descriptor: PeerLink, ...} every open link
+        self.deadlines = Deadlines()  # next deadline of each GroupMember
+        self.dirty = set()  # GroupMembers whose deadlines may have changed
+        self.clock = time.monotonic
+
+    def add_group(self, group, gcd_address=('localhost', 0)):
+        """
+        Start hosting a group.
+
+        :param group: group id, an int from 0 to MAX_GROUP (0 is LEGACY_GROUP)
+        :param gcd_address: (host, port) of the group's GCD
+        :return: the group's GroupMember
+        """
+        if not 0 <= group <= MAX_GROUP:
+            raise ValueError('group id {} is not between 0 and {}'.format(group, MAX_GROUP))
+        if group in self.groups:
+            raise ValueError('already hosting group {}'.format(group))
+        node = self.groups[group] = GroupMember(self, group, gcd_address,
+                                                self.next_birthday, self.su_id)
+        return node
+
+    def heartbeat_socket(self):
+        """ The UDP socket every group's heartbeats use, opened the first time """
+        if self.heartbeat_sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(self.listener_address)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.heartbeat_sock = sock
+        return self.heartbeat_sock
+
+    def run(self):
+        """ Runs the event loop for every group """
+        while True:
+            self.run_once(self.deadlines.timeout(CHECK_INTERVAL, self.clock()))
+
+    def run_once(self, timeout):
+        """
+        One pass of the event loop: wait up to timeout seconds for socket events,
+        hand what arrives to the groups it is for, then check the groups whose
+        deadlines have passed.
+
+        :param timeout: max seconds to wait in select
+        """
+        self.refresh()  # pick up elections started since the last pass
+        events = self.selector.select(timeout)
+
+        for key, mask in events:
+            if key.fileobj is self.listener:
+                self.accept_peer()
+                continue
+            if key.fileobj is self.heartbeat_sock:
+                self.receive_heartbeats()
+                continue
+            link = self.by_fd.get(key.fd)
+            if link is None:
+                continue
+            if mask & selectors.EVENT_WRITE:
+                self.write_ready(link)
+            if mask & selectors.EVENT_READ and not link.closed:
+                self.receive(link)
+
+        busy, self.dirty = self.dirty, set()
+        busy.update(self.deadlines.expired(self.clock()))
+        for node in busy:
+            node.flush_oks()
+            node.check_timeouts()
+        self.dirty |= busy
+        self.refresh()
+
+    def refresh(self):
+        """ Bring the host's deadline for each changed group up to date """
+        for node in self.dirty:
+            deadline = node.deadlines.next_deadline()
+            if deadline is None:
+                self.deadlines.cancel(node)
+            else:
+                self.deadlines.schedule_at(node, deadline)
+        self.dirty.clear()
+
+    # links
+
+    def accept_peer(self):
+        """ Accept a link; whose it is comes out with the first HELLO on it """
+        try:
+            sock, _addr = self.listener.accept()
+        except socket_error as serr:
+            log.warning('accept failed %s', serr)
+            return
+        sock.setblocking(False)
+        self.add_link(PeerLink(sock))
+
+    def add_link(self, link):
+        """ Start tracking a link and watching it in the selector """
+        self.by_fd[link.fd] = link
+        if link.pid is not None:
+            self.links.setdefault(link.pid, link)
+        self.selector.register(link.sock, Bully.interest(link))
+
+    def open_channel(self, group, pid, address):
+        """
+        A group's channel to a peer process, on the link to it (connecting one if there
+        isn't one yet).
+
+        :param group: group id
+        :param pid: peer's process id
+        :param address: peer's listener (host, port)
+        :return: GroupChannel
+        :raises OSError: if a new link fails to connect straight away
+        """
+        link = self.links.get(pid)
+        if link is None:
+            link = PeerLink.connect(pid, address)
+            self.add_link(link)
+        channel = link.channels.get(group)
+        return channel if channel is not None else GroupChannel(link, group, pid)
+
+    def identify(self, link, pid):
+        """ A HELLO said who is on the other end of a link """
+        if link.pid is None:
+            link.pid = pid
+        self.links.setdefault(pid, link)
+
+    def update_interest(self, link):
+        """ Watch for writability only while something is queued on the link """
+        if link.closed:
+            return
+        events = Bully.interest(link)
+        if self.selector.get_key(link.sock).events != events:
+            self.selector.modify(link.sock, events)
+
+    def write_ready(self, link):
+        """ Link is writable: finish its connect and send what is queued """
+        try:
+            link.flush()
+        except socket_error as serr:
+            self.close_link(link, 'send failed {}'.format(serr))
+            return
+        self.update_interest(link)
+
+    def receive(self, link):
+        """
+        Read what has arrived on a link and hand each frame to the group it is for,
+        starting the group's channel on the link if this is its first frame.
+
+        :param link: PeerLink reported readable
+        """
+        try:
+            packets = link.read()
+        except (BlockingIOError, InterruptedError):
+            return
+        except (socket_error, framing.FramingError) as err:
+            self.close_link(link, err)
+            return
+        for packet in packets:
+            if link.closed:
+                return
+            if packet[:1] and packet[0] >= UNTAGGED:
+                group, payload = LEGACY_GROUP, packet
+            elif len(packet) < GROUP.size:
+                self.close_link(link, 'frame without a group id')
+                return
+            else:
+                (group,), payload = GROUP.unpack_from(packet), packet[GROUP.size:]
+            node = self.groups.get(group)
+            if node is None:
+                log.warning('dropping frame for group %s, which I do not host', group)
+                continue
+            channel = link.channels.get(group)
+            if channel is None:
+                channel = GroupChannel(link, group)
+                node.add_channel(channel)
+            node.handle_packets(channel, [payload])
+            self.dirty.add(node)
+
+    def close_link(self, link, reason):
+        """
+        Close a link, ending every group's conversation on it.
+
+        :param link: PeerLink to close
+        :param reason: note for log
+        """
+        if link.closed:
+            return
+        link.closed = True
+        if not link.channels:
+            log.warning('closing link: %s', reason)
+        for group, channel in list(link.channels.items()):
+            node = self.groups[group]
+            node.forget_channel(channel, reason)
+            self.dirty.add(node)
+        link.channels.clear()
+        if link.pid is not None and self.links.get(link.pid) is link:
+            del self.links[link.pid]
+        del self.by_fd[link.fd]
+        self.selector.unregister(link.sock)
+        link.close()
+
+    # heartbeats
+
+    def receive_heartbeats(self):
+        """ Hand each group the heartbeats sent to it """
+        by_group = {}
+        for group, pid, epoch in receive_all(self.heartbeat_sock):
+            group = LEGACY_GROUP if group is None else group
+            by_group.setdefault(group, []).append((pid, epoch))
+        for group, beats in by_group.items():
+            node = self.groups.get(group)
+            if node is not None and node.heartbeats is not None:
+                node.heartbeats_received(beats)
+                self.dirty.add(node)
+
+    def close(self):
+        """ Close every link, the sockets and the selector """
+        for link in list(self.by_fd.values()):
+            link.close()
+        if self.heartbeat_sock is not None:
+            self.heartbeat_sock.close()
+        self.listener.close()
+        self.selector.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bully groups')
+    parser.add_argument('host', help='GCD host')
+    parser.add_argument('suid', type=int, help='six digit seattle u id')
+    parser.add_argument('ports', type=int, nargs='+',
+                        help='GCD port of each group (also used as its group id)')
+    parser.add_argument('--birthday', required=True,
+                        help='birthday, YYYY-MM-DD (only the month and day are used)')
+    parser.add_argument('--heartbeats', action='store_true',
+                        help='detect leader failure with UDP heartbeats')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='DEBUG traces every event and state change')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(message)s', stream=sys.stdout)
+
+    host = GroupHost(upcoming_birthday(args.birthday), args.suid)
+    for port in args.ports:
+        node = host.add_group(port, (args.host, port))
+        node.join_group()
+        if args.heartbeats:
+            node.start_heartbeats()
+        node.start_election('at startup')
+    log.info('Hosting %d groups on %s', len(host.groups), host.listener_address)
+    host.run()
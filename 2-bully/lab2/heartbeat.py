@@ -0,0 +1,248 @@
+"""
+Leader Heartbeats
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Leader liveness for the Bully nodes. The leader sends small UDP datagrams
+to the members every HEARTBEAT_INTERVAL. Every other member runs a phi accrual
+failure detector on the arrivals from its leader. The detector turns the time since
+the last heartbeat into a suspicion level (phi), scaled by how regular the
+heartbeats have been so far, after allowing ACCEPTABLE_PAUSE heartbeat periods to go
+missing (datagrams do get lost, and one lost in a row is routine). Once phi passes
+PHI_THRESHOLD the leader is presumed dead and an election is started. Heartbeats use the same port number as the node's
+TCP listener, so no extra addresses need to go through the GCD. Groups hosted by one
+process (see groups.py) share that process's heartbeat socket, and their heartbeats
+carry the group id so the receiving host can tell whose leader each one is from.
+
+Overhead is bounded by HEARTBEAT_BUDGET: each interval the leader sends at most that
+many 18-byte datagrams, going round the members in turn. Groups no bigger than the
+budget hear from the leader every interval. In bigger ones each member hears from it
+every ceil(members / budget) intervals, and its detector expects that period instead.
+So the leader sends at most HEARTBEAT_BUDGET / HEARTBEAT_INTERVAL datagrams a second
+(1,600 with the defaults) however big the group is, and detection slows down as the
+group grows past the budget.
+
+References
+Hayashibara et al., The phi accrual failure detector (2004)
+https://doc.akka.io/docs/akka/current/typed/failure-detector.html
+https://docs.python.org/3/library/socket.html#socket.socket.recvfrom
+"""
+
+import collections
+import math
+import socket
+import struct
+
+HEARTBEAT_INTERVAL = 0.02  # seconds between a leader's heartbeat ticks
+HEARTBEAT_BUDGET = 32  # most heartbeats a leader sends per tick
+PHI_THRESHOLD = 8.0  # suspicion level at which the leader is presumed dead
+WINDOW = 100  # heartbeat intervals remembered by a detector
+MIN_STD = 0.005  # floor on the interval std dev, so a perfectly regular leader isn't
+                 # suspected the moment one heartbeat is a little late
+ACCEPTABLE_PAUSE = 3  # heartbeat periods that may be lost in a row before phi rises
+PACKET = struct.Struct('!2siIQ')  # magic, leader's days_to_bd, su_id, election epoch
+GROUP_PACKET = struct.Struct('!2siIQI')  # the same plus the group id (hosted groups)
+MAGIC = b'HB'
+GROUP_MAGIC = b'HG'
+
+
+class PhiAccrual(object):
+    """
+    Phi accrual failure detector for one monitored process. Keeps a window of
+    inter-arrival times with running sums, so both heartbeat() and phi() are O(1).
+
+    >>> d = PhiAccrual(0.1)
+    >>> for t in range(10): d.heartbeat(t * 0.1)
+    >>> d.phi(0.95) < 1.0, d.phi(1.5) > PHI_THRESHOLD
+    (True, True)
+    """
+
+    def __init__(self, expected_interval, window=WINDOW, min_std=MIN_STD,
+                 acceptable_pause=0.0):
+        """
+        :param expected_interval: interval to assume until real ones are seen
+        :param window: inter-arrival times to remember
+        :param min_std: floor on the std dev used
+        :param acceptable_pause: seconds a heartbeat may be late beyond the mean
+                                 before any suspicion builds up
+        """
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.intervals = collections.deque(maxlen=window)
+        self.total = self.total_sq = 0.0
+        self.last = None
+        # bootstrap with the expected interval, give or take a quarter
+        for interval in (expected_interval * 0.75, expected_interval * 1.25):
+            self.add(interval)
+
+    def add(self, interval):
+        if len(self.intervals) == self.intervals.maxlen:
+            old = self.intervals[0]
+            self.total -= old
+            self.total_sq -= old * old
+        self.intervals.append(interval)
+        self.total += interval
+        self.total_sq += interval * interval
+
+    def heartbeat(self, now):
+        """ Record a heartbeat (or, the first time, the start of the lease) """
+        if self.last is not None:
+            self.add(now - self.last)
+        self.last = now
+
+    def phi(self, now):
+        """
+        :param now: current time, on the same clock as heartbeat()
+        :return: suspicion level, -log10 of the probability that a heartbeat this
+                 late would still arrive (0 means no suspicion at all)
+        """
+        if self.last is None:
+            return 0.0
+        n = len(self.intervals)
+        mean = self.total / n
+        std = max(self.min_std, math.sqrt(max(0.0, self.total_sq / n - mean * mean)))
+        mean += self.acceptable_pause
+        elapsed = now - self.last
+        y = (elapsed - mean) / std
+        try:
+            e = math.exp(-y * (1.5976 + 0.070566 * y * y))  # logistic approximation
+        except OverflowError:
+            return 0.0  # far earlier than expected
+        p = e / (1.0 + e) if elapsed > mean else 1.0 - 1.0 / (1.0 + e)
+        return math.inf if p <= 0.0 else -math.log10(p)
+
+
+class Heartbeats(object):
+    """
+    A node's UDP heartbeat socket plus a detector for each process it watches.
+    """
+
+    def __init__(self, address, interval=HEARTBEAT_INTERVAL, threshold=PHI_THRESHOLD,
+                 budget=HEARTBEAT_BUDGET, group=None, sock=None):
+        """
+        :param address: (host, port) to bind, normally the node's TCP listener address
+        :param interval: seconds between heartbeat ticks when leading
+        :param threshold: phi at which a watched process is suspected
+        :param budget: most heartbeats sent per tick
+        :param group: group id to tag heartbeats with, for a hosted group (else None)
+        :param sock: UDP socket shared with the other groups of a host (address is
+                     then ignored, and the host reads the socket), else None
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.budget = budget
+        self.group = group
+        self.shared = sock is not None
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(address)
+            sock.setblocking(False)
+        self.sock = sock
+        self.detectors = {}  # {pid: PhiAccrual, ...}
+        self.cursor = 0  # where the next tick's batch starts when over budget
+        self.sent = self.received = 0
+
+    def period(self, followers):
+        """
+        Seconds between heartbeats to each follower, for a leader with that many.
+
+        >>> h = Heartbeats(('127.0.0.1', 0), interval=0.02, budget=32)
+        >>> h.period(10), h.period(32), h.period(1000)
+        (0.02, 0.02, 0.64)
+        >>> h.close()
+        """
+        return self.interval * max(1, -(-followers // self.budget))
+
+    def batch(self, followers):
+        """
+        The followers to send heartbeats to this tick: all of them if they fit the
+        budget, otherwise the next budget of them in turn.
+
+        :param followers: [(pid, address), ...] everyone but the leader, in the same
+                          order every tick (the cursor walks along it)
+        :return: the ones to send to now
+        """
+        n = len(followers)
+        if n <= self.budget:
+            return followers
+        start = self.cursor % n
+        self.cursor = start + self.budget
+        chosen = followers[start:start + self.budget]
+        return chosen + followers[:self.budget - len(chosen)]
+
+    def send(self, pid, epoch, address):
+        """
+        Send one heartbeat.
+
+        :param pid: my pid (I am the leader)
+        :param epoch: election epoch that made me leader
+        :param address: member's (host, port)
+        """
+        if self.group is None:
+            packet = PACKET.pack(MAGIC, pid[0], pid[1], epoch)
+        else:
+            packet = GROUP_PACKET.pack(GROUP_MAGIC, pid[0], pid[1], epoch, self.group)
+        try:
+            self.sock.sendto(packet, address)
+            self.sent += 1
+        except OSError:
+            pass  # best effort, a missed heartbeat is what the detector is for
+
+    def receive(self):
+        """
+        Drain the socket.
+
+        :return: list of (leader pid, epoch) from the heartbeats that were waiting
+        """
+        return [(pid, epoch) for group, pid, epoch in receive_all(self.sock)
+                if group == self.group]
+
+    def watch(self, pid, now, followers=1):
+        """
+        Start (or restart) monitoring pid, counting its lease from now.
+
+        :param followers: how many followers pid has, which sets the heartbeat
+                          period to expect until real intervals are seen
+        """
+        period = self.period(followers)
+        detector = self.detectors[pid] = PhiAccrual(period,
+                                                    acceptable_pause=ACCEPTABLE_PAUSE * period)
+        detector.heartbeat(now)
+
+    def beat(self, pid, now):
+        """ Record a heartbeat from a watched pid """
+        detector = self.detectors.get(pid)
+        if detector is not None:
+            detector.heartbeat(now)
+
+    def suspect(self, pid, now):
+        """ True if pid is watched and has gone quiet for too long """
+        detector = self.detectors.get(pid)
+        return detector is not None and detector.phi(now) > self.threshold
+
+    def close(self):
+        if not self.shared:
+            self.sock.close()
+
+
+def receive_all(sock):
+    """
+    Drain a heartbeat socket.
+
+    :param sock: non-blocking UDP socket heartbeats are sent to
+    :return: list of (group id or None, leader pid, epoch) from the heartbeats that
+             were waiting
+    """
+    beats = []
+    while True:
+        try:
+            packet, _address = sock.recvfrom(GROUP_PACKET.size)
+        except (BlockingIOError, InterruptedError):
+            return beats
+        except OSError:
+            return beats  # e.g. ICMP port unreachable from an earlier send
+        if len(packet) == PACKET.size and packet[:2] == MAGIC:
+            _magic, days, su_id, epoch = PACKET.unpack(packet)
+            beats.append((None, (days, su_id), epoch))
+        elif len(packet) == GROUP_PACKET.size and packet[:2] == GROUP_MAGIC:
+            _magic, days, su_id, epoch, group = GROUP_PACKET.unpack(packet)
+            beats.append((group, (days, su_id), epoch))
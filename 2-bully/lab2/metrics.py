@@ -0,0 +1,156 @@
+"""
+Election Metrics
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Counters, histograms and gauges for a Bully node, readable while the node
+runs. A snapshot is a plain dict, served as JSON over HTTP (GET /metrics) and/or
+written to a file, replaced atomically so readers never see a partial file.
+Updates are cheap: a lock, a dict increment or a bisect into fixed buckets.
+
+References
+https://docs.python.org/3/library/http.server.html
+https://prometheus.io/docs/concepts/metric_types/
+"""
+
+import bisect
+import collections
+import http.server
+import json
+import os
+import threading
+
+# histogram bucket upper bounds in seconds: 100us, 200us, 500us, 1ms, ... 50s
+BUCKETS = tuple(scale * 10 ** exp for exp in range(-4, 2) for scale in (1, 2, 5))
+
+
+class Histogram(object):
+    """
+    Counts of observations per bucket, plus count, sum, min and max.
+
+    >>> h = Histogram()
+    >>> for ms in (1, 2, 3, 40): h.observe(ms / 1000)
+    >>> h.snapshot()['count'], round(h.snapshot()['p50'], 3)
+    (4, 0.002)
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last one is everything bigger
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th quantile (max if past the last) """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count, 'sum': self.total, 'min': self.min, 'max': self.max,
+            'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+            'buckets': {str(bound): n for bound, n in zip(self.bounds, self.counts) if n},
+        }
+
+
+class Metrics(object):
+    """
+    Named counters, histograms and gauges (callables read at snapshot time). Safe to
+    snapshot from another thread while the event loop updates it.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.gauges = {}  # {name: callable, ...}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def gauge(self, name, read):
+        """
+        :param name: gauge name
+        :param read: callable returning the current value
+        """
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """ Everything as a dict of plain values """
+        with self.lock:
+            snapshot = {
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.snapshot()
+                               for name, histogram in self.histograms.items()},
+            }
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception:  # e.g. a dict resized under us; skip this once
+                gauges[name] = None
+        snapshot['gauges'] = gauges
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True, default=str)
+
+    def write(self, path):
+        """ Write a snapshot to path, atomically """
+        tmp = '{}.tmp'.format(path)
+        with open(tmp, 'w') as f:
+            f.write(self.to_json())
+        os.replace(tmp, path)
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """
+        Serve GET /metrics as JSON from a background thread.
+
+        :return: (host, port) actually bound
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_json().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # no per-request logging
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
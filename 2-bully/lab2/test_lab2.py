@@ -6,9 +6,28 @@ This is free and unencumbered software released into the public domain.
 :brief: Testing file for lab2
 """
 
+import asyncio
+import json
+import os
+import pickle
+import socket
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
-from bully import Bully
-from gcd2 import GroupCoordinatorDaemon
+import urllib.request
+from datetime import datetime
+
+import codec
+from async_bully import AsyncBully
+import framing
+import gcd2
+from bully import Bully, State, upcoming_birthday
+from channel import OUTBOX_HIGH_WATER
+from election_sim import Network
+from gcd2 import GroupCoordinatorDaemon, ThreadedGroupCoordinator
+from groups import GroupHost
 
 GCD_ADDRESS = ('127.0.0.1', '22')
 NEXT_BIRTHDAY = '2023-06-28'
@@ -24,6 +43,8 @@ class TestLab2(unittest.TestCase):
     def tearDown(self):
         #print('tearDown')
         self.node.listener.close()
+        for channel in list(self.node.peers.values()):
+            channel.close()
 
     # test constructor
     print('### TEST __INIT__')
@@ -37,6 +58,13 @@ class TestLab2(unittest.TestCase):
         res = (262, 123456)
         self.assertEqual(self.node.pid, res)
 
+    def test_upcoming_birthday(self):
+        print('test_upcoming_birthday')
+        now = datetime(2023, 7, 1, 12)
+        self.assertEqual(upcoming_birthday('2020-01-01', now), '2024-01-01')
+        self.assertEqual(upcoming_birthday('1999-12-31', now), '2023-12-31')
+        self.assertEqual(upcoming_birthday('2023-07-01', now), '2024-07-01')  # today's is over
+
     def test_members_is_not_None(self):
         print('test_members_is_not_None')
         self.assertIsNotNone(self.node.members)
@@ -67,5 +95,666 @@ class TestLab2(unittest.TestCase):
     # print socket
     #print(self.node.cpr_sock(self.node.listener))
 
+    # test framing
+    print('### TEST FRAMING')
+    def test_receive_message_partial_frames(self):
+        print('test_receive_message_partial_frames')
+        theirs = socket.create_connection(self.node.listener_address)
+        self.node.listener.setblocking(True)
+        self.node.accept_peer()
+        channel, = self.node.peers.values()
+        ours = channel.sock
+        big_idea = {(i % 365 + 1, 1_000_000 + i): ('127.0.0.1', 10_000 + i)
+                    for i in range(2_000)}
+        hello = framing.frame(pickle.dumps(('HELLO', {(1, 654321): ('127.0.0.1', 1)})))
+        wire = framing.frame(pickle.dumps(('COORDINATOR', big_idea)))
+        theirs.sendall(hello + wire[:1500])
+        self.node.receive_message(ours)
+        self.assertEqual(channel.pid, (1, 654321))
+        self.assertEqual(len(self.node.members), 1)  # still waiting for the rest
+        theirs.sendall(wire[1500:])
+        while self.node.bully is None:
+            self.node.receive_message(ours)
+        self.assertEqual(len(self.node.members), len(big_idea) + 1)
+        self.assertEqual(self.node.bully, (1, 654321))
+        self.node.close_channel(channel, 'done')
+        theirs.close()
+
+    def test_congested_peer_gets_backpressure(self):
+        print('test_congested_peer_gets_backpressure')
+        theirs = socket.create_connection(self.node.listener_address)
+        self.node.listener.setblocking(True)
+        self.node.accept_peer()
+        channel, = self.node.peers.values()
+        big_idea = {(i % 365 + 1, 1_000_000 + i): ('127.0.0.1', 10_000 + i)
+                    for i in range(2_000)}
+        for _ in range(1_000):  # they never read, so the kernel buffers fill up
+            if not self.node.transmit(channel, ('COORDINATOR', big_idea)):
+                break
+        self.assertTrue(channel.congested())
+        self.assertLess(len(channel.outbox), 2 * OUTBOX_HIGH_WATER)
+        self.assertEqual(self.node.metrics.counters['dropped.congested.COORDINATOR'], 1)
+        self.assertIs(self.node.peers[channel.fd], channel)  # still open, just waiting
+        theirs.setblocking(False)
+        while channel.outbox:  # they catch up
+            try:
+                while theirs.recv(1 << 16):
+                    pass
+            except BlockingIOError:
+                pass
+            self.node.write_ready(channel)
+        self.assertTrue(self.node.transmit(channel, ('OK', None)))
+        self.node.close_channel(channel, 'done')
+        theirs.close()
+
+    def test_election_reuses_channels(self):
+        print('test_election_reuses_channels')
+        nodes = [self.node] + [Bully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID + i)
+                               for i in (1, 2)]
+        members = {node.pid: node.listener_address for node in nodes}
+        for node in nodes:
+            node.members = dict(members)
+
+        def elect(starter):
+            starter.start_election('test')
+            for _ in range(200):
+                for node in nodes:
+                    node.run_once(0.01)
+                if all(node.bully == nodes[-1].pid and not node.states
+                       for node in nodes):
+                    return
+            self.fail('no leader elected')
+
+        elect(nodes[0])
+        channels = {node.pid: set(node.peers) for node in nodes}
+        elect(nodes[0])
+        self.assertEqual(channels, {node.pid: set(node.peers) for node in nodes})
+        for node in nodes[1:]:
+            node.listener.close()
+            for channel in node.peers.values():
+                channel.close()
+
+    def test_heartbeats_detect_dead_leader(self):
+        print('test_heartbeats_detect_dead_leader')
+        nodes = [self.node] + [Bully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID + i)
+                               for i in (1, 2)]
+        members = {node.pid: node.listener_address for node in nodes}
+        for node in nodes:
+            node.members = dict(members)
+            node.start_heartbeats()
+
+        def run_until(up, leader, seconds):
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for node in up:
+                    node.run_once(0.005)
+                if all(node.bully == leader and not node.states for node in up):
+                    return
+            self.fail('{} not elected'.format(leader))
+
+        nodes[0].start_election('test')
+        run_until(nodes, nodes[2].pid, 2)
+        steady = time.monotonic() + 0.2  # heartbeats flowing, no false alarms
+        while time.monotonic() < steady:
+            for node in nodes:
+                node.run_once(0.005)
+        self.assertEqual([node.bully for node in nodes], [nodes[2].pid] * 3)
+        self.assertGreater(nodes[0].heartbeats.received, 0)
+        start = time.monotonic()
+        run_until(nodes[:2], nodes[1].pid, 2)  # nodes[2] stops running
+        self.assertLess(time.monotonic() - start, 1)
+        for node in nodes:
+            node.heartbeats.close()
+            if node is not self.node:
+                node.listener.close()
+                for channel in node.peers.values():
+                    channel.close()
+
+    def test_heartbeats_stay_in_budget(self):
+        print('test_heartbeats_stay_in_budget')
+        self.node.start_heartbeats(budget=8)
+        self.addCleanup(self.node.heartbeats.close)
+        self.node.members = {(i % 365 + 1, 1_000_000 + i): ('127.0.0.1', 9) for i in range(100)}
+        self.node.members[self.node.pid] = self.node.listener_address
+        self.node.bully = self.node.pid
+        for _ in range(13):  # ceil(100 / 8) ticks to go round everyone
+            self.node.heartbeat_tick()
+        self.assertEqual(self.node.heartbeats.sent, 13 * 8)
+        followers = sorted(pid for pid in self.node.members if pid != self.node.pid)
+        seen = set()
+        heartbeats = self.node.heartbeats
+        heartbeats.cursor = 0
+        for _ in range(13):
+            seen.update(pid for pid, _address in heartbeats.batch([(pid, None) for pid in followers]))
+        self.assertEqual(seen, set(followers))
+        self.assertAlmostEqual(heartbeats.period(len(followers)), 13 * heartbeats.interval)
+
+    def test_stale_heartbeats_ignored(self):
+        print('test_stale_heartbeats_ignored')
+        self.node.start_heartbeats()
+        self.addCleanup(self.node.heartbeats.close)
+        higher, leader = (self.node.pid[0], SUID + 2), (self.node.pid[0], SUID + 1)
+        self.node.set_leader(leader)
+        self.node.leader_epoch = 3
+        self.node.heartbeats_received([(higher, 2)])  # sent before it died, delayed
+        self.assertEqual(self.node.bully, leader)
+        self.node.heartbeats_received([(higher, 4)])  # it won an election I missed
+        self.assertEqual(self.node.bully, higher)
+        self.assertEqual(self.node.leader_epoch, 4)
+
+    def test_metrics(self):
+        print('test_metrics')
+        self.node.start_election('test')  # no members, so I win straight away
+        snapshot = self.node.metrics.snapshot()
+        self.assertEqual(snapshot['counters']['elections.won'], 1)
+        self.assertEqual(snapshot['histograms']['election_seconds']['count'], 1)
+        self.assertEqual(snapshot['gauges']['leader'], self.node.pid)
+        host, port = self.node.metrics.serve()
+        try:
+            with urllib.request.urlopen('http://{}:{}/metrics'.format(host, port)) as reply:
+                self.assertEqual(json.loads(reply.read())['counters']['elections.started'], 1)
+        finally:
+            self.node.metrics.close()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.json')
+            self.node.start_metrics_file(path)
+            self.node.check_timeouts()
+            with open(path) as f:
+                self.assertEqual(json.load(f)['gauges']['states'], 0)
+
+    def test_deadlines(self):
+        print('test_deadlines')
+        self.node.set_state(State.WAITING_FOR_OK)
+        self.assertLessEqual(self.node.deadlines.timeout(), 5)
+        self.assertEqual(self.node.deadlines.timeout(cap=0.5), 0.5)
+        self.node.check_timeouts()
+        self.assertIsNone(self.node.bully)  # not due yet
+        self.node.deadlines.schedule(self.node.me, 0)
+        self.node.check_timeouts()
+        self.assertEqual(self.node.bully, self.node.pid)  # no OK came, so I won
+        self.assertEqual(len(self.node.deadlines), 0)
+        self.assertIsNone(self.node.deadlines.timeout())
+
+    def test_gcd_pipelined_joins(self):
+        print('test_gcd_pipelined_joins')
+        ours, theirs = socket.socketpair()
+        framing.send_msg(ours, ('JOIN', ((100, 1_234_567), ('localhost', 40_000))))
+        framing.send_msg(ours, 'not a join')
+        ours.shutdown(socket.SHUT_WR)
+        server = ThreadedGroupCoordinator(('localhost', 0), GroupCoordinatorDaemon,
+                                          bind_and_activate=False)
+        self.addCleanup(server.server_close)
+        GroupCoordinatorDaemon(theirs, ('localhost', 0), server)
+        self.assertIn((100, 1_234_567), framing.recv_msg(ours))
+        self.assertEqual(framing.recv_msg(ours), 'Malformed message')
+        ours.close()
+
+    def test_gcd_single_threaded_one_join_per_connection(self):
+        print('test_gcd_single_threaded_one_join_per_connection')
+        server = socketserver.TCPServer(('localhost', 0), GroupCoordinatorDaemon)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        idle = socket.create_connection(server.server_address, timeout=2)
+        self.addCleanup(idle.close)
+        framing.send_msg(idle, ('JOIN', ((100, 1_234_567), ('localhost', 40_000))))
+        framing.recv_msg(idle)  # then keep it open, as a pooled client does
+        with socket.create_connection(server.server_address, timeout=2) as other:
+            framing.send_msg(other, ('JOIN', ((101, 1_234_568), ('localhost', 40_001))))
+            self.assertIn((101, 1_234_568), framing.recv_msg(other))
+
+class TestAsyncBully(unittest.TestCase):
+
+    def elect(self, nodes, down=()):
+        """ Run an election started by the lowest node; return each node's leader """
+        async def run():
+            members = {node.pid: node.listener_address for node in nodes}
+            for node in nodes:
+                node.members = dict(members)
+            up = [node for node in nodes if node not in down]
+            for node in up:
+                await node.start()
+            for node in down:
+                node.listener.close()
+            nodes[0].start_election('test')
+            try:
+                for _ in range(200):
+                    await asyncio.sleep(0.01)
+                    if all(node.bully is not None and not node.is_election_in_progress()
+                           for node in up):
+                        break
+                return [node.bully for node in up]
+            finally:
+                for node in up:
+                    await node.close()
+        return asyncio.run(run())
+
+    def test_highest_wins(self):
+        print('test_highest_wins')
+        nodes = [AsyncBully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID + i) for i in range(5)]
+        self.assertEqual(self.elect(nodes), [nodes[-1].pid] * 5)
+
+    def test_dead_highest_times_out(self):
+        print('test_dead_highest_times_out')
+        nodes = [AsyncBully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID + i, timeout=0.2)
+                 for i in range(3)]
+        self.assertEqual(self.elect(nodes, down=nodes[-1:]), [nodes[1].pid] * 2)
+
+    def test_mixed_with_selector_nodes(self):
+        print('test_mixed_with_selector_nodes')
+        # msgs carry digests (gossip) and epochs (coalescing) both ways, and the
+        # lowest node only learns of the highest one from MEMBERS gossip
+        nodes = [AsyncBully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID), Bully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID + 1),
+                 AsyncBully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID + 2), Bully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID + 3)]
+        selector_nodes = [node for node in nodes if not isinstance(node, AsyncBully)]
+        members = {node.pid: node.listener_address for node in nodes}
+        for node in nodes:
+            node.coalesce = True
+            node.members = {pid: listener for pid, listener in members.items()
+                            if node is not nodes[0] or pid != nodes[-1].pid}
+
+        async def run():
+            for node in nodes[0::2]:
+                await node.start()
+            nodes[0].start_election('test')
+            try:
+                for _ in range(300):
+                    await asyncio.sleep(0.005)
+                    for node in selector_nodes:
+                        node.run_once(0)
+                    if all(node.bully == nodes[-1].pid for node in nodes) and \
+                            not any(node.is_election_in_progress() for node in nodes):
+                        break
+            finally:
+                for node in nodes[0::2]:
+                    await node.close()
+                for node in selector_nodes:
+                    node.listener.close()
+                    for channel in list(node.peers.values()):
+                        channel.close()
+
+        asyncio.run(run())
+        self.assertEqual([node.bully for node in nodes], [nodes[-1].pid] * 4)
+        self.assertEqual(nodes[0].members, members)
+        self.assertEqual({node.leader_epoch for node in nodes}, {nodes[-1].epoch})
+
+
+class TestElectionSim(unittest.TestCase):
+
+    def test_highest_wins(self):
+        print('test_highest_wins')
+        network = Network(seed=1)
+        nodes = network.add_nodes(10)
+        result = network.elect(nodes[0])
+        self.assertTrue(result.converged)
+        self.assertEqual(result.leaders, {nodes[-1].pid: 10})
+        self.assertGreater(result.by_kind['ELECTION'], 0)
+
+    def test_leader_crash(self):
+        print('test_leader_crash')
+        network = Network(seed=2)
+        nodes = network.add_nodes(8)
+        network.elect(nodes[0])
+        network.crash(nodes[-1].pid)
+        result = network.elect(nodes[0])
+        self.assertTrue(result.converged)
+        self.assertEqual(result.leaders, {nodes[-2].pid: 7})
+
+    def test_partition(self):
+        print('test_partition')
+        network = Network(seed=3)
+        nodes = network.add_nodes(6)
+        network.partition([node.pid for node in nodes[:3]])
+        network.elect(nodes[0])
+        result = network.elect(nodes[3])
+        self.assertTrue(result.converged)
+        self.assertEqual(result.leaders, {nodes[2].pid: 3, nodes[-1].pid: 3})
+
+    def test_coalesce(self):
+        print('test_coalesce')
+        results = {}
+        for coalesce in (False, True):
+            network = Network(seed=5, coalesce=coalesce)
+            nodes = network.add_nodes(20)
+            results[coalesce] = network.elect(nodes[0])
+            self.assertTrue(results[coalesce].converged)
+        self.assertLess(results[True].messages, results[False].messages / 10)
+        self.assertLessEqual(results[True].by_kind['ELECTION'], 20)
+        # lost msgs (announcements included) are healed by timeouts and heartbeats
+        network = Network(seed=1, coalesce=True, loss=0.05, heartbeats=True)
+        nodes = network.add_nodes(30)
+        self.assertTrue(network.elect(nodes[0]).converged)
+        network.crash(nodes[-1].pid)
+        result = network.elect(nodes[0])
+        self.assertTrue(result.converged)
+        self.assertLess(result.messages, 10 * 30)  # no rounds of false suspicions
+
+    def test_no_election_cascade(self):
+        print('test_no_election_cascade')
+        # each node asks each higher one at most once, and the leader is announced
+        # about once per node, however the elections overlap
+        network = Network(seed=7)
+        nodes = network.add_nodes(30)
+        for result in (network.elect(nodes[0]), network.elect(nodes[10])):
+            self.assertTrue(result.converged)
+            self.assertLessEqual(result.by_kind['ELECTION'], 30 * 29 // 2)
+            self.assertLessEqual(result.by_kind['COORDINATOR'], 2 * 30)
+
+    def test_gossip(self):
+        print('test_gossip')
+        network = Network(seed=6)
+        nodes = network.add_nodes(6)
+        nodes[0].add_member((0, 1), ('10.9.9.9', 5000))  # only node 0 knows them
+        result = network.elect(nodes[0])
+        self.assertTrue(result.converged)
+        self.assertEqual({node.digest for node in nodes}, {nodes[0].digest})
+        self.assertTrue(all((0, 1) in node.members for node in nodes))
+        exchanged = network.stats['MEMBERS']
+        self.assertGreater(exchanged, 0)
+        network.elect(nodes[0])
+        self.assertEqual(network.stats['MEMBERS'], exchanged)  # digests all agree now
+
+    def test_deterministic(self):
+        print('test_deterministic')
+        results = []
+        for _ in range(2):
+            network = Network(loss=0.1, seed=4)
+            results.append(network.elect(network.add_nodes(12)[0])._replace(wall_seconds=0))
+        self.assertEqual(results[0], results[1])
+
+
+class TestGroups(unittest.TestCase):
+
+    def test_groups_share_a_listener(self):
+        print('test_groups_share_a_listener')
+        hosts = [GroupHost(NEXT_BIRTHDAY, SUID), GroupHost(NEXT_BIRTHDAY, SUID + 1)]
+        groups = (7, 8, 9)
+        try:
+            for group in groups:
+                nodes = [host.add_group(group) for host in hosts]
+                members = {node.pid: node.listener_address for node in nodes}
+                for node in nodes:
+                    node.members = dict(members)
+            for group in groups:
+                hosts[0].groups[group].start_election('test')
+            for _ in range(200):
+                if all(host.groups[group].bully is not None
+                       for host in hosts for group in groups):
+                    break
+                for host in hosts:
+                    host.run_once(0.01)
+            winner = hosts[1].groups[7].pid
+            self.assertEqual({host.groups[group].bully for host in hosts for group in groups},
+                             {winner})
+            # one link between the hosts, carrying a channel for each group
+            for host in hosts:
+                self.assertEqual(len(host.by_fd), 1)
+                link, = host.by_fd.values()
+                self.assertEqual(sorted(link.channels), list(groups))
+                for group in groups:
+                    self.assertIs(link.channels[group], host.groups[group].peers[link.fd])
+        finally:
+            for host in hosts:
+                host.close()
+
+    def test_legacy_group_with_standalone_bully(self):
+        print('test_legacy_group_with_standalone_bully')
+        hosts = [GroupHost(NEXT_BIRTHDAY, SUID + i) for i in (1, 2)]
+        standalone = Bully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID)
+        try:
+            for group in (0, 7):
+                nodes = [host.add_group(group) for host in hosts]
+                if group == 0:
+                    nodes.append(standalone)
+                members = {node.pid: node.listener_address for node in nodes}
+                for node in nodes:
+                    node.members = dict(members)
+                    if group == 0:
+                        node.start_heartbeats()
+            standalone.start_election('test')
+            hosts[0].groups[7].start_election('test')
+            winner = hosts[1].groups[0].pid
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:
+                for host in hosts:
+                    host.run_once(0.005)
+                standalone.run_once(0.005)
+                if standalone.heartbeats.received and all(
+                        host.groups[group].bully == winner for host in hosts for group in (0, 7)):
+                    break
+            self.assertEqual(standalone.bully, winner)
+            self.assertEqual({host.groups[group].bully for host in hosts for group in (0, 7)},
+                             {winner})
+            self.assertGreater(standalone.heartbeats.received, 0)
+            # the hosts' link carries both groups, tagged and untagged
+            link = hosts[0].links[winner]
+            self.assertEqual(sorted(link.channels), [0, 7])
+            with self.assertRaises(ValueError):
+                hosts[0].add_group(2 ** 31)
+        finally:
+            for host in hosts:
+                host.close()
+            standalone.heartbeats.close()
+            standalone.listener.close()
+            for channel in list(standalone.peers.values()):
+                channel.close()
+
+    def test_hosted_heartbeats(self):
+        print('test_hosted_heartbeats')
+        hosts = [GroupHost(NEXT_BIRTHDAY, SUID + i) for i in range(3)]
+        groups = (7, 8)
+        try:
+            for group in groups:
+                nodes = [host.add_group(group) for host in hosts]
+                members = {node.pid: node.listener_address for node in nodes}
+                for node in nodes:
+                    node.members = dict(members)
+                    node.start_heartbeats()
+
+            def run_until(up, leader, seconds):
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    for host in up:
+                        host.run_once(0.005)
+                    if all(host.groups[group].bully == leader and not host.groups[group].states
+                           for host in up for group in groups):
+                        return
+                self.fail('{} not elected'.format(leader))
+
+            for group in groups:
+                hosts[0].groups[group].start_election('test')
+            run_until(hosts, hosts[2].groups[7].pid, 2)
+            steady = time.monotonic() + 0.2  # heartbeats flowing, no false alarms
+            while time.monotonic() < steady:
+                for host in hosts:
+                    host.run_once(0.005)
+            for host in hosts[:2]:  # each group got its own leader's heartbeats
+                for group in groups:
+                    self.assertGreater(host.groups[group].heartbeats.received, 0)
+            start = time.monotonic()
+            run_until(hosts[:2], hosts[1].groups[7].pid, 2)  # hosts[2] stops running
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            for host in hosts:
+                host.close()
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_struct_round_trip(self):
+        print('test_struct_round_trip')
+        group = {(i % 365 + 1, 1_000_000 + i): ('127.0.0.1', 10_000 + i) for i in range(50)}
+        messages = ['JOIN', ('OK', None), ('ELECTION', group), ('COORDINATOR', {}),
+                    ('JOIN', ((100, 1_234_567), ('127.0.0.1', 40_000))),
+                    ('JOIN', ((100, 1_234_567), ('127.0.0.1', 40_000), None)),
+                    ('OK', None, 7), ('ELECTION', group, 2 ** 40),
+                    ('JOIN', ((100, 1_234_567), ('127.0.0.1', 40_000), ('0a1b2c3d', 9))),
+                    group, ('FULL', ('0a1b2c3d', 9), group),
+                    ('DELTA', ('0a1b2c3d', 9), group, [(1, 1_000_000)]),
+                    ('MEMBERS', group, None, 2 ** 63), ('OK', None, 3, 1)]
+        for message in messages:
+            payload = codec.encode(message, codec.STRUCT)
+            self.assertEqual(codec.decode(payload), (message, codec.STRUCT))
+
+    def test_unsupported_falls_back_to_pickle(self):
+        print('test_unsupported_falls_back_to_pickle')
+        for message in [('JOIN', ((100, 1_234_567), ('localhost', 40_000))),
+                        {'host': 'cs1', 'port': 1}, ('x', 1.5, None),
+                        ('find_successor', 12, None), [3, 1, 4, 1, 5]]:  # chord's
+            payload = codec.encode(message, codec.STRUCT)
+            self.assertEqual(codec.decode(payload), (message, codec.PICKLE))
+
+    def test_truncated_payload(self):
+        print('test_truncated_payload')
+        payload = codec.encode(('ELECTION', {(1, 1_000_000): ('127.0.0.1', 1)}))
+        with self.assertRaises(codec.CodecError):
+            codec.decode(payload[:-3])
+
+    def test_gcd_answers_in_request_codec(self):
+        print('test_gcd_answers_in_request_codec')
+        join = ('JOIN', ((100, 1_234_567), ('127.0.0.1', 40_000)))
+        for codec_name in (codec.STRUCT, codec.PICKLE):
+            ours, theirs = socket.socketpair()
+            framing.send_msg(ours, join, codec_name)
+            ours.shutdown(socket.SHUT_WR)
+            GroupCoordinatorDaemon(theirs, ('localhost', 0), None)
+            reply, reply_codec = codec.decode(framing.recv_frame(ours))
+            self.assertEqual(reply_codec, codec_name)
+            self.assertIn((100, 1_234_567), reply)
+            ours.close()
+
+    def test_gcd_rejects_in_request_codec(self):
+        print('test_gcd_rejects_in_request_codec')
+        join = codec.encode(('JOIN', ((100, 1_234_567), ('127.0.0.1', 40_000))), codec.PICKLE)
+        GroupCoordinatorDaemon.accept_pickle = False
+        self.addCleanup(setattr, GroupCoordinatorDaemon, 'accept_pickle', True)
+        for payload, codec_name, error in [(join, codec.PICKLE, 'not accepted'),
+                                           (bytes((codec.MAGIC, 99)), codec.STRUCT, 'unknown')]:
+            ours, theirs = socket.socketpair()
+            framing.send_frame(ours, payload)
+            ours.shutdown(socket.SHUT_WR)
+            GroupCoordinatorDaemon(theirs, ('localhost', 0), None)
+            reply, reply_codec = codec.decode(framing.recv_frame(ours))
+            self.assertEqual(reply_codec, codec_name)
+            self.assertIn(error, reply)
+            ours.close()
+
+
+class TestGCD(unittest.TestCase):
+
+    def setUp(self):
+        GroupCoordinatorDaemon.listeners_by_pid.clear()
+        GroupCoordinatorDaemon.pids_by_listener.clear()
+        GroupCoordinatorDaemon.pids_by_student.clear()
+        GroupCoordinatorDaemon.membership_log.clear()
+        GroupCoordinatorDaemon.cancel_snapshot_timer()
+        GroupCoordinatorDaemon.snapshot_path = None
+        GroupCoordinatorDaemon.snapshot_time = 0.0
+        GroupCoordinatorDaemon.resolved.clear()
+
+    tearDown = setUp
+
+    @staticmethod
+    def join(i):
+        return ('JOIN', ((i % 365 + 1, 1_000_000 + i), ('localhost', 20_000 + i)))
+
+    def test_threaded_concurrent_joins(self):
+        print('test_threaded_concurrent_joins')
+        server = ThreadedGroupCoordinator(('localhost', 0), GroupCoordinatorDaemon)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def client(first):
+            with socket.create_connection(server.server_address) as gcd:
+                for i in range(first, first + 25):
+                    framing.send_msg(gcd, self.join(i))
+                    framing.recv_msg(gcd)
+
+        clients = [threading.Thread(target=client, args=(25 * n,)) for n in range(8)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(len(GroupCoordinatorDaemon.listeners_by_pid), 200)
+
+    def test_snapshot_round_trip(self):
+        print('test_snapshot_round_trip')
+        path = os.path.join(tempfile.mkdtemp(), 'gcd.snapshot')
+        self.assertEqual(GroupCoordinatorDaemon.load_snapshot(path), 0)
+        for i in range(3):
+            GroupCoordinatorDaemon.handle_join(self.join(i))
+        GroupCoordinatorDaemon.save_snapshot(force=True)
+        group = dict(GroupCoordinatorDaemon.listeners_by_pid)
+        GroupCoordinatorDaemon.listeners_by_pid.clear()
+        self.assertEqual(GroupCoordinatorDaemon.load_snapshot(path), 3)
+        self.assertEqual(GroupCoordinatorDaemon.listeners_by_pid, group)
+
+    def test_delta_join(self):
+        print('test_delta_join')
+        handle_join = GroupCoordinatorDaemon.handle_join
+        handle_join(self.join(1))
+        name, token, members = handle_join(('JOIN', self.join(2)[1] + (None,)))
+        self.assertEqual(name, 'FULL')
+        self.assertEqual(len(members), 2)
+
+        # nothing new
+        self.assertEqual(handle_join(('JOIN', self.join(2)[1] + (token,))),
+                         ('DELTA', token, {}, []))
+
+        # same student comes back with a new pid, old one is removed
+        process_id, listener = self.join(3)[1]
+        moved = ((process_id[0] + 1, process_id[1]), listener)
+        handle_join(self.join(3))
+        name, new_token, added, removed = handle_join(('JOIN', moved + (token,)))
+        self.assertEqual(name, 'DELTA')
+        self.assertEqual(added, {moved[0]: ('127.0.0.1', listener[1])})
+        self.assertEqual(removed, [process_id])
+
+        # unknown epoch falls back to the whole group
+        name, _token, members = handle_join(('JOIN', moved + (('old', 1),)))
+        self.assertEqual(name, 'FULL')
+        self.assertEqual(members, GroupCoordinatorDaemon.listeners_by_pid)
+
+    def test_bully_applies_delta(self):
+        print('test_bully_applies_delta')
+        node = Bully(GCD_ADDRESS, NEXT_BIRTHDAY, SUID)
+        node.listener.close()
+        node.apply_membership(('FULL', ('e', 1), {(1, 1): ('h', 1), (2, 2): ('h', 2)}))
+        node.apply_membership(('DELTA', ('e', 3), {(3, 3): ('h', 3)}, [(1, 1)]))
+        self.assertEqual(node.members, {(2, 2): ('h', 2), (3, 3): ('h', 3)})
+        self.assertEqual(node.members_version, ('e', 3))
+        with self.assertRaises(TypeError):
+            node.apply_membership(('Malformed message', None))
+
+    def test_resolve_is_cached(self):
+        print('test_resolve_is_cached')
+        GroupCoordinatorDaemon.handle_join(self.join(1))
+        ip, expires = GroupCoordinatorDaemon.resolved['localhost']
+        GroupCoordinatorDaemon.handle_join(self.join(2))
+        self.assertEqual(GroupCoordinatorDaemon.resolved['localhost'], (ip, expires))
+
+        # once the TTL is up, the host is looked up again
+        GroupCoordinatorDaemon.resolved['localhost'] = ('10.0.0.1', time.monotonic() - 1)
+        self.assertEqual(GroupCoordinatorDaemon.resolve('localhost'), ip)
+        self.assertGreater(GroupCoordinatorDaemon.resolved['localhost'][1], expires)
+
+    def test_snapshot_trailing_write(self):
+        print('test_snapshot_trailing_write')
+        path = os.path.join(tempfile.mkdtemp(), 'gcd.snapshot')
+        GroupCoordinatorDaemon.load_snapshot(path)
+        interval, gcd2.SNAPSHOT_INTERVAL = gcd2.SNAPSHOT_INTERVAL, 0.1
+        try:
+            GroupCoordinatorDaemon.handle_join(self.join(1))  # written now
+            GroupCoordinatorDaemon.handle_join(self.join(2))  # too soon, left to the timer
+            with open(path, 'rb') as f:
+                self.assertEqual(len(pickle.load(f)[0]), 1)
+            time.sleep(0.3)
+            with open(path, 'rb') as f:
+                self.assertEqual(len(pickle.load(f)[0]), 2)
+            self.assertIsNone(GroupCoordinatorDaemon.snapshot_timer)
+        finally:
+            gcd2.SNAPSHOT_INTERVAL = interval
+
 if __name__ == '__main__':
     unittest.main()
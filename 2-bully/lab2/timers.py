@@ -0,0 +1,110 @@
+"""
+Peer Deadlines
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: A heap of deadlines on time.monotonic(), one per key (a peer socket, or the
+node itself). The event loop asks for the next deadline to know how long it may
+sleep in select, and pops only the entries that are due. Rescheduling or cancelling
+a key leaves its old heap entry behind, and that entry is skipped when it reaches the
+top, so both cost O(log n) and nothing is ever scanned.
+
+References
+https://docs.python.org/3/library/heapq.html (see "Priority Queue Implementation Notes")
+https://docs.python.org/3/library/time.html#time.monotonic
+"""
+
+import heapq
+import itertools
+import time
+
+
+class Deadlines(object):
+    """
+    Deadline per key, earliest first.
+
+    >>> d = Deadlines()
+    >>> d.schedule('a', 5.0, now=0.0); d.schedule('b', 1.0, now=0.0)
+    >>> d.schedule('b', 9.0, now=0.0)  # pushes b's deadline back
+    >>> d.next_deadline(), d.expired(now=6.0)
+    (5.0, ['a'])
+    """
+
+    def __init__(self):
+        self.heap = []  # [(deadline, sequence, key), ...] including stale entries
+        self.deadlines = {}  # {key: deadline, ...} the live ones
+        self.sequence = itertools.count()  # tie breaker so keys are never compared
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, delay, now=None):
+        """
+        Set (or reset) key's deadline to delay seconds from now.
+
+        :param key: hashable
+        :param delay: seconds
+        :param now: current time.monotonic() if already known
+        """
+        self.schedule_at(key, (time.monotonic() if now is None else now) + delay)
+
+    def schedule_at(self, key, deadline):
+        """
+        Set (or reset) key's deadline to the given time (nothing to do if unchanged).
+
+        :param key: hashable
+        :param deadline: time.monotonic() value
+        """
+        if self.deadlines.get(key) == deadline:
+            return
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.sequence), key))
+
+    def cancel(self, key):
+        """ Forget key's deadline, if it has one """
+        self.deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """
+        :return: earliest live deadline, or None if there are none
+        """
+        heap = self.heap
+        while heap:
+            deadline, _seq, key = heap[0]
+            if self.deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(heap)  # cancelled or rescheduled since
+        return None
+
+    def timeout(self, cap=None, now=None):
+        """
+        How long select may wait before the next deadline is due.
+
+        :param cap: longest wait to allow (None means no limit)
+        :param now: current time.monotonic() if already known
+        :return: seconds (0 if something is already due), or cap if nothing is scheduled
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return cap
+        wait = max(0.0, deadline - (time.monotonic() if now is None else now))
+        return wait if cap is None else min(wait, cap)
+
+    def expired(self, now=None):
+        """
+        Remove and return every key whose deadline has passed.
+
+        :param now: current time.monotonic() if already known
+        :return: list of keys, earliest deadline first
+        """
+        now = time.monotonic() if now is None else now
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                return due
+            _deadline, _seq, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            due.append(key)
@@ -0,0 +1,215 @@
+"""
+Incremental Arbitrage Detector
+:authors: Narissa Tsuboi
+:version: 1
+:brief: Finds negative cycles (arbitrage) in the MarketGraph as quotes arrive,
+without running Bellman-Ford over the whole graph for every datagram.
+
+The detector keeps a potential per currency such that every edge a->b satisfies
+potential[b] <= potential[a] + weight (the distances of a Bellman-Ford run from a
+virtual source connected to everything). Such potentials exist exactly when there is
+no negative cycle. When a quote changes an edge, only that edge can break the
+invariant:
+
+- if it still holds, nothing else needs to be looked at (the common case);
+- if not, a Dijkstra search on reduced costs (potential[a] + weight - potential[b],
+  which are >= 0 for every other edge) starts at the edge's end and goes only as far
+  as the violation. If it reaches the edge's start, that path plus the edge is a
+  negative cycle. Otherwise the potentials of just the vertices it reached are
+  lowered, and the invariant holds again.
+
+All of this is up to tolerance: violations smaller than that are left alone, so
+rounding error never sends a search across the whole graph.
+
+Removing an edge can't break the invariant. After a cycle has been found the
+potentials are left as they are; the cycle is reported while it lasts, and once it
+is gone the potentials are rebuilt with a full pass. For markets of
+VECTOR_MIN_CURRENCIES or more that pass is done by VectorBellmanFord when NumPy is
+installed (below that its per-call overhead costs more than it saves).
+
+References
+Ramalingam, Song, Joskowicz and Miller, Solving systems of difference constraints
+incrementally (1999)
+https://en.wikipedia.org/wiki/Johnson%27s_algorithm (reweighting by potentials)
+"""
+import heapq
+
+try:
+    from bellman_ford_np import VectorBellmanFord
+except ImportError:  # NumPy not installed, the pure Python pass does it all
+    VectorBellmanFord = None
+
+INF = float('inf')
+VECTOR_MIN_CURRENCIES = 20  # rebuild with the NumPy engine (if present) from this many up
+
+
+class ArbitrageDetector(object):
+
+    def __init__(self, graph, tolerance=1e-10):
+        """
+        :param graph: MarketGraph with -log(rate) weights, shared with (and updated
+                      by) the caller, who calls edge_updated after changing an edge
+        :param tolerance: cycles that lose less than this are not reported
+        """
+        self.graph = graph
+        self.tolerance = tolerance
+        self.potential = []  # potential of each currency id, valid while cycle is None
+        self.cycle = None  # last negative cycle found, [a, b, ..., a]
+        self.rebuild()
+
+    def edge_updated(self, slot):
+        """
+        Check an edge that was just added or changed.
+
+        :param slot: the edge's MarketGraph slot
+        :return: negative cycle through the edge a->b, [b, ..., a, b], or None
+        """
+        if self.cycle is not None:
+            return None  # potentials are stale until check() rebuilds them
+        graph, tolerance = self.graph, self.tolerance
+        potential = self.potential
+        potential.extend([0.0] * (len(graph) - len(potential)))  # new currencies
+        a, b = graph.src[slot], graph.dst[slot]
+        delta = potential[b] - (potential[a] + graph.weight[slot])  # violation
+        if delta <= tolerance:
+            return None
+
+        # Dijkstra from b on reduced costs, only as far as the violation (less tolerance)
+        dst, weight, out = graph.dst, graph.weight, graph.out
+        limit = delta - tolerance
+        reached = {}  # {currency id: reduced distance from b, ...}
+        best = {b: 0.0}
+        parent = {}
+        heap = [(0.0, b)]
+        while heap:
+            distance, x = heapq.heappop(heap)
+            if x in reached:
+                continue
+            reached[x] = distance
+            if x == a:
+                self.cycle = [graph.names[i] for i in self.trace(parent, a, b)]
+                return self.cycle
+            px = potential[x]
+            for edge in out[x]:
+                y = dst[edge]
+                if y in reached:
+                    continue
+                through = distance + max(0.0, px + weight[edge] - potential[y])
+                if through < limit and through < best.get(y, INF):
+                    best[y] = through
+                    parent[y] = x
+                    heapq.heappush(heap, (through, y))
+
+        for x, distance in reached.items():
+            potential[x] -= delta - distance
+        return None
+
+    @staticmethod
+    def trace(parent, a, b):
+        """ The cycle [b, ..., a, b] made of the search path from b to a plus a->b """
+        path = [a]
+        while path[-1] != b:
+            path.append(parent[path[-1]])
+        path.reverse()
+        path.append(b)
+        return path
+
+    def check(self):
+        """
+        Called once the graph is up to date (e.g. after stale quotes are removed).
+
+        :return: a negative cycle, [a, b, ..., a], or None if there is no arbitrage
+        """
+        if self.cycle is None:
+            return None
+        if self.cycle_weight(self.cycle) < -self.tolerance:
+            return self.cycle
+        return self.rebuild()
+
+    def cycle_weight(self, cycle):
+        """ Sum of weights around cycle, inf if any of its edges is gone """
+        total = 0.0
+        for a, b in zip(cycle, cycle[1:]):
+            slot = self.graph.find(a, b)
+            if slot is None:
+                return INF
+            total += self.graph.weight[slot]
+        return total
+
+    def rebuild(self):
+        """
+        Recompute the potentials with a full Bellman-Ford pass from a virtual source.
+
+        :return: a negative cycle, [a, b, ..., a], or None (and the potentials valid)
+        """
+        graph = self.graph
+        n = len(graph)
+        cycle = None
+        if VectorBellmanFord is not None and n >= VECTOR_MIN_CURRENCIES:
+            bf = VectorBellmanFord.from_edges(graph.names, *graph.arrays())
+            potential, prev, changed = bf.potentials(self.tolerance)
+            potential, prev = potential.tolist(), prev.tolist()
+            if changed is not None:
+                cycle = self.find_cycle(prev, changed)
+                if cycle is None:  # lost in rounding: let the in-place pass decide
+                    potential, prev, changed = self.relax_all()
+        else:
+            potential, prev, changed = self.relax_all()
+
+        self.potential = potential
+        if changed is None:
+            self.cycle = None
+            return None
+        if cycle is None:
+            cycle = self.find_cycle(prev, changed)
+        self.cycle = None if cycle is None else [graph.names[i] for i in cycle]
+        return self.cycle
+
+    def relax_all(self):
+        """
+        The pure Python pass: Bellman-Ford from a virtual source, updating in place.
+
+        :return: potentials, predecessors (-1 for none), and a currency id still
+                 relaxing after V rounds or None
+        """
+        tolerance = self.tolerance
+        n = len(self.graph)
+        potential = [0.0] * n
+        prev = [-1] * n
+        edges = list(zip(*self.graph.arrays()))
+        changed = None
+        for _ in range(n):
+            changed = None
+            for a, b, weight in edges:
+                if potential[a] + weight < potential[b] - tolerance:
+                    potential[b] = potential[a] + weight
+                    prev[b] = a
+                    changed = b
+            if changed is None:
+                break
+        return potential, prev, changed
+
+    @staticmethod
+    def find_cycle(prev, changed):
+        """
+        The negative cycle among the predecessors of a currency still relaxing after
+        V rounds.
+
+        :return: the cycle's currency ids, [a, b, ..., a], or None if the walk back
+                 runs out of predecessors
+        """
+        n = len(prev)
+        x = changed
+        for _ in range(n):  # walk back far enough to be on the cycle
+            x = prev[x]
+            if x < 0:
+                return None
+        cycle, y = [x], prev[x]
+        while y != x:
+            if y < 0 or len(cycle) > n:
+                return None
+            cycle.append(y)
+            y = prev[y]
+        cycle.append(x)
+        cycle.reverse()
+        return cycle
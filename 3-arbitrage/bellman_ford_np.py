@@ -0,0 +1,154 @@
+"""
+Vectorized Bellman-Ford Implementation
+:authors: Narissa Tsuboi
+:version: 1
+:brief: Same contract as bellman_ford.BellmanFord, for markets with hundreds of
+currencies. The graph is turned into edge arrays (src index, dst index, weight)
+sorted by dst, and each relaxation round is a handful of NumPy operations over all
+the edges at once: candidate distances dist[src] + weight, then the best candidate
+per dst with np.minimum.reduceat. Rounds stop as soon as one improves nothing, so
+for a market with no arbitrage it takes only as many rounds as the longest shortest
+path has edges, not V - 1.
+
+Each round relaxes from the distances at the start of the round (BellmanFord
+updates in place as it goes). After V - 1 rounds the distances are the same, and so
+is the answer to whether there is a negative cycle.
+
+Requires NumPy.
+
+References
+https://numpy.org/doc/stable/reference/generated/numpy.ufunc.reduceat.html
+https://en.wikipedia.org/wiki/Bellman%E2%80%93Ford_algorithm
+"""
+import numpy as np
+
+# commonly used dict keys
+TIMESTAMP, CROSS, PRICE = 'timestamp', 'cross', 'price'
+
+
+class VectorBellmanFord(object):
+
+    def __init__(self, graph):
+        """ Builds the edge arrays from a graph of the form
+        {currency_a: {currency_b: {PRICE: weight, ...}, ...}, ...}
+        (from_edges takes a MarketGraph's arrays)
+        """
+        vertices = list(graph)
+        index = {vertex: i for i, vertex in enumerate(vertices)}
+        src, dst, weight = [], [], []
+        for currency_a, edges in graph.items():
+            for currency_b, edge in edges.items():
+                src.append(index[currency_a])
+                dst.append(index[currency_b])
+                weight.append(edge[PRICE])
+        self.set_edges(vertices, src, dst, weight)
+
+    @classmethod
+    def from_edges(cls, vertices, src, dst, weight):
+        """
+        Builds the solver straight from edge arrays.
+
+        :param vertices: vertex names, indexed by the ints in src and dst
+        :param src: start vertex index of each edge
+        :param dst: end vertex index of each edge
+        :param weight: weight of each edge
+        """
+        bf = cls.__new__(cls)
+        bf.set_edges(list(vertices), src, dst, weight)
+        return bf
+
+    def set_edges(self, vertices, src, dst, weight):
+        """ Store the edges sorted by dst, with where each dst's run of edges starts """
+        self.vertices = vertices
+        self.index = {vertex: i for i, vertex in enumerate(vertices)}
+        self.num_vertices = len(vertices)
+        dst = np.asarray(dst, dtype=np.intp)
+        order = np.argsort(dst, kind='stable')
+        self.src = np.asarray(src, dtype=np.intp)[order]
+        self.dst = dst[order]
+        self.weight = np.asarray(weight, dtype=np.float64)[order]
+        if len(self.dst):
+            self.starts = np.flatnonzero(np.r_[True, self.dst[1:] != self.dst[:-1]])
+        else:
+            self.starts = np.empty(0, dtype=np.intp)
+        self.heads = self.dst[self.starts]  # the dst of each run
+        self.counts = np.diff(np.r_[self.starts, len(self.dst)])
+
+    def shortest_paths(self, start_vertex, tolerance=0):
+        """
+        Finds the shortest paths (sum of edge weights) from start_vertex to every other
+        vertex, and reports a negative cycle edge if there is one. See
+        BellmanFord.shortest_paths for the meaning of tolerance.
+
+        :param start_vertex: start of all paths
+        :param tolerance: only if a path is more than tolerance will it be relaxed
+        :return: distance, predecessor, negative cycle
+            distance: dictionary keyed by vertex of shortest distance from start_vertex to
+            that vertex
+            predecessor: dictionary keyed by vertex of previous vertex in shortest path
+            from start_vertex
+            negative_cycle: None if no negative cycle, otherwise an edge (u, v)
+        """
+        dist, prev, negative_cycle = self.solve(self.index[start_vertex], tolerance)
+        vertices = self.vertices
+        return (dict(zip(vertices, dist.tolist())),
+                {v: None if p < 0 else vertices[p] for v, p in zip(vertices, prev.tolist())},
+                negative_cycle)
+
+    def solve(self, start, tolerance=0):
+        """
+        shortest_paths on vertex indexes, leaving the results as arrays.
+
+        :param start: index of the start vertex
+        :param tolerance: as for shortest_paths
+        :return: dist array, prev array (-1 for none), negative cycle (u, v) or None
+        """
+        dist = np.full(self.num_vertices, np.inf)
+        dist[start] = 0.0
+        prev = np.full(self.num_vertices, -1, dtype=np.intp)
+        if self.relax(dist, prev, self.num_vertices - 1, tolerance) is None:
+            return dist, prev, None
+        src, dst = self.src, self.dst
+        violated = np.flatnonzero(dist[src] + self.weight + tolerance < dist[dst])
+        if len(violated) == 0:
+            return dist, prev, None
+        edge = violated[0]
+        return dist, prev, (self.vertices[src[edge]], self.vertices[dst[edge]])
+
+    def potentials(self, tolerance=0):
+        """
+        Shortest distances from a virtual source with a zero-weight edge to every
+        vertex (so all start at 0), as the ArbitrageDetector keeps them.
+
+        :param tolerance: as for shortest_paths
+        :return: dist array, prev array (-1 for none), and a vertex index still
+                 improving after num_vertices rounds (so a negative cycle is among its
+                 predecessors) or None
+        """
+        dist = np.zeros(self.num_vertices)
+        prev = np.full(self.num_vertices, -1, dtype=np.intp)
+        return dist, prev, self.relax(dist, prev, self.num_vertices, tolerance)
+
+    def relax(self, dist, prev, rounds, tolerance):
+        """
+        Relax all edges at once, up to rounds times, updating dist and prev in place.
+
+        :return: None if a round improved nothing, else the index of a vertex the last
+                 round improved (-1 if rounds is 0)
+        """
+        src, dst, weight, heads = self.src, self.dst, self.weight, self.heads
+        if not len(dst):
+            return None
+        improved = -1
+        for _ in range(rounds):
+            candidate = dist[src] + weight
+            best = np.minimum.reduceat(candidate, self.starts)
+            better = best + tolerance < dist[heads]
+            if not better.any():
+                return None
+            # an edge achieving its dst's best becomes the dst's predecessor
+            hit = np.repeat(better, self.counts) & (candidate == np.repeat(best, self.counts))
+            prev[dst[hit]] = src[hit]
+            dist[heads[better]] = best[better]
+            improved = int(heads[better][0])
+        return improved
@@ -0,0 +1,101 @@
+"""
+Bellman-Ford Benchmark
+:authors: Narissa Tsuboi
+:version: 1
+:brief: Times BellmanFord (pure Python) against VectorBellmanFord (NumPy) on random
+markets of 10 to 1,000 currencies. Each currency is quoted against DEGREE others,
+both ways. Rates follow one hidden value per currency, so there is no arbitrage
+except a single planted cycle when --arbitrage is given. The two engines are checked
+to agree before anything is timed. The pure Python engine is skipped above
+--max-python currencies, since it always runs V - 1 full rounds.
+
+Usage:
+    python bf_bench.py [--arbitrage] [--max-python N] [CURRENCIES ...]
+
+References
+https://docs.python.org/3/library/timeit.html
+"""
+
+import argparse
+import math
+import random
+import timeit
+
+from bellman_ford import BellmanFord, PRICE, TIMESTAMP
+from bellman_ford_np import VectorBellmanFord
+
+DEFAULT_SIZES = (10, 30, 100, 300, 1000)
+DEGREE = 8  # markets quoted per currency
+SEED = 5220
+
+
+def market(n, arbitrage=False, degree=DEGREE, seed=SEED):
+    """
+    A random market graph in the form Lab3 builds: edge weights are -log(rate).
+
+    :param n: number of currencies (the first is 'USD')
+    :param arbitrage: if True, make one 3-cycle through USD profitable
+    :return: {currency_a: {currency_b: {TIMESTAMP: None, PRICE: weight}, ...}, ...}
+    """
+    rng = random.Random(seed)
+    names = ['USD'] + ['C{:04d}'.format(i) for i in range(1, n)]
+    value = {name: math.log(rng.uniform(0.5, 2.0)) for name in names}
+    graph = {name: {} for name in names}
+
+    def quote(a, b, weight):
+        graph[a][b] = {TIMESTAMP: None, PRICE: weight}
+        graph[b][a] = {TIMESTAMP: None, PRICE: -weight}
+
+    for i, a in enumerate(names):
+        quote(a, names[(i + 1) % n], value[a] - value[names[(i + 1) % n]])  # connected
+        for b in rng.sample(names, min(degree, n)):
+            if b != a:
+                quote(a, b, value[a] - value[b])
+    if arbitrage and n >= 3:
+        a, b = names[1], names[2]
+        quote('USD', a, value['USD'] - value[a])
+        quote(a, b, value[a] - value[b])
+        graph[b]['USD'] = {TIMESTAMP: None, PRICE: value[b] - value['USD'] - 0.01}
+    return graph
+
+
+def seconds_per_solve(make, min_time=0.2):
+    """ Best mean seconds per call of make().shortest_paths('USD') """
+    timer = timeit.Timer(lambda: make().shortest_paths('USD', 1e-10))
+    number, _elapsed = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def main(sizes, arbitrage, max_python):
+    print('{:>10} {:>8} {:>12} {:>12} {:>9}'.format(
+        'currencies', 'edges', 'python ms', 'numpy ms', 'speedup'))
+    for n in sizes:
+        graph = market(n, arbitrage)
+        edges = sum(len(edges) for edges in graph.values())
+        vector = VectorBellmanFord(graph).shortest_paths('USD', 1e-10)
+        python_ms = None
+        if n <= max_python:
+            python = BellmanFord(graph).shortest_paths('USD', 1e-10)
+            assert (python[2] is None) == (vector[2] is None), n
+            if python[2] is None:
+                assert all(abs(python[0][v] - vector[0][v]) < 1e-9 for v in graph), n
+            python_ms = seconds_per_solve(lambda: BellmanFord(graph)) * 1e3
+        numpy_ms = seconds_per_solve(lambda: VectorBellmanFord(graph)) * 1e3
+        print('{:>10,} {:>8,} {:>12} {:>12,.3f} {:>9}'.format(
+            n, edges,
+            '-' if python_ms is None else '{:,.3f}'.format(python_ms),
+            numpy_ms,
+            '-' if python_ms is None else '{:,.1f}x'.format(python_ms / numpy_ms)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bellman-Ford benchmark')
+    parser.add_argument('sizes', type=int, nargs='*', default=DEFAULT_SIZES,
+                        help='numbers of currencies')
+    parser.add_argument('--arbitrage', action='store_true',
+                        help='plant one negative cycle (forces V - 1 rounds)')
+    parser.add_argument('--max-python', type=int, default=300,
+                        help='largest market to time the pure Python engine on')
+    args = parser.parse_args()
+    main(args.sizes, args.arbitrage, args.max_python)
@@ -3,13 +3,23 @@ Forex Provider
 (c) all rights reserved
 
 This module contains useful marshalling functions for manipulating Forex Provider packet contents.
+
+marshal_message packs every quote straight into one preallocated buffer with
+struct.pack_into (the reserved bytes are already zero), in a single pass. The
+message is built once per tick and the same bytes are sent to every subscriber.
 """
 import ipaddress
+import struct
 from array import array
-from datetime import datetime
+from datetime import datetime, timedelta
 
 MAX_QUOTES_PER_MESSAGE = 50
 MICROS_PER_SECOND = 1_000_000
+QUOTE_SZ = 32  # bytes per quote in a message
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+QUOTE_HEAD = struct.Struct('>Q6s')  # big-endian micros since EPOCH, cross codes
+QUOTE_PRICE = struct.Struct('<d')  # little-endian price, at QUOTE_HEAD.size
 
 
 def serialize_price(x: float) -> bytes:
@@ -55,11 +65,18 @@ def serialize_utcdatetime(utc: datetime) -> bytes:
     :param utc: timestamp to convert to desired byte format
     :return: 8-byte stream
     """
-    epoch = datetime(1970, 1, 1)
-    micros = (utc - epoch).total_seconds() * MICROS_PER_SECOND
-    a = array('Q', [int(micros)])
-    a.byteswap()  # convert to big-endian
-    return a.tobytes()
+    return utc_micros(utc).to_bytes(8, 'big')
+
+
+def utc_micros(utc: datetime) -> int:
+    """
+    Whole microseconds from 00:00:00 UTC on 1 January 1970 to utc (integer
+    arithmetic, so no float rounding).
+
+    >>> utc_micros(datetime(1971, 12, 10, 1, 2, 3, 64000))
+    61174923064000
+    """
+    return (utc - EPOCH) // ONE_MICROSECOND
 
 
 def marshal_message(quote_sequence) -> bytes:
@@ -80,16 +97,18 @@ def marshal_message(quote_sequence) -> bytes:
     """
     if len(quote_sequence) > MAX_QUOTES_PER_MESSAGE:
         raise ValueError('max quotes exceeded for a single message')
-    message = bytes()
-    default_time = serialize_utcdatetime(datetime.utcnow())
-    padding = b'\x00' * 10  # 10 bytes of zeros
+    message = bytearray(len(quote_sequence) * QUOTE_SZ)  # zeros, incl. the padding
+    default_time = None
+    offset = 0
     for quote in quote_sequence:
         if 'timestamp' in quote:
-            message += serialize_utcdatetime(quote['timestamp'])
+            micros = utc_micros(quote['timestamp'])
         else:
-            message += default_time
-        message += quote['cross'][0:3].encode('utf-8')
-        message += quote['cross'][4:7].encode('utf-8')
-        message += serialize_price(quote['price'])
-        message += padding
-    return message
+            if default_time is None:
+                default_time = utc_micros(datetime.utcnow())
+            micros = default_time
+        cross = quote['cross']
+        QUOTE_HEAD.pack_into(message, offset, micros, (cross[0:3] + cross[4:7]).encode('utf-8'))
+        QUOTE_PRICE.pack_into(message, offset + QUOTE_HEAD.size, quote['price'])
+        offset += QUOTE_SZ
+    return bytes(message)
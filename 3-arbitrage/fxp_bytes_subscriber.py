@@ -6,15 +6,41 @@
 mirror the serialize and deserialize utility functions for the corresponding provider
 class forex_provider_v2.py.
 
+unmarshal_quotes decodes a whole datagram at once into columns (epoch micros, cross
+codes, prices) instead of a dict per quote. With NumPy the columns are views of the
+datagram through a structured dtype, so nothing is copied; without it they come from
+one struct.iter_unpack pass. Records are only built (as the same dicts
+unmarshall_msg returns) for the quotes that are looked at one by one.
+
 References:
 Python Arrays for byte manip https://docs.python.org/3/library/array.html
+https://docs.python.org/3/library/struct.html#struct.iter_unpack
+https://numpy.org/doc/stable/user/basics.rec.html
 """
 
 import datetime
 import socket
+import struct
 from array import array
 from datetime import datetime, timedelta
 
+try:
+    import numpy as np
+except ImportError:  # the struct decoder does the same job, a bit slower
+    np = None
+
+TIMESTAMP, CROSS, PRICE = 'timestamp', 'cross', 'price'
+QUOTE_SZ = 32  # bytes per quote in a datagram
+EPOCH = datetime(1970, 1, 1)
+
+# one quote: big-endian micros, ASCII cross, little-endian price, 10 reserved bytes
+QUOTE = struct.Struct('<8s6sd10x')  # (micros are converted from big-endian after)
+if np is not None:
+    QUOTE_DTYPE = np.dtype([('micros', '>u8'), ('cross', 'S6'), ('price', '<f8'),
+                            ('reserved', 'V10')])
+
+_crosses = {}  # {b'GBPUSD': 'GBP/USD', ...} each cross code decoded only once
+
 
 def deserialize_price(b: bytes) -> float:
     """
@@ -118,6 +144,70 @@ def unmarshall_msg(b: bytes) -> list:
     return quote_list
 
 
+def cross_name(code: bytes) -> str:
+    """
+    Cached deserialize_cross.
+
+    :param code: 6 ASCII bytes, eg b'GBPUSD'
+    :return: eg 'GBP/USD'
+    """
+    name = _crosses.get(code)
+    if name is None:
+        name = _crosses[code] = deserialize_cross(code)
+    return name
+
+
+class Quotes(object):
+    """
+    The quotes of one datagram as columns, with a lazy record view: quotes[i] (and
+    iterating) gives the same dicts unmarshall_msg does.
+    """
+    __slots__ = ('micros', 'crosses', 'prices')
+
+    def __init__(self, micros, crosses, prices):
+        """
+        :param micros: UTC timestamps, microseconds since 1970
+        :param crosses: 6-byte cross codes, eg b'GBPUSD'
+        :param prices: exchange rates
+        """
+        self.micros = micros
+        self.crosses = crosses
+        self.prices = prices
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getitem__(self, i):
+        return {TIMESTAMP: EPOCH + timedelta(microseconds=int(self.micros[i])),
+                CROSS: cross_name(bytes(self.crosses[i])),
+                PRICE: float(self.prices[i])}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def unmarshal_quotes(b: bytes) -> Quotes:
+    """
+    Unmarshall a whole msg from the Forex provider into columns. Trailing bytes that
+    don't make up a whole quote are ignored, like unmarshall_msg does.
+
+    :param b: datagram of 32-byte quotes (see unmarshall_msg for the layout)
+    :return: Quotes (NumPy arrays viewing b if NumPy is installed)
+    """
+    n_quotes = len(b) // QUOTE_SZ
+    if np is not None:
+        records = np.frombuffer(b, QUOTE_DTYPE, count=n_quotes)
+        return Quotes(records['micros'], records['cross'], records['price'])
+    view = memoryview(b)[:n_quotes * QUOTE_SZ]
+    micros, crosses, prices = array('Q'), [], array('d')
+    for b_time, b_cross, price in QUOTE.iter_unpack(view):
+        micros.append(int.from_bytes(b_time, 'big'))
+        crosses.append(b_cross)
+        prices.append(price)
+    return Quotes(micros, crosses, prices)
+
+
 if __name__ == '__main__':
     address = ('127.0.0.1', 0)
     ser_address = serialize_address(address)
@@ -5,17 +5,27 @@ Lab 3 Arbitrage Detector (aka forex_subscriber)
 :brief:
 
 provider represents publisher in the sub/pub algorithm
-References
 
+The subscriber runs one selector loop over its UDP listener with two deadlines:
+renewing the subscription (every RENEWAL_INTERVAL, well before the provider drops
+it after SUBSCRIPTION_TIME, or sooner if the feed has been quiet for FEED_TIMEOUT)
+and the end of RUNTIME. Each wakeup handles at most MAX_BATCH datagrams, then
+removes stale quotes and reports arbitrage once for the whole batch, so neither
+deadline can be held up by a busy feed.
+
+References
+https://docs.python.org/3/library/selectors.html
 """
 import math
+import selectors
 import socket
 import sys
 import time
 from datetime import datetime, timedelta
 
 import fxp_bytes_subscriber
-from bellman_ford import BellmanFord
+from arbitrage_detector import ArbitrageDetector
+from market_graph import MarketGraph
 
 # Global vars per spec
 BUF_SZ = 4096           # bytes
@@ -23,6 +33,9 @@ SUBSCRIPTION_TIME = 19  # 10 * 60  # seconds
 TIME_TO_STALE = 1.5     # Threshold for an old quote
 USD_TRADE_VAL = 100     # Assume USD is always 100
 RUNTIME = 10 * 60       # Run for 10 minutes per spec
+RENEWAL_INTERVAL = SUBSCRIPTION_TIME / 2  # resubscribe this often (a renewal may be lost)
+FEED_TIMEOUT = 5        # resubscribe if no quotes for this long (seconds)
+MAX_BATCH = 64          # most datagrams handled per wakeup
 
 # commonly used dict keys
 TIMESTAMP, CROSS, PRICE = 'timestamp', 'cross', 'price'
@@ -51,7 +64,10 @@ class Lab3(object):
         """
 
         # represents bellman ford exploration space
-        self.graph = {}
+        self.graph = MarketGraph()
+
+        # checks each edge as it changes for new negative cycles
+        self.detector = ArbitrageDetector(self.graph)
 
         # subscriber always starts on local host at hardkeyed port number
         self.listener_address = (socket.gethostbyname('localhost'), 45678)
@@ -73,33 +89,43 @@ class Lab3(object):
             sub.sendto(subscribe_msg, self.provider)
             print('subscribe: sent subscribe message to pub')
 
-    def handle_stream(self):
-        """
-        Opens listening socket. Processes UDP packets rec'd by unmarshalling them and
-        directing them to the Bellman Ford object.
+    def handle_stream(self, listener, max_batch=MAX_BATCH):
         """
+        Processes the UDP packets waiting on the listener (up to max_batch of them) by
+        unmarshalling them and adding their quotes to the graph, then removes stale
+        quotes and reports any arbitrage.
 
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as listener:
-            listener.bind(self.listener_address)
-            print('\nblocking, waiting to receive message from forex ')
-
-            while True:
+        :param listener: non-blocking UDP socket the quotes arrive on
+        :param max_batch: most packets to handle before returning to the event loop
+        :return: number of packets handled
+        """
+        handled = 0
+        while handled < max_batch:
+            try:
                 b_provider_msg, _addr = listener.recvfrom(BUF_SZ)
-                quote_list = fxp_bytes_subscriber.unmarshall_msg(b_provider_msg)
-
-                for quote in quote_list:
-                    # check if it's out of order, if not, add to graph, else skip
-                    if not self.is_out_of_order(quote[CROSS], quote[TIMESTAMP]):
-                        print_quote(quote)  # log
-
-                        # convert price to -log and add quote to graph
-                        quote[PRICE] = (-1) * math.log(quote[PRICE])
-                        self.add_quote_to_graph(quote)
-                    else:
-                        print('ignoring out-of-sequence message')
-                # remove stale quotes from the graph then call bellman ford
-                self.remove_stale_rates()
-                self.run_bellman_ford()
+            except (BlockingIOError, InterruptedError):
+                break
+            handled += 1
+            quote_list = fxp_bytes_subscriber.unmarshal_quotes(b_provider_msg)
+
+            for quote in quote_list:
+                # check if it's out of order, if not, add to graph, else skip
+                if not self.is_out_of_order(quote[CROSS], quote[TIMESTAMP]):
+                    print_quote(quote)  # log
+
+                    # convert price to -log and add quote to graph
+                    quote[PRICE] = (-1) * math.log(quote[PRICE])
+                    self.add_quote_to_graph(quote)
+                else:
+                    print('ignoring out-of-sequence message')
+
+        # remove stale quotes from the graph then report any arbitrage
+        if handled:
+            self.remove_stale_rates()
+            cycle = self.detector.check()
+            if cycle:
+                self.print_cycle(cycle)
+        return handled
 
     def add_quote_to_graph(self, quote):
         """
@@ -107,55 +133,37 @@ class Lab3(object):
         bidirectional edges as appropriate.
 
         :param quote: dictionary representing a forex quote
+        :return: a negative cycle the new edges made, or None
         """
 
         curr_a, curr_b = quote[CROSS].split('/')
 
-        """add directional edge between start and end vertices. start vertex not in 
-        graph, create entry in graph with nested dict as value 
-        holding end vertex as key and timestamp and rate as value"""
-        if curr_a not in self.graph:
-            self.graph[curr_a] = {}
-
-        # add edge (a->b) rate from start to end vertex
-        self.graph[curr_a][curr_b] = {TIMESTAMP: quote[TIMESTAMP], PRICE: quote[PRICE]}
+        # add edge (a->b) rate from start to end vertex (currencies are added as needed)
+        slot = self.graph.set_edge(curr_a, curr_b, quote[PRICE], quote[TIMESTAMP])
+        cycle = self.detector.edge_updated(slot)
 
-        # add edge (b->a) rate from end vertex to start, if applicable
-        if curr_b not in self.graph:
-            self.graph[curr_b] = {}
-        self.graph[curr_b][curr_a] = {TIMESTAMP: quote[TIMESTAMP], PRICE: (-1) * quote[
-            PRICE]}
+        # add edge (b->a) rate from end vertex to start
+        slot = self.graph.set_edge(curr_b, curr_a, (-1) * quote[PRICE], quote[TIMESTAMP])
+        return self.detector.edge_updated(slot) or cycle
 
-    def run_bellman_ford(self, tolerance=1e-10):
+    def print_cycle(self, cycle):
         """
-        Runs the Bellman Ford algorithm and prints the results to console.
-        :param tolerance:
-        :return: (dist, prev, neg_edge) tuple
-        """
-
-        # init bf object with graph
-        mybf = BellmanFord(self.graph)
-        dist, prev, neg_edge = mybf.shortest_paths('USD')
-
-        # if a negative edge was found, print the arbitrage report
-        if neg_edge:
-            self.print_arbitrage(prev, 'USD')
+        Prints a negative cycle, starting from USD if it goes through USD
 
-    def print_arbitrage(self, prev, src):
+        :param cycle: [currency, ..., currency] with the same first and last
         """
-        Prints the path to log messages
-        :param prev: locations where currency was previously recorded
-        :param src: starting currency
-        """
-
-        path, end = [src], prev[src]
+        if 'USD' in cycle:
+            at = cycle.index('USD')
+            cycle = cycle[at:-1] + cycle[:at] + ['USD']
+        self.print_path(cycle)
 
-        while not end == src:
-            path.append(end)
-            end = prev[end]
+    def print_path(self, path):
+        """
+        Prints the trades around an arbitrage path
 
-        path.append(src)
-        path.reverse()
+        :param path: [src, ..., src] currencies to exchange through in order
+        """
+        src = path[0]
         value = 100
         last = src
         print('ARBITRAGE:')
@@ -163,7 +171,7 @@ class Lab3(object):
 
         for _ in range(1, len(path)):
             curr = path[_]
-            value *= math.exp(-1 * self.graph[last][curr]["price"])
+            value *= math.exp(-1 * self.graph.weight[self.graph.find(last, curr)])
             print("\t\texchange {} for {} {}".format(last, curr, value))
             last = curr
 
@@ -190,30 +198,55 @@ class Lab3(object):
         """
         stale_time = datetime.utcnow() - timedelta(seconds=TIME_TO_STALE)
 
-        to_delete = []
+        for currency_a, currency_b in self.graph.expire(stale_time):
+            print('removing stale quote for ({}, {})'.format([currency_a], [currency_b]))
 
-        for currency_a in self.graph:
-            for currency_b in self.graph[currency_a]:
-                if self.graph[currency_a][currency_b][TIMESTAMP] <= stale_time:
-                    to_delete.append((currency_a, currency_b))
-        for item in to_delete:
-            print('removing stale quote for ({}, {})'.format([item[0]], [item[1]]))
-            del self.graph[item[0]][item[1]]
-
-    def run(self):
-        """Subscribes and runs for RUNTIME."""
-
-        # attempt to subscribe
-        self.subscribe()
+    def run(self, runtime=RUNTIME):
+        """
+        Subscribes, then handles quotes as they arrive for runtime seconds, renewing
+        the subscription before it runs out.
 
-        # end loop after RUNTIME per spec
-        end = time.time() + RUNTIME
-        while time.time() < end:
-            self.handle_stream()
+        :param runtime: seconds to run for
+        """
+        selector = selectors.DefaultSelector()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as listener:
+            listener.bind(self.listener_address)
+            listener.setblocking(False)
+            selector.register(listener, selectors.EVENT_READ)
+
+            now = time.monotonic()
+            end = now + runtime
+            subscribed = heard = None
+            renew = now  # subscribe straight away
+            while now < end:
+                if now >= renew:
+                    if subscribed is not None and now < subscribed + RENEWAL_INTERVAL:
+                        print('no quotes for {}s, renewing subscription'.format(FEED_TIMEOUT))
+                    self.subscribe()
+                    subscribed = now
+                renew = self.renewal_due(subscribed, heard)
+
+                # sleep until the next quote, renewal or the end
+                for _key, _mask in selector.select(max(0.0, min(renew, end) - now)):
+                    if self.handle_stream(listener):
+                        heard = time.monotonic()
+                now = time.monotonic()
+        selector.close()
 
         print('END OF PROGRAM')
         return
 
+    @staticmethod
+    def renewal_due(subscribed, heard):
+        """
+        When to renew the subscription: RENEWAL_INTERVAL after the last one, or
+        FEED_TIMEOUT after the feed went quiet if that is sooner.
+
+        :param subscribed: time.monotonic() of the last subscribe
+        :param heard: time.monotonic() of the last quotes (None if none yet)
+        """
+        quiet_since = subscribed if heard is None else max(subscribed, heard)
+        return min(subscribed + RENEWAL_INTERVAL, quiet_since + FEED_TIMEOUT)
 
 if __name__ == '__main__':
     print('\n/// Forex Subscriber ///')
@@ -0,0 +1,147 @@
+"""
+Market Graph
+:authors: Narissa Tsuboi
+:version: 1
+:brief: The arbitrage detector's graph of currencies (vertices) and quotes (edges).
+Each currency is interned to an integer id the first time it is seen, and the edges
+are kept in parallel arrays indexed by edge slot: src id, dst id, weight (-log of
+the rate) and quote timestamp. A dict from src id << 32 | dst id to slot makes
+updating a quote O(1), and each currency keeps the list of slots of the edges leaving
+it. Removed edges' slots are reused by the next new edges.
+
+Stale quotes are found with a min-heap of (timestamp, version, slot) entries, one
+pushed each time an edge is set. An entry is only acted on if the slot still holds
+that version of the edge; overwritten or removed edges just leave their old entries
+to be discarded when they reach the top. So expiring costs O(log n) per entry popped,
+and nothing that hasn't expired is looked at.
+
+An edge costs two ints and a float in typed arrays plus a timestamp reference and
+its index entry, instead of a dict of its own inside a dict of dicts, and the
+solvers relax over plain arrays of ints and floats instead of looking up
+graph[a][b]['price'].
+
+References
+https://docs.python.org/3/library/array.html
+https://docs.python.org/3/library/heapq.html
+"""
+import heapq
+import itertools
+from array import array
+
+
+class MarketGraph(object):
+
+    def __init__(self):
+        self.ids = {}  # {currency: id, ...}
+        self.names = []  # [currency, ...] indexed by id
+        self.out = []  # [[slot, ...], ...] indexed by id: edges leaving the currency
+        self.src = array('i')  # edge slot -> start currency id
+        self.dst = array('i')  # edge slot -> end currency id
+        self.weight = array('d')  # edge slot -> -log(rate)
+        self.timestamp = []  # edge slot -> quote timestamp (None if slot is free)
+        self.slots = {}  # {src id << 32 | dst id: slot, ...} for every edge in the graph
+        self.free = []  # slots of removed edges, reused first
+        self.version = array('Q')  # edge slot -> version of the edge in it
+        self.expiry = []  # heap of (timestamp, version, slot), incl. outdated ones
+        self.versions = itertools.count(1)  # 0 is never current
+
+    def __len__(self):
+        """ Number of currencies """
+        return len(self.names)
+
+    def intern(self, currency):
+        """
+        :param currency: eg 'USD'
+        :return: currency's id, assigned now if it is new
+        """
+        i = self.ids.get(currency)
+        if i is None:
+            i = self.ids[currency] = len(self.names)
+            self.names.append(currency)
+            self.out.append([])
+        return i
+
+    def set_edge(self, currency_a, currency_b, weight, timestamp):
+        """
+        Add the edge a->b, or update it if it is already there.
+
+        :param currency_a: start currency
+        :param currency_b: end currency
+        :param weight: -log of the exchange rate
+        :param timestamp: time of the quote
+        :return: the edge's slot
+        """
+        u, v = self.intern(currency_a), self.intern(currency_b)
+        version = next(self.versions)
+        slot = self.slots.get(u << 32 | v)
+        if slot is not None:
+            self.weight[slot] = weight
+            self.timestamp[slot] = timestamp
+            self.version[slot] = version
+        else:
+            if self.free:
+                slot = self.free.pop()
+                self.src[slot], self.dst[slot] = u, v
+                self.weight[slot], self.timestamp[slot] = weight, timestamp
+                self.version[slot] = version
+            else:
+                slot = len(self.src)
+                self.src.append(u)
+                self.dst.append(v)
+                self.weight.append(weight)
+                self.timestamp.append(timestamp)
+                self.version.append(version)
+            self.slots[u << 32 | v] = slot
+            self.out[u].append(slot)
+        heapq.heappush(self.expiry, (timestamp, version, slot))
+        return slot
+
+    def find(self, currency_a, currency_b):
+        """
+        :return: slot of the edge a->b, or None if there is no such edge
+        """
+        u, v = self.ids.get(currency_a), self.ids.get(currency_b)
+        if u is None or v is None:
+            return None
+        return self.slots.get(u << 32 | v)
+
+    def remove_slot(self, slot):
+        """ Remove the edge in the given slot """
+        u = self.src[slot]
+        del self.slots[u << 32 | self.dst[slot]]
+        self.out[u].remove(slot)
+        self.timestamp[slot] = None
+        self.version[slot] = 0
+        self.free.append(slot)
+
+    def expire(self, cutoff):
+        """
+        Remove every edge whose quote timestamp is at or before cutoff.
+
+        :param cutoff: timestamp, comparable with the edges' timestamps
+        :return: [(currency_a, currency_b), ...] of the edges removed, oldest first
+        """
+        expiry, version, names = self.expiry, self.version, self.names
+        removed = []
+        while expiry and expiry[0][0] <= cutoff:
+            _timestamp, edge_version, slot = heapq.heappop(expiry)
+            if version[slot] != edge_version:
+                continue  # edge was updated or removed since
+            removed.append((names[self.src[slot]], names[self.dst[slot]]))
+            self.remove_slot(slot)
+        return removed
+
+    def live(self):
+        """ Slots of every edge in the graph """
+        return self.slots.values()
+
+    def arrays(self):
+        """
+        :return: (src, dst, weight) of every edge, as arrays with no free slots
+        """
+        if not self.free:
+            return self.src, self.dst, self.weight
+        live = list(self.slots.values())
+        return (array('i', [self.src[s] for s in live]),
+                array('i', [self.dst[s] for s in live]),
+                array('d', [self.weight[s] for s in live]))
@@ -0,0 +1,257 @@
+"""
+CPSC 5520, Seattle University
+This is free and unencumbered software released into the public domain.
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Testing file for lab3
+"""
+
+import math
+import random
+import socket
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import fxp_bytes
+import fxp_bytes_subscriber
+import lab3
+from arbitrage_detector import ArbitrageDetector, VECTOR_MIN_CURRENCIES
+from bellman_ford import BellmanFord
+from bellman_ford_np import VectorBellmanFord
+from lab3 import Lab3
+from market_graph import MarketGraph
+
+PRICE = 'price'
+
+
+def dict_graph(rates):
+    """ {a: {b: {PRICE: -log(rate)}}} for BellmanFord, from {(a, b): rate, ...} """
+    graph = {}
+    for (a, b), rate in rates.items():
+        graph.setdefault(a, {})[b] = {PRICE: -math.log(rate)}
+        graph.setdefault(b, {})
+    return graph
+
+
+def random_rates(n, seed, arbitrage=False):
+    """
+    A market of n currencies whose rates come from hidden values, so every cycle
+    breaks even, less a small spread on each quote. With arbitrage, one cycle of
+    three quotes is priced to gain.
+    """
+    rng = random.Random(seed)
+    value = [rng.uniform(0.5, 2.0) for _ in range(n)]
+    rates = {}
+    for a in range(n):
+        for b in rng.sample(range(n), min(n, 4)):
+            if a != b:
+                rates['C{}'.format(a), 'C{}'.format(b)] = value[a] / value[b] * 0.999
+    if arbitrage:
+        for a, b in (('C0', 'C1'), ('C1', 'C2'), ('C2', 'C0')):
+            rates[a, b] = value[int(a[1:])] / value[int(b[1:])] * 1.01
+    return rates
+
+
+class TestMarketGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = MarketGraph()
+
+    def test_intern(self):
+        self.assertEqual([self.graph.intern(c) for c in ('USD', 'EUR', 'USD')], [0, 1, 0])
+        self.assertEqual(self.graph.names, ['USD', 'EUR'])
+        self.assertEqual(len(self.graph), 2)
+
+    def test_upsert(self):
+        slot = self.graph.set_edge('USD', 'EUR', 0.5, 1)
+        self.assertEqual(self.graph.set_edge('USD', 'EUR', 0.25, 2), slot)
+        self.assertEqual(self.graph.find('USD', 'EUR'), slot)
+        self.assertIsNone(self.graph.find('EUR', 'USD'))
+        self.assertEqual(self.graph.weight[slot], 0.25)
+        self.assertEqual(self.graph.timestamp[slot], 2)
+        self.assertEqual(len(self.graph.live()), 1)
+        self.assertEqual(self.graph.out[self.graph.ids['USD']], [slot])
+
+    def test_expire(self):
+        self.graph.set_edge('USD', 'EUR', 0.1, 1)
+        self.graph.set_edge('EUR', 'GBP', 0.2, 2)
+        self.graph.set_edge('USD', 'EUR', 0.3, 5)  # its entry for time 1 is now outdated
+        self.assertEqual(self.graph.expire(3), [('EUR', 'GBP')])
+        self.assertIsNotNone(self.graph.find('USD', 'EUR'))
+        self.assertEqual(self.graph.expire(3), [])
+        self.assertEqual(self.graph.expire(5), [('USD', 'EUR')])
+        self.assertEqual(len(self.graph.live()), 0)
+        self.assertEqual(self.graph.expiry, [])
+
+    def test_removed_slots_reused(self):
+        self.graph.set_edge('USD', 'EUR', 0.1, 1)
+        old = self.graph.set_edge('EUR', 'GBP', 0.2, 1)
+        self.graph.set_edge('GBP', 'USD', 0.3, 3)
+        self.graph.expire(1)
+        self.assertEqual(self.graph.set_edge('USD', 'JPY', 0.4, 4), old)
+        src, dst, weight = self.graph.arrays()
+        names = self.graph.names
+        self.assertEqual(sorted((names[a], names[b], w) for a, b, w in zip(src, dst, weight)),
+                         [('GBP', 'USD', 0.3), ('USD', 'JPY', 0.4)])
+        # the update after a reuse is what stays, not the removed edge's entry
+        self.graph.set_edge('USD', 'JPY', 0.5, 9)
+        self.assertEqual(self.graph.expire(4), [('GBP', 'USD')])
+
+
+class TestArbitrageDetector(unittest.TestCase):
+
+    def quote(self, graph, detector, a, b, rate, timestamp=0):
+        return detector.edge_updated(graph.set_edge(a, b, -math.log(rate), timestamp))
+
+    def test_finds_and_clears_cycle(self):
+        graph = MarketGraph()
+        detector = ArbitrageDetector(graph)
+        self.assertIsNone(self.quote(graph, detector, 'USD', 'EUR', 0.9))
+        self.assertIsNone(self.quote(graph, detector, 'EUR', 'GBP', 0.9))
+        cycle = self.quote(graph, detector, 'GBP', 'USD', 1.3)  # 0.9 * 0.9 * 1.3 > 1
+        self.assertEqual(cycle, ['USD', 'EUR', 'GBP', 'USD'])
+        self.assertEqual(detector.check(), cycle)
+        self.assertLess(detector.cycle_weight(cycle), 0)
+
+        self.quote(graph, detector, 'GBP', 'USD', 1.2)  # 0.9 * 0.9 * 1.2 < 1
+        self.assertIsNone(detector.check())
+        self.assertIsNone(detector.cycle)
+        self.assertIsNone(self.quote(graph, detector, 'EUR', 'USD', 1 / 0.9))
+
+    def test_expired_quote_clears_cycle(self):
+        graph = MarketGraph()
+        detector = ArbitrageDetector(graph)
+        self.quote(graph, detector, 'USD', 'EUR', 0.9, 2)
+        self.quote(graph, detector, 'EUR', 'GBP', 0.9, 2)
+        self.assertIsNotNone(self.quote(graph, detector, 'GBP', 'USD', 1.3, 1))
+        graph.expire(1)
+        self.assertIsNone(detector.check())
+
+    def test_incremental_matches_rebuild(self):
+        for seed in range(5):
+            for arbitrage in (False, True):
+                graph = MarketGraph()
+                detector = ArbitrageDetector(graph)
+                found = None
+                for (a, b), rate in random_rates(30, seed, arbitrage).items():
+                    found = self.quote(graph, detector, a, b, rate) or found
+                self.assertEqual(found is not None, arbitrage)
+                self.assertEqual(ArbitrageDetector(graph).cycle is not None, arbitrage)
+
+    def test_vector_rebuild(self):
+        graph = MarketGraph()
+        for (a, b), rate in random_rates(VECTOR_MIN_CURRENCIES + 10, 3, True).items():
+            graph.set_edge(a, b, -math.log(rate), 0)
+        with mock.patch('arbitrage_detector.VECTOR_MIN_CURRENCIES', math.inf):
+            scalar = ArbitrageDetector(graph).cycle
+        vector = ArbitrageDetector(graph).cycle
+        self.assertIsNotNone(scalar)
+        self.assertIsNotNone(vector)
+        self.assertLess(ArbitrageDetector(graph).cycle_weight(vector), 0)
+
+
+class TestBellmanFord(unittest.TestCase):
+
+    def test_vector_matches_scalar(self):
+        for seed in range(5):
+            for arbitrage in (False, True):
+                graph = dict_graph(random_rates(25, seed, arbitrage))
+                dist, prev, cycle = BellmanFord(graph).shortest_paths('C0', 1e-12)
+                v_dist, v_prev, v_cycle = VectorBellmanFord(graph).shortest_paths('C0', 1e-12)
+                self.assertEqual(cycle is not None, arbitrage)
+                self.assertEqual(v_cycle is not None, arbitrage)
+                if not arbitrage:
+                    for currency in graph:
+                        self.assertAlmostEqual(dist[currency], v_dist[currency])
+
+    def test_tolerance(self):
+        # a cycle that gains less than the tolerance isn't arbitrage
+        graph = dict_graph({('USD', 'EUR'): 0.5, ('EUR', 'USD'): 2.000001})
+        for solver in (BellmanFord, VectorBellmanFord):
+            self.assertIsNotNone(solver(graph).shortest_paths('USD')[2])
+            self.assertIsNone(solver(graph).shortest_paths('USD', 1e-3)[2])
+
+
+class TestQuotes(unittest.TestCase):
+
+    def setUp(self):
+        start = datetime(2023, 5, 6, 7, 8, 9, 123456)
+        self.quotes = [{'timestamp': start + timedelta(microseconds=i * 1001),
+                        'cross': cross, 'price': price}
+                       for i, (cross, price) in enumerate([('GBP/USD', 1.22041),
+                                                           ('USD/JPY', 108.2755),
+                                                           ('EUR/CHF', 0.97)] * 10)]
+
+    def test_marshal_matches_fields(self):
+        expected = b''.join(fxp_bytes.serialize_utcdatetime(q['timestamp']) +
+                            (q['cross'][:3] + q['cross'][4:]).encode() +
+                            fxp_bytes.serialize_price(q['price']) + bytes(10)
+                            for q in self.quotes)
+        self.assertEqual(fxp_bytes.marshal_message(self.quotes), expected)
+        with self.assertRaises(ValueError):
+            fxp_bytes.marshal_message(self.quotes * 2)
+
+    def test_unmarshal_quotes(self):
+        datagram = fxp_bytes.marshal_message(self.quotes) + b'\x00' * 5  # partial quote
+        for numpy in (fxp_bytes_subscriber.np, None):
+            with mock.patch.object(fxp_bytes_subscriber, 'np', numpy):
+                quotes = fxp_bytes_subscriber.unmarshal_quotes(datagram)
+            self.assertEqual(len(quotes), len(self.quotes))
+            self.assertEqual(list(quotes), fxp_bytes_subscriber.unmarshall_msg(datagram))
+            self.assertEqual(list(quotes), self.quotes)
+            self.assertEqual(quotes[1]['cross'], 'USD/JPY')
+
+
+class TestLab3(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.provider.bind(('127.0.0.1', 0))
+        self.provider.settimeout(1)
+        self.addCleanup(self.provider.close)
+        self.lab = Lab3(self.provider.getsockname())
+        self.lab.listener_address = ('127.0.0.1', 0)
+
+    def test_renewal_due(self):
+        with mock.patch.multiple(lab3, RENEWAL_INTERVAL=10, FEED_TIMEOUT=4):
+            self.assertEqual(Lab3.renewal_due(100, None), 104)  # nothing heard yet
+            self.assertEqual(Lab3.renewal_due(100, 103), 107)  # feed went quiet
+            self.assertEqual(Lab3.renewal_due(100, 109), 110)  # feed is fine
+
+    def test_renews_quiet_subscription(self):
+        with mock.patch.multiple(lab3, RENEWAL_INTERVAL=0.2, FEED_TIMEOUT=0.05), \
+                mock.patch('builtins.print'):
+            self.lab.run(runtime=0.3)
+        requests = []
+        self.provider.settimeout(0)
+        try:
+            while True:
+                requests.append(self.provider.recv(64))
+        except BlockingIOError:
+            pass
+        self.assertGreaterEqual(len(requests), 4)  # at 0, then every FEED_TIMEOUT
+        self.assertLessEqual(len(requests), 8)
+        self.assertTrue(all(len(request) == 6 for request in requests))
+
+    def test_handle_stream(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.setblocking(False)
+        self.addCleanup(listener.close)
+        now = datetime.utcnow()
+        datagrams = [[{'timestamp': now, 'cross': 'USD/EUR', 'price': 0.9}],
+                     [{'timestamp': now, 'cross': 'EUR/GBP', 'price': 0.9}],
+                     [{'timestamp': now, 'cross': 'GBP/USD', 'price': 1.3}]]
+        for quotes in datagrams:
+            self.provider.sendto(fxp_bytes.marshal_message(quotes), listener.getsockname())
+        with mock.patch('builtins.print') as printed:
+            self.assertEqual(self.lab.handle_stream(listener, max_batch=2), 2)
+            self.assertEqual(len(self.lab.graph.live()), 4)  # both ways for each cross
+            self.assertEqual(self.lab.handle_stream(listener), 1)
+        self.assertIn(mock.call('ARBITRAGE:'), printed.call_args_list)
+        self.assertEqual(self.lab.detector.cycle[0], self.lab.detector.cycle[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
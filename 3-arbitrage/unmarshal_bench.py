@@ -0,0 +1,81 @@
+"""
+Quote Unmarshalling Benchmark
+:authors: Narissa Tsuboi
+:version: 1
+:brief: Times fxp_bytes_subscriber.unmarshall_msg (a dict per quote) against
+unmarshal_quotes (columns for the whole datagram), with NumPy and with the struct
+fallback, on datagrams of 1 to MAX_QUOTES_PER_MESSAGE quotes. "records" is
+unmarshal_quotes plus building every record dict, the most a caller can ask of it.
+
+Usage:
+    python unmarshal_bench.py [QUOTES ...]
+
+References
+https://docs.python.org/3/library/timeit.html
+"""
+
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import fxp_bytes
+import fxp_bytes_subscriber
+
+DEFAULT_SIZES = (1, 10, fxp_bytes.MAX_QUOTES_PER_MESSAGE)
+CROSSES = ('GBP/USD', 'USD/JPY', 'EUR/USD', 'USD/CHF', 'AUD/USD', 'CAD/EUR', 'CHF/JPY')
+
+
+def datagram(n, seed=5220):
+    """ A provider msg of n random quotes """
+    rng = random.Random(seed)
+    now = datetime(2022, 12, 3)
+    return fxp_bytes.marshal_message([
+        {'timestamp': now + timedelta(microseconds=rng.randrange(10 ** 9)),
+         'cross': rng.choice(CROSSES), 'price': rng.uniform(0.5, 150.0)}
+        for _ in range(n)])
+
+
+def us_per_call(func, min_time=0.2):
+    """ Best mean us per call of func """
+    timer = timeit.Timer(func)
+    number, _elapsed = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=3, number=number)) / number * 1e6
+
+
+def decoders():
+    """ (label, decode function, whether it uses NumPy) for each way to decode """
+    def columns(b):
+        return fxp_bytes_subscriber.unmarshal_quotes(b)
+
+    def records(b):
+        return list(fxp_bytes_subscriber.unmarshal_quotes(b))
+
+    return [('unmarshall_msg', fxp_bytes_subscriber.unmarshall_msg, False),
+            ('columns', columns, True), ('records', records, True),
+            ('columns/struct', columns, False), ('records/struct', records, False)]
+
+
+def main(sizes):
+    numpy = fxp_bytes_subscriber.np
+    labels = [label for label, _decode, _np in decoders()]
+    print('{:>7} '.format('quotes') + ' '.join('{:>15}'.format(l) for l in labels)
+          + '   (us per datagram)')
+    for n in sizes:
+        b = datagram(n)
+        expected = fxp_bytes_subscriber.unmarshall_msg(b)
+        row = []
+        for label, decode, uses_numpy in decoders():
+            fxp_bytes_subscriber.np = numpy if uses_numpy else None
+            if uses_numpy and numpy is None:
+                row.append('-')
+                continue
+            assert list(fxp_bytes_subscriber.unmarshal_quotes(b)) == expected, label
+            row.append('{:,.2f}'.format(us_per_call(lambda: decode(b))))
+        fxp_bytes_subscriber.np = numpy
+        print('{:>7} '.format(n) + ' '.join('{:>15}'.format(cell) for cell in row))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_SIZES)
@@ -4,16 +4,18 @@
 start a new network). This program joins a new node into the network using a
 system-assigned port number for itself. The node joins and then listens for incoming
 connections (other nodes or queriers). You can use blocking TCP for this and pickle for
-the marshaling.
+the marshaling (RPC triples and key lists go out in the compact struct codec).
 """
 
 import hashlib  # for consistent hashing with SHA-1
-import pickle  # for marshalling and unmarshalling
 import socket  # for rpc calls
 import sys
 import threading  # to prevent deadlock
 from datetime import datetime  # for logging
 
+import codec  # for marshalling and unmarshalling
+import framing  # length-prefixed messages
+
 # globals
 
 M = 4  # TODO: Test size, normally hashlib.sha1().digest_size * 8
@@ -154,7 +156,7 @@ class ChordNode(object):
                                                                                     M + 1)]]
         self.pr_log('__init__ finger table')
         self.predecessor = None
-        self.keys = ()
+        self.keys = set()
 
     def __repr__(self):
         node = 'NODE ' + str(self.node) + ' at ' + str(self.addr) + '\n'
@@ -277,11 +279,11 @@ class ChordNode(object):
             else:
                 with conn:
                     self.pr_log('chord_populate connected from {}'.format(_addr))
-                    data = pickle.loads(conn.recv(BUF_SZ))
+                    data = framing.recv_msg(conn)
                     self.pr_log('keys: {}'.format(data))
 
                     # store data to keys
-                    self.keys.add(data)
+                    self.keys.update(data)
 
     def listen_thread(self):  # server side
         """Starts threaded listening server to handle incoming requests"""
@@ -295,12 +297,19 @@ class ChordNode(object):
             threading.Thread(target=self.handle_rpc, args=(client,)).start()
 
     def handle_rpc(self, client):
-        """Unmarshalls msg from client, routes request to dispatch_rpc, waits
-        for result and sends back to client."""
-        rpc = client.recv(BUF_SZ)
-        method, arg1, arg2 = pickle.loads(rpc)
-        result = self.rpc_dispatch(method, arg1, arg2)
-        client.sendall(pickle.dumps(result))
+        """Unmarshalls msgs from client, routes each request to dispatch_rpc, waits
+        for result and sends back to client (in the codec the request came in).
+        Keeps serving framed requests on the same connection until the client
+        closes it."""
+        with client:
+            while True:
+                try:
+                    rpc = framing.recv_frame(client)
+                except (ConnectionError, framing.FramingError):
+                    return
+                (method, arg1, arg2), codec_name = codec.decode(rpc)
+                result = self.rpc_dispatch(method, arg1, arg2)
+                framing.send_msg(client, result, codec_name)
 
     # TODO
     def call_rpc(self, np, param):
@@ -7,13 +7,14 @@ SHA1: https://en.wikipedia.org/wiki/SHA-1
 CSV: https://docs.python.org/3/library/csv.html
 """
 import csv  # for data parsing
-import pickle
 from datetime import datetime  # for timestamp in log
 import hashlib  # for consistent hashing with SHA-1
 import json  # for nested dict formating
 import socket
 import sys
 
+import framing  # length-prefixed messages
+
 # globals
 
 M = 4  # TODO: Test size, normally hashlib.sha1().digest_size * 8
@@ -103,7 +104,7 @@ class Chord(object):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             data = sorted(self.chord_data.keys())
             s.connect(('127.0.0.1', 43543))
-            s.sendall(pickle.dumps(data))
+            framing.send_msg(s, data)
 
 
     def run(self):
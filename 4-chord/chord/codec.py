@@ -0,0 +1,194 @@
+"""
+Message Codecs
+:Authors: Narissa Tsuboi
+:Version: 1
+:brief: Marshalling for the payload of each frame. Two codecs are available:
+
+- pickle: marshals anything, but is slow for small tuples, bloated on the wire and
+  unsafe to accept from untrusted peers.
+- struct: compact fixed-layout binary encoding of the message shapes this lab
+  sends (RPC triples, the key list chord_populate seeds the first node with, text).
+  Anything else falls back to pickle.
+
+Every struct payload starts with MAGIC, which no pickle (protocol 2 and up starts
+with 0x80) does, so payloads identify their own codec. decode() sniffs it and tells
+the caller which codec the peer used; servers answer in the same codec the request
+arrived in, which is how the codec is negotiated per connection.
+
+References
+https://docs.python.org/3/library/struct.html
+https://docs.python.org/3/library/pickle.html (see the warning at the top)
+"""
+
+import pickle
+import struct
+
+PICKLE, STRUCT = 'pickle', 'struct'
+MAGIC = 0xB5  # first byte of every struct-codec payload
+
+# struct-codec message kinds (second byte of the payload), numbered the same in each
+# lab's copy of this module
+K_TEXT, K_RPC, K_INTS = 1, 7, 8
+
+PREFIX = struct.Struct('!BB')  # magic, kind
+COUNT = struct.Struct('!I')
+INT = struct.Struct('!q')  # RPC argument
+KEY = struct.Struct('!I')  # key (key lists are packed as n of these)
+
+
+class CodecError(ValueError):
+    """
+    Raised when a message can't be encoded by, or decoded as, the requested codec.
+    """
+
+
+class PickleCodec(object):
+    """ Marshals anything with pickle """
+    name = PICKLE
+
+    @staticmethod
+    def encode(data):
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(payload):
+        try:
+            return pickle.loads(payload)
+        except Exception as err:
+            raise CodecError('not a pickled message: {}'.format(err))
+
+
+class StructCodec(object):
+    """
+    Fixed-layout binary codec for the chord message shapes.
+
+    >>> c = StructCodec()
+    >>> message = ('find_successor', 12, None)
+    >>> c.decode(c.encode(message)) == message
+    True
+    >>> len(c.encode(message)), len(PickleCodec.encode(message))
+    (26, 34)
+    """
+    name = STRUCT
+
+    # encoding
+
+    def encode(self, data):
+        """
+        :param data: message to marshal
+        :return: payload bytes
+        :raises CodecError: if data isn't one of the supported shapes
+        """
+        try:
+            return self.encode_shape(data)
+        except (struct.error, TypeError, ValueError, AttributeError) as err:
+            if isinstance(err, CodecError):
+                raise
+            raise CodecError('cannot struct-encode {!r}: {}'.format(data, err))
+
+    @staticmethod
+    def encode_shape(data):
+        kind = type(data)
+        if kind is str:
+            return PREFIX.pack(MAGIC, K_TEXT) + data.encode('utf-8')
+        if kind is list:
+            return (PREFIX.pack(MAGIC, K_INTS) + COUNT.pack(len(data)) +
+                    struct.pack('!{}I'.format(len(data)), *data))
+        if (kind is tuple and len(data) == 3 and type(data[0]) is str and
+                all(arg is None or type(arg) is int for arg in data[1:])):
+            method = data[0].encode('utf-8')
+            present = (data[1] is not None) | (data[2] is not None) << 1
+            return (PREFIX.pack(MAGIC, K_RPC) + bytes((len(method),)) + method +
+                    bytes((present,)) + b''.join([INT.pack(arg) for arg in data[1:]
+                                                  if arg is not None]))
+        raise CodecError('unsupported message shape: {!r}'.format(data))
+
+    # decoding
+
+    def decode(self, payload):
+        """
+        :param payload: bytes starting with MAGIC
+        :return: the message
+        :raises CodecError: if the payload is truncated or malformed
+        """
+        try:
+            magic, kind = PREFIX.unpack_from(payload)
+            if magic != MAGIC:
+                raise CodecError('not a struct-codec payload')
+            view = memoryview(payload)[PREFIX.size:]
+            return self.decode_shape(kind, view)
+        except (struct.error, IndexError, UnicodeDecodeError, ValueError) as err:
+            if isinstance(err, CodecError):
+                raise
+            raise CodecError('malformed struct-codec payload: {}'.format(err))
+
+    @staticmethod
+    def decode_shape(kind, view):
+        if kind == K_TEXT:
+            return str(view, 'utf-8')
+        if kind == K_INTS:
+            n, = COUNT.unpack_from(view)
+            body = view[COUNT.size:COUNT.size + n * KEY.size]
+            if len(body) != n * KEY.size:
+                raise CodecError('truncated key list')
+            return list(struct.unpack('!{}I'.format(n), body))
+        if kind == K_RPC:
+            size = view[0]
+            method = str(view[1:1 + size], 'utf-8')
+            present, offset = view[1 + size], 2 + size
+            args = []
+            for bit in (1, 2):
+                if present & bit:
+                    args.append(INT.unpack_from(view, offset)[0])
+                    offset += INT.size
+                else:
+                    args.append(None)
+            return (method,) + tuple(args)
+        raise CodecError('unknown struct-codec kind {}'.format(kind))
+
+
+CODECS = {PICKLE: PickleCodec(), STRUCT: StructCodec()}
+
+
+def encode(data, codec=STRUCT):
+    """
+    Marshal data with the given codec, falling back to pickle for shapes the struct
+    codec doesn't know.
+
+    :param data: message to marshal
+    :param codec: PICKLE or STRUCT
+    :return: payload bytes
+    """
+    if codec == STRUCT:
+        try:
+            return CODECS[STRUCT].encode(data)
+        except CodecError:
+            pass
+    return CODECS[PICKLE].encode(data)
+
+
+def sniff(payload):
+    """
+    The codec a payload is in, going by its first byte only. Lets a server answer a
+    message it couldn't decode in a codec the sender can read.
+
+    >>> sniff(encode([1, 2], STRUCT)), sniff(encode([1, 2], PICKLE))
+    ('struct', 'pickle')
+    """
+    return STRUCT if payload[:1] == bytes((MAGIC,)) else PICKLE
+
+
+def decode(payload, accept_pickle=True):
+    """
+    Unmarshal a payload in whichever codec it was encoded with.
+
+    :param payload: bytes of one frame
+    :param accept_pickle: if False, refuse pickled payloads (e.g. from untrusted peers)
+    :return: (message, codec name)
+    :raises CodecError: if the payload can't be decoded (or is a refused pickle)
+    """
+    if payload[:1] == bytes((MAGIC,)):
+        return CODECS[STRUCT].decode(payload), STRUCT
+    if not accept_pickle:
+        raise CodecError('pickled messages are not accepted')
+    return CODECS[PICKLE].decode(payload), PICKLE